@@ -38,17 +38,56 @@ The currently available promises are:
 
     * constant(names):   promise that variables having the given names will
                          always refer to the same object, across all calls
-                         to the function.
+                         to the function.  With guarded=True this is checked
+                         on each call, and the function is re-optimised if
+                         any of the names changes.
 
     * pure():   promise that the function is a transparent mapping from inputs
                 to outputs; this opens up the possibility of inling it directly
                 into other functions.
 
+    * memoize():    promise that the function is pure and that its results
+                    may be remembered in a bounded table, which is consulted
+                    by code injected into the function itself.
+
+    * final():  promise that a method is not overridden in subclasses; when
+                also applied to the class, calls to final methods on self in
+                its other methods are inlined.
+
+    * types(**signature):   promise that the named arguments are instances of
+                            the given classes, so their methods can be looked
+                            up early and isinstance() checks resolved.
+
     * sensible():   promise that the function is "sensibly behaved".  All
                     builtins and module-level functions are considered
                     constant; all other module-level names are considered
                     invariant.
 
+    * optimize():   promise that the function's bytecode may be cleaned up by
+                    a peephole optimiser; this is best applied on top of other
+                    promises, to remove redundancies in the code they produce.
+
+    * hoist():  promise that pure expressions in loops have the same value on
+                each iteration, so they can be computed once before the loop.
+
+The names given to constant() and invariant() can also be dotted names such
+as "os.path.join", regular expressions such as "/[A-Z_]+/", or be restricted
+to a scope as in "global:/[A-Z_]+/"; see the promise.namespec module.
+
+Promises that can't be applied immediately are deferred until the function
+is first called.  Until then the function's func_code is replaced by a copy
+starting with some bootstrapping code to apply them.  To apply them all ahead
+of time, e.g. in the parent process of a preforking server, call
+promise.apply_all(module).  Promises stacked on the same function are also
+applied together to a single disassembled copy of its code, which is
+reassembled when the function is first called (or by apply_all); any broken
+promises are still reported right away.
+
+Applying promises takes some work at import time (or when each function is
+first called).  To avoid repeating this work in every process, transformed code
+can be cached on disk by calling promise.enable_cache(dirname) or by setting
+the environment variable PROMISE_CACHE_DIR.
+
 Promise is built on Noam Raphael's fantastic "byteplay" module.  It used be
 be bundled as part of promise because it needed some patches to work with
 newer versions of Python; now it's just bundled for your convenience.
@@ -63,9 +102,22 @@ __version__ = "%d.%d.%d%s" % (__ver_major__,__ver_minor__,
                               __ver_patch__,__ver_sub__)
 
 
-import types
+import os
+import sys
+import copy
+import time
+import types as pytypes
+import opcode
+import heapq
+import inspect
+import itertools
+import threading
+from array import array
 
 from promise.byteplay import *
+from promise import cache
+from promise import peephole
+from promise import namespec
 
 
 class BrokenPromiseError(Exception):
@@ -94,27 +146,387 @@ def new_name(name=None):
         return "_promise_var%s_%s" % (_ids.next(),name,)
 
 
+def enable_cache(dirname):
+    """Enable caching of transformed code objects in the given directory.
+
+    See the promise.cache module for details.  The cache can also be enabled
+    by setting the environment variable PROMISE_CACHE_DIR.
+    """
+    cache.enable(dirname)
+
+
+def disable_cache():
+    """Disable caching of transformed code objects."""
+    cache.disable()
+
+
+if os.environ.get("PROMISE_CACHE_DIR"):
+    enable_cache(os.environ["PROMISE_CACHE_DIR"])
+
+
+#  Lock protecting the '_promise_deferred' attribute of functions.  It's held
+#  only while claiming or adding to the list of deferred promises, never while
+#  actually applying them; once the transformed code is installed the lock is
+#  no longer touched when calling the function.
+_deferred_lock = threading.Lock()
+
+
+def _claim_deferred_promises(func):
+    """Atomically remove and return the deferred promises of func.
+
+    Returns a tuple (func_code,deferred,pending) where func_code is the code
+    object in which the deferred promises are bootstrapped, and pending is
+    None or a tuple (code,count) as set up by Promise.apply_or_defer(), giving
+    a Code object to which the first 'count' of them have been applied.  If
+    there are no deferred promises, (None,None,None) is returned.
+    """
+    #  Quick check without the lock, so functions whose promises have already
+    #  been claimed never touch it.
+    if "_promise_deferred" not in func.__dict__:
+        return (None,None,None)
+    _deferred_lock.acquire()
+    try:
+        deferred = func.__dict__.pop("_promise_deferred",None)
+        pending = func.__dict__.pop("_promise_pending",None)
+        return (func.func_code,deferred,pending)
+    finally:
+        _deferred_lock.release()
+
+
 def apply_deferred_promises(func):
-    """Apply any deferred promises attached to a function."""
-    #  Get the code object before checking for deferred promises.
-    #  This prevents race conditions if several threads apply them at once.
-    c = Code.from_code(func.func_code)
+    """Apply any deferred promises attached to a function.
+
+    This is called by the bootstrapping code that Promise.defer() inserts at
+    the start of the function.  The deferred promises are applied exactly
+    once: the first thread to get here claims them and transforms the code,
+    while any other threads calling the function concurrently simply continue
+    to execute the untransformed code.  Returns True if the promises were
+    applied and the caller is running func itself, so that the bootstrapping
+    code can call the transformed function instead.  Copies of func sharing
+    its code object (e.g. with other globals) carry on with their own code.
+
+    If the promises can't be applied, the bootstrapping code is removed and
+    the error is re-raised.
+    """
+    (func_code,deferred,pending) = _claim_deferred_promises(func)
+    if deferred is None:
+        return False
     try:
-        deferred = func._promise_deferred
-    except AttributeError:
-        pass
-    else:
-        del func._promise_deferred
-        #  Remove the bootstrapping code inserted by Promise.defer()
-        idx = c.code.index((POP_TOP,None))
-        del c.code[:idx+1]
+        _apply_promises(func,func_code,deferred,True,pending)
+    except Exception:
+        c = Code.from_code(func_code)
+        _remove_bootstrap(c)
+        func.func_code = c.to_code()
+        raise
+    return _is_running(func,sys._getframe(1))
+
+
+def _is_running(func,frame):
+    """Check whether the given frame could be running func itself.
+
+    Calling func again with the same arguments is then equivalent to the
+    call in the frame: the arguments are passed explicitly, so only the
+    globals and the values of any closure cells need to be the same.
+    """
+    if frame.f_globals is not func.func_globals:
+        return False
+    if func.func_code.co_freevars:
+        values = frame.f_locals
+        for (nm,cell) in zip(frame.f_code.co_freevars,func.func_closure):
+            try:
+                if values[nm] is not cell.cell_contents:
+                    return False
+            except (KeyError,ValueError):
+                return False
+    return True
+
+
+def apply_all(*args):
+    """Eagerly apply deferred promises to all functions in the given objects.
+
+    Each argument can be a function, class, module or package; for packages
+    all of their submodules that have already been imported are included.
+    This is useful for e.g. applying all promises in the parent process of a
+    preforking server, rather than separately in each child.
+
+    Promises that still can't be applied (e.g. because they make constant a
+    name that's not yet defined) remain deferred.  If applying them fails
+    with any other error, the bootstrapping code is removed and the function
+    is left running its untransformed code, as when it's called.  The return
+    value is a list of (func,error) pairs reporting the functions for which
+    either happened.
+    """
+    unresolved = []
+    for func in _find_functions(args):
+        (func_code,deferred,pending) = _claim_deferred_promises(func)
+        if deferred is None:
+            continue
+        try:
+            _apply_promises(func,func_code,deferred,True,pending)
+        except NameError, e:
+            #  The pending code may be half transformed, so it's dropped
+            #  and all the promises are applied afresh next time.
+            unresolved.append((func,e))
+            _deferred_lock.acquire()
+            try:
+                func.__dict__.setdefault("_promise_deferred",deferred)
+            finally:
+                _deferred_lock.release()
+        except Exception, e:
+            unresolved.append((func,e))
+            c = Code.from_code(func_code)
+            _remove_bootstrap(c)
+            func.func_code = c.to_code()
+    return unresolved
+
+
+def _find_functions(objs):
+    """Generate all functions found in the given functions/classes/modules."""
+    seen = set()
+    todo = list(objs)
+    while todo:
+        obj = todo.pop(0)
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj,pytypes.FunctionType):
+            yield obj
+        elif isinstance(obj,(staticmethod,classmethod)):
+            todo.append(obj.__func__)
+        elif isinstance(obj,(type,pytypes.ClassType)):
+            todo.extend(obj.__dict__.itervalues())
+        elif isinstance(obj,pytypes.ModuleType):
+            for (nm,val) in obj.__dict__.items():
+                if isinstance(val,(type,pytypes.ClassType)):
+                    #  Only look into classes defined in this module
+                    if getattr(val,"__module__",None) == obj.__name__:
+                        todo.append(val)
+                elif isinstance(val,pytypes.FunctionType):
+                    todo.append(val)
+            if hasattr(obj,"__path__"):
+                prefix = obj.__name__ + "."
+                for (modnm,mod) in sys.modules.items():
+                    if modnm.startswith(prefix) and mod is not None:
+                        todo.append(mod)
+
+
+def _apply_promises(func,func_code,promises,bootstrap=False,pending=None):
+    """Apply the given promises to func, whose code object is func_code.
+
+    If 'bootstrap' is true then the code begins with the bootstrapping code
+    inserted by Promise.defer(), which is removed before applying them.  If
+    'pending' is given, it's a tuple (code,count) giving a Code object of the
+    function without the bootstrapping code, to which the first 'count' of
+    the promises have already been applied.  If the cache is enabled, the
+    transformed code is loaded from it if possible and stored in it otherwise.
+    """
+    #  Remember the original code and the promises applied to it, so that
+    #  they can be re-applied if a guarded constant changes.
+    if "_promise_history" not in func.__dict__:
+        func._promise_original = (func_code,bootstrap)
+        func._promise_history = []
+    key = cache.make_key(func,func_code,promises)
+    new_code = cache.load(func,key)
+    if new_code is None:
+        if pending is not None:
+            (c,count) = pending
+        else:
+            c = Code.from_code(func_code)
+            if bootstrap:
+                _remove_bootstrap(c)
+            count = 0
         #  Apply each promise in turn
-        for p in deferred:
+        for p in promises[count:]:
             p.apply(func,c)
-        #  Use the transformed bytecode in subsequent calls to func
-        func.func_code = c.to_code()
-    pass
+        new_code = c.to_code()
+        cache.store(func,key,new_code)
+    #  Use the transformed bytecode in subsequent calls to func
+    func.func_code = new_code
+    func._promise_history.extend(promises)
+
+
+def _bootstrap_ops(co,func,start):
+    """Get the bootstrapping code applying the deferred promises of func.
+
+    The code calls apply_deferred_promises(func), and if that transformed
+    func, calls it again with the same arguments and returns the result.
+    Otherwise it jumps to the label 'start' and carries on running the
+    untransformed code in co.  Generators can't return a value, so they
+    always carry on.
+    """
+    ops = [(LOAD_CONST,apply_deferred_promises),(LOAD_CONST,func),
+           (CALL_FUNCTION,1)]
+    nargs = co.co_argcount
+    if co.co_flags & inspect.CO_GENERATOR or nargs > 0xFF:
+        ops.append((POP_TOP,None))
+        return ops
+    varargs = bool(co.co_flags & inspect.CO_VARARGS)
+    varkwds = bool(co.co_flags & inspect.CO_VARKEYWORDS)
+    ops.append((POP_JUMP_IF_FALSE,start))
+    ops.append((LOAD_CONST,func))
+    for nm in co.co_varnames[:nargs+varargs+varkwds]:
+        ops.append((LOAD_FAST,nm))
+    call_op = (CALL_FUNCTION,CALL_FUNCTION_VAR,
+               CALL_FUNCTION_KW,CALL_FUNCTION_VAR_KW)
+    ops.append((call_op[varargs + 2*varkwds],nargs))
+    ops.append((RETURN_VALUE,None))
+    return ops
+
+
+def _insert_bootstrap(co,func):
+    """Get a copy of co starting with the bootstrapping code for func.
+
+    The code from _bootstrap_ops() is added by patching the bytecode
+    directly, moving the targets of absolute jumps along and extending the
+    line number table, which is much quicker than going through byteplay.
+    Code where that's not possible, e.g. because it needs EXTENDED_ARG,
+    goes through byteplay anyway.
+    """
+    ops = _bootstrap_ops(co,func,None)
+    nconsts = len(co.co_consts)
+    size = 0
+    for (op,arg) in ops:
+        size += 1 if op < opcode.HAVE_ARGUMENT else 3
+    if nconsts + 1 <= 0xFFFF and size <= 0xFF:
+        new_code = array("B")
+        for (op,arg) in ops:
+            if op == LOAD_CONST:
+                arg = nconsts + (arg is func)
+            elif op == LOAD_FAST:
+                arg = co.co_varnames.index(arg)
+            elif op == POP_JUMP_IF_FALSE:
+                arg = size
+            new_code.append(op)
+            if arg is not None:
+                new_code.extend((arg & 0xFF,arg >> 8))
+        new_code.fromstring(co.co_code)
+        i = size
+        while i < len(new_code):
+            op = new_code[i]
+            if op == opcode.EXTENDED_ARG:
+                break
+            if op < opcode.HAVE_ARGUMENT:
+                i += 1
+                continue
+            if op in hasjabs:
+                target = new_code[i+1] + (new_code[i+2] << 8) + size
+                if target > 0xFFFF:
+                    break
+                new_code[i+1] = target & 0xFF
+                new_code[i+2] = target >> 8
+            i += 3
+        else:
+            #  The call pushes two values, or the function and its args
+            consts = co.co_consts + (apply_deferred_promises,func)
+            depth = max(2,1 + [op for (op,arg) in ops].count(LOAD_FAST))
+            return pytypes.CodeType(co.co_argcount,co.co_nlocals,
+                                    max(co.co_stacksize,depth),
+                                    co.co_flags,new_code.tostring(),consts,
+                                    co.co_names,co.co_varnames,co.co_filename,
+                                    co.co_name,co.co_firstlineno,
+                                    chr(size) + "\x00" + co.co_lnotab,
+                                    co.co_freevars,co.co_cellvars)
+    start = Label()
+    c = Code.from_code(co,compact=True)
+    c.code[0:0] = _bootstrap_ops(co,func,start) + [(start,None)]
+    return c.to_code()
+
+
+def _remove_bootstrap(code):
+    """Remove the bootstrapping code inserted by Promise.defer()."""
+    for (i,(op,arg)) in enumerate(code.code):
+        if op in (POP_TOP,RETURN_VALUE):
+            del code.code[:i+1]
+            return
+
+
+class _DeferredInnerPromise(object):
+    """Callable applying a promise to inner code when it's first executed.
+
+    Promises on inner code objects (e.g. of generator expressions or nested
+    functions) that can't be applied when the outer function is transformed
+    are deferred by inserting a call to one of these at the start of the
+    inner code.  When called, it applies the promise to the inner code and
+    patches the constants of the outer function's code object, so that inner
+    functions created from then on use the transformed code.  If the names
+    still can't be resolved, nothing is changed and it's tried again the next
+    time the inner code is executed.
+    """
+
+    def __init__(self,func,promise):
+        self.func = func
+        self.promise = promise
+        self.claimed = False
+
+    def __call__(self):
+        #  Claim the work while holding the lock, but don't hold it while
+        #  applying the promise; other threads just run the untransformed
+        #  inner code in the meantime.
+        if self.claimed:
+            return
+        _deferred_lock.acquire()
+        try:
+            if self.claimed:
+                return
+            self.claimed = True
+        finally:
+            _deferred_lock.release()
+        func_code = self.func.func_code
+        try:
+            new_code = self._patch(func_code)
+        except NameError:
+            self.claimed = False
+            return
+        if new_code is not None:
+            _deferred_lock.acquire()
+            try:
+                #  If the outer code was replaced in the meantime, try
+                #  again the next time we're called.
+                if self.func.func_code is func_code:
+                    self.func.func_code = new_code
+                else:
+                    self.claimed = False
+            finally:
+                _deferred_lock.release()
+
+    def insert(self,code):
+        """Insert the bootstrapping code for this object into inner code."""
+        code.code[0:0] = [(LOAD_CONST,self),(CALL_FUNCTION,0),(POP_TOP,None)]
+
+    @staticmethod
+    def remove(code):
+        """Remove any bootstrapping code inserted into the given inner code."""
+        for (i,(op,arg)) in enumerate(code.code):
+            if op is not SetLineno:
+                if op == LOAD_CONST and isinstance(arg,_DeferredInnerPromise):
+                    del code.code[i:i+3]
+                break
+
+    def _patch(self,co):
+        """Get a copy of co with the inner code calling us transformed.
+
+        If there's no such inner code object, None is returned.
+        """
+        consts = list(co.co_consts)
+        for (i,const) in enumerate(consts):
+            if not isinstance(const,pytypes.CodeType):
+                continue
+            for inner_const in const.co_consts:
+                if inner_const is self:
+                    consts[i] = self._transform(const)
+                    return cache._replace_consts(co,consts)
+            new_const = self._patch(const)
+            if new_const is not None:
+                consts[i] = new_const
+                return cache._replace_consts(co,consts)
+        return None
 
+    def _transform(self,co):
+        """Apply the deferred promise to the inner code object co."""
+        c = Code.from_code(co)
+        self.remove(c)
+        self.promise.apply(self.func,c)
+        return c.to_code()
 
 class Promise(object):
     """Base class for promises.
@@ -131,6 +543,10 @@ class Promise(object):
         * apply(func,code):  actually transform the function's bytecode
                              to take advantages of the promised behaviour.
 
+        * cache_key(func):  return a key identifying the transformation that
+                            apply() would perform on the given function, for
+                            use by the on-disk cache; None means uncacheable.
+
     Subclasses may find the following method useful:
 
         * defer(func):  defer the application of this promise until the
@@ -154,7 +570,7 @@ class Promise(object):
         if not args:
             return None
         for arg in args:
-            if isinstance(arg,types.FunctionType):
+            if isinstance(arg,pytypes.FunctionType):
                 self.decorate(arg)
             else:
                 try:
@@ -162,7 +578,7 @@ class Promise(object):
                 except (AttributeError,TypeError):
                     subargs =  (getattr(arg,nm) for nm in dir(arg))
                 for subarg in subargs:
-                    if isinstance(subarg,types.FunctionType):
+                    if isinstance(subarg,pytypes.FunctionType):
                         self(subarg)
         return args[0]
 
@@ -185,22 +601,36 @@ class Promise(object):
         """
         pass
 
+    def cache_key(self,func):
+        """Get a key identifying this promise's transformation of func.
+
+        The key must be a tuple of simple values whose repr() is stable across
+        processes, and must change whenever apply() might transform the same
+        code differently.  Returning None prevents caching of the transformed
+        code; this is the default.
+        """
+        return None
+
     def defer(self,func):
-        """Defer the application of this promise func is first executed."""
-        # Try to be thread-safe by using setdefault(), which is implemented
-        # in C and is therefore non-interruptible.
-        default = []
-        deferred = func.__dict__.setdefault("_promise_deferred",default)
-        deferred.append(self)
-        if deferred is default:
-            #  Add code to apply the promise when func is first executed.
-            #  These opcodes are removed by apply_deferred_promises()
-            c = Code.from_code(func.func_code)
-            c.code.insert(0,(LOAD_CONST,apply_deferred_promises))
-            c.code.insert(1,(LOAD_CONST,func))
-            c.code.insert(2,(CALL_FUNCTION,1))
-            c.code.insert(3,(POP_TOP,None))
-            func.func_code = c.to_code()
+        """Defer the application of this promise func is first executed.
+
+        Until then, func.func_code is a copy of the code starting with a call
+        to apply_deferred_promises(), which puts the transformed code in its
+        place; the first call then calls func again to run it.  Generators,
+        and copies of func made with other globals or closure cells, carry on
+        running the untransformed code instead.
+        """
+        _deferred_lock.acquire()
+        try:
+            default = []
+            deferred = func.__dict__.setdefault("_promise_deferred",default)
+            deferred.append(self)
+            if deferred is default:
+                #  Add code to apply the promise when func is first executed.
+                #  These opcodes are removed by apply_deferred_promises()
+                func.func_code = _insert_bootstrap(func.func_code,func)
+        finally:
+            _deferred_lock.release()
 
     def apply_or_defer(self,func):
         """Apply this promise, or defer it if others are already deferred.
@@ -208,15 +638,146 @@ class Promise(object):
         It's generally a good idea to use this instead of directly applying
         a promise, since it ensures that individual promises will be applied
         in the order in which they appear in code.
+
+        Promises stacked on a function are applied together: each is
+        applied right away to a byteplay Code object kept with the function,
+        so any broken promises are still reported here, but that code is only
+        assembled when the function is first called or apply_all() is used.
+        The function is thus disassembled and reassembled just once, at the
+        cost of keeping the Code object until then.  With the cache enabled,
+        each promise is applied separately instead, so that its work can be
+        skipped when the cache has the result.
         """
+        _deferred_lock.acquire()
         try:
-            deferred = func._promise_deferred
-        except AttributeError:
-            code = Code.from_code(func.func_code)
-            self.apply(func,code)
-            func.func_code = code.to_code()
-        else:
+            deferred = func.__dict__.get("_promise_deferred")
+            if deferred is not None:
+                pending = func.__dict__.get("_promise_pending")
+                if pending is None or pending[1] < len(deferred):
+                    deferred.append(self)
+                    return
+                #  Claim the pending code while applying to it; any calls in
+                #  the meantime run the untransformed code.
+                del func._promise_deferred
+                del func._promise_pending
+        finally:
+            _deferred_lock.release()
+        if deferred is None:
+            if cache.enabled():
+                _apply_promises(func,func.func_code,[self])
+                return
+            pending = (Code.from_code(func.func_code),0)
+        try:
+            self.apply(func,pending[0])
+        except Exception:
+            #  The pending code may be half transformed, so it's dropped
+            #  and the other promises are applied afresh when func is run.
+            if deferred is not None:
+                _deferred_lock.acquire()
+                try:
+                    func.__dict__.setdefault("_promise_deferred",deferred)
+                finally:
+                    _deferred_lock.release()
+            raise
+        _deferred_lock.acquire()
+        try:
+            if deferred is None:
+                deferred = []
+                func.func_code = _insert_bootstrap(func.func_code,func)
             deferred.append(self)
+            func._promise_deferred = deferred
+            func._promise_pending = (pending[0],len(deferred))
+        finally:
+            _deferred_lock.release()
+
+
+#  Opcodes accessing variables by name, which promises about names check.
+_name_ops = (LOAD_GLOBAL,LOAD_NAME,LOAD_DEREF,LOAD_FAST,
+             STORE_GLOBAL,STORE_NAME,STORE_DEREF,STORE_FAST,
+             DELETE_GLOBAL,DELETE_NAME,DELETE_FAST)
+
+
+def _match_dotted(code_list,i,dotted):
+    """Find the dotted name loaded by the chain of ops starting at index i.
+
+    The op at index i loads the first part of the name, and must be followed
+    by a LOAD_ATTR for each of the other parts.  The argument 'dotted' is a
+    list of tuples (parts,scope) as produced by NameMatcher.dotted_names(),
+    longest first so that the longest matching chain wins.  The name is
+    returned as a list of its parts, or None if none of the names match.
+    """
+    (op,arg) = code_list[i]
+    for (parts,scope) in dotted:
+        if parts[0] != arg or i + len(parts) > len(code_list):
+            continue
+        if scope is not None and scope != namespec.op_scope(op):
+            continue
+        for (j,attr) in enumerate(parts[1:]):
+            if code_list[i+j+1] != (LOAD_ATTR,attr):
+                break
+        else:
+            return parts
+    return None
+
+
+def _replace_dotted(code,dotted,kind,replace):
+    """Replace chains of ops loading any of the given dotted names.
+
+    For each matching chain, replace(parts,op) is called with the parts of
+    the name and the op loading its first part.  It returns the op to use
+    instead of the chain, or None to leave the chain alone.  If the first
+    part of a name is assigned to, or any of its attributes are assigned to
+    or deleted, BrokenPromiseError is raised.
+    """
+    heads = set(parts[0] for (parts,scope) in dotted)
+    for i in code.find(_name_ops):
+        if code.code[i][1] in heads:
+            break
+    else:
+        return
+    code_list = code.code
+    new_code = []
+    i = 0
+    while i < len(code_list):
+        (op,arg) = code_list[i]
+        if arg in heads and op in (LOAD_GLOBAL,LOAD_NAME,LOAD_DEREF,LOAD_FAST):
+            #  Quick check that the attributes aren't munged
+            chain = [arg]
+            j = i + 1
+            while j < len(code_list) and code_list[j][0] == LOAD_ATTR:
+                chain.append(code_list[j][1])
+                j += 1
+            if j < len(code_list) and code_list[j][0] in (STORE_ATTR,DELETE_ATTR):
+                chain.append(code_list[j][1])
+                for (parts,scope) in dotted:
+                    if parts[:len(chain)] == chain:
+                        msg = "name '%s' was promised %s, but '%s' was modified"
+                        msg = msg % (".".join(parts),kind,".".join(chain))
+                        raise BrokenPromiseError(msg)
+            parts = _match_dotted(code_list,i,dotted)
+            if parts is not None:
+                new_op = replace(parts,op)
+                if new_op is not None:
+                    new_code.append(new_op)
+                    i += len(parts)
+                    continue
+        elif op in (STORE_NAME,STORE_GLOBAL,STORE_FAST,STORE_DEREF,
+                    DELETE_NAME,DELETE_GLOBAL,DELETE_FAST):
+            if arg in heads:
+                for (parts,scope) in dotted:
+                    if parts[0] != arg:
+                        continue
+                    if scope is None or scope == namespec.op_scope(op):
+                        msg = "name '%s' is part of a name promised %s, but modified"
+                        raise BrokenPromiseError(msg % (arg,kind))
+        new_code.append((op,arg))
+        i += 1
+    code.code[:] = new_code
+
+
+#  Names of the code objects of comprehensions and generator expressions,
+#  which are only ever called with the single argument of their iterator.
+_comprehensions = set(["<genexpr>","<dictcomp>","<setcomp>"])
 
 
 class invariant(Promise):
@@ -238,40 +799,173 @@ class invariant(Promise):
         def myfunc():
             ...do stuff directly with myvar...
 
+    Dotted names such as "os.path.join" or "self.config" make the whole chain
+    of attribute lookups invariant, so it's done only once per call.  This is
+    also handy for hoisting bound methods out of loops, e.g. "out.append".
+    The first part of a dotted name may be one of the function's arguments.
+
+    Generator expressions and dict or set comprehensions using the names are
+    given their values as default arguments, so that they don't look them up
+    on every iteration either.
     """
 
     def __init__(self,names):
-        self.names = names
+        self.names = namespec.matcher(names)
         super(invariant,self).__init__()
 
     def decorate(self,func):
         self.apply_or_defer(func)
 
+    def cache_key(self,func):
+        names = cache.code_names(func.func_code)
+        dotted = [".".join(parts) for (parts,_) in self.names.dotted_names()
+                                  if parts[0] in names]
+        return ("invariant",tuple(sorted(nm for nm in names
+                                          if self.names.match(nm))),
+                tuple(sorted(dotted)))
+
     def apply(self,func,code):
         local_names = {}
         load_ops = []
-        for (i,(op,arg)) in enumerate(code.code):
+        #  Replace chains of loads for dotted names with a LOAD_FAST
+        def replace(parts,op):
+            if op == LOAD_FAST and parts[0] not in code.args:
+                msg = "name '%s' can't be invariant, '%s' isn't an argument"
+                raise BrokenPromiseError(msg % (".".join(parts),parts[0]))
+            name = ".".join(parts)
+            if name not in local_names:
+                local_names[name] = new_name("_".join(parts))
+                load_ops.append((op,parts[0]))
+                for attr in parts[1:]:
+                    load_ops.append((LOAD_ATTR,attr))
+                load_ops.append((STORE_FAST,local_names[name]))
+            return (LOAD_FAST,local_names[name])
+        dotted = self.names.dotted_names()
+        if dotted:
+            _replace_dotted(code,dotted,"invariant",replace)
+        for i in code.find(_name_ops):
+            (op,arg) = code.code[i]
             #  Replace any LOADs of invariant names with a LOAD_FAST
             if op in (LOAD_GLOBAL,LOAD_NAME,LOAD_DEREF):
-                if arg in self.names:
+                if self.names.match(arg,op):
                     if arg not in local_names:
                         local_names[arg] = new_name(arg)
                         load_ops.append((op,arg))
                         load_ops.append((STORE_FAST,local_names[arg]))
-                    code.code[i] = (LOAD_FAST,local_names[arg])
+                    code.replace(i,(LOAD_FAST,local_names[arg]))
             #  Quick check that invariant names arent munged
             elif op in (STORE_NAME,STORE_GLOBAL,STORE_FAST,STORE_DEREF):
-                if arg in self.names:
+                if self.names.match(arg,op):
                     msg = "name '%s' was promised invariant, but assigned to"
                     raise BrokenPromiseError(msg % (arg,))
             elif op in (DELETE_NAME,DELETE_GLOBAL,DELETE_FAST):
-                if arg in self.names:
+                if self.names.match(arg,op):
                     msg = "name '%s' was promised invariant, but deleted"
                     raise BrokenPromiseError(msg % (arg,))
+        #  Pass the values into comprehensions and generator expressions as
+        #  default arguments, so they're not looked up on each iteration.
+        def local_for(nm,op):
+            if nm not in local_names:
+                local_names[nm] = new_name(nm)
+                load_ops.append((op,nm))
+                load_ops.append((STORE_FAST,local_names[nm]))
+            return local_names[nm]
+        self._propagate(code,local_for)
+        #  Arguments that were only cells to pass them into inner code can
+        #  now be loaded directly.
+        derefs = set(code.code[i][1] for i in code.find(hasfree))
+        for (i,(op,arg)) in enumerate(load_ops):
+            if op == LOAD_DEREF and arg not in derefs:
+                if arg in code.args and arg not in code.freevars:
+                    load_ops[i] = (LOAD_FAST,arg)
         #  Insert code to load the names in local vars at start of function
         for i,op in enumerate(load_ops):
             code.code.insert(i,op)
 
+    def _propagate(self,code,local_for):
+        """Pass invariant values into inner comprehensions in the given code.
+
+        Each comprehension or generator expression loading invariant names
+        gets an extra parameter for each, whose default is the value of the
+        local variable named by local_for(name,op) in the enclosing code.
+        Closure cells that are no longer needed by the inner code are then
+        dropped.  Nested comprehensions are handled recursively.
+        """
+        if not code.find(hascode):
+            return
+        code_list = code.code
+        i = 0
+        while i < len(code_list) - 1:
+            (op,inner) = code_list[i]
+            (makeop,ndefaults) = code_list[i+1]
+            if op != LOAD_CONST or not isinstance(inner,Code):
+                i += 1
+                continue
+            if makeop not in hascode or inner.name not in _comprehensions:
+                i += 1
+                continue
+            if inner.varargs or inner.varkwargs:
+                i += 1
+                continue
+            needed = self._inner_names(inner)
+            #  Find the start of the code building the function
+            start = i
+            if makeop == MAKE_CLOSURE:
+                (tupop,n) = code_list[i-1]
+                start = i - 1 - n
+                if tupop != BUILD_TUPLE or start < 0:
+                    needed = None
+                else:
+                    for (op,_) in code_list[start:i-1]:
+                        if op != LOAD_CLOSURE:
+                            needed = None
+            if not needed:
+                i += 1
+                continue
+            params = {}
+            defaults = []
+            for (nm,op) in sorted(needed.iteritems()):
+                params[nm] = new_name(nm)
+                defaults.append((LOAD_FAST,local_for(nm,op)))
+            inner.args = tuple(inner.args) + \
+                         tuple(params[nm] for (nm,_) in sorted(needed.iteritems()))
+            for (j,(op,arg)) in enumerate(inner.code):
+                if op in (LOAD_GLOBAL,LOAD_DEREF) and arg in params:
+                    if op == LOAD_GLOBAL or arg in inner.freevars:
+                        inner.code[j] = (LOAD_FAST,params[arg])
+            self._propagate(inner,lambda nm,op: params[nm])
+            #  Drop any closure cells that aren't used any more
+            used = set(arg for (op,arg) in inner.code if op in hasfree)
+            inner.freevars = tuple(nm for nm in inner.freevars if nm in used)
+            if inner.freevars:
+                make = [(LOAD_CLOSURE,nm) for nm in inner.freevars]
+                make.append((BUILD_TUPLE,len(inner.freevars)))
+                make.append((LOAD_CONST,inner))
+                make.append((MAKE_CLOSURE,ndefaults + len(defaults)))
+            else:
+                make = [(LOAD_CONST,inner),
+                        (MAKE_FUNCTION,ndefaults + len(defaults))]
+            code_list[start:i+2] = defaults + make
+            i = start + len(defaults) + len(make)
+
+    def _inner_names(self,inner):
+        """Find the invariant names loaded by an inner comprehension.
+
+        Returns a dict mapping each name to the opcode used to load it from
+        the enclosing code.
+        """
+        names = {}
+        for (op,arg) in inner.code:
+            if op in (LOAD_GLOBAL,LOAD_DEREF) and self.names.match(arg,op):
+                if op == LOAD_GLOBAL or arg in inner.freevars:
+                    names[arg] = op
+            elif op == LOAD_CONST and isinstance(arg,Code):
+                if arg.name in _comprehensions:
+                    for (nm,op) in self._inner_names(arg).iteritems():
+                        if op == LOAD_GLOBAL or nm in inner.freevars:
+                            names[nm] = op
+        return names
+
 
 class constant(Promise):
     """Promise that the given names are constant
@@ -295,11 +989,25 @@ class constant(Promise):
             for i in range(10):
                 yield range(i)
 
+    Dotted names such as "os.path.join" promise that the whole chain of
+    attribute lookups always gives the same object, so it can be replaced by
+    a single constant.  Bound methods can be made constant in this way too,
+    e.g. "registry.lookup" for a global object 'registry'.
+
+    If 'guarded' is true, the promise is checked rather than trusted:  code
+    is added to the start of the function to check that each name still
+    refers to the same object, and if any has changed (e.g. because it was
+    monkeypatched) all promises are re-applied to the function's original
+    code and the call is retried.  This costs a name lookup per guarded name
+    per call, rather than one per use; Python 2 dicts can't be watched for
+    changes or carry a version tag, so there's no cheaper check.  Inner functions aren't guarded, so
+    their names are left alone, and generators can't be guarded.
     """
 
-    def __init__(self,names,exclude=[]):
-        self.names = names
+    def __init__(self,names,exclude=[],guarded=False):
+        self.names = namespec.matcher(names)
         self.exclude = exclude
+        self.guarded = guarded
         super(constant,self).__init__()
 
     def _load_name(self,func,name,op=None):
@@ -322,7 +1030,20 @@ class constant(Promise):
            except NameError:
                pass
         raise NameError(name)
- 
+
+    def _load_dotted(self,func,parts,op=None):
+        """Look up the given dotted name in the scope of the given function.
+
+        The first part of the name is found by _load_name(), and the others
+        as attributes.  If any of them can't be found, NameError is raised.
+        """
+        value = self._load_name(func,parts[0],op)
+        for attr in parts[1:]:
+            try:
+                value = getattr(value,attr)
+            except AttributeError:
+                raise NameError(".".join(parts))
+        return value
 
     def _load_name_deref(self,func,name):
         """Simulate (LOAD_DEREF,name) on the given function."""
@@ -335,7 +1056,11 @@ class constant(Promise):
                 idx -= len(func.func_code.co_cellvars)
             except ValueError:
                 raise NameError(name)
-        return func.func_closure[idx].cell_contents
+        #  The cell may not be filled in yet, e.g. for recursive functions
+        try:
+            return func.func_closure[idx].cell_contents
+        except ValueError:
+            raise NameError(name)
 
     def _load_name_global(self,func,name):
         """Simulate (LOAD_GLOBAL,name) on the given function."""
@@ -348,19 +1073,82 @@ class constant(Promise):
             raise NameError(name)
 
     def decorate(self,func):
+        if self.guarded:
+            c = Code.from_code(func.func_code,compact=True)
+            if YIELD_VALUE in c.code.opcodes:
+                raise TypeError("generators can't have guarded constants")
         try:
             self.apply_or_defer(func)
         except NameError:
             self.defer(func)
 
+    def cache_key(self,func):
+        #  The transformed code depends on the values of the constant names,
+        #  as well as which names are constant.
+        values = []
+        names = cache.code_names(func.func_code)
+        for nm in sorted(names):
+            if self.names.match(nm) and nm not in self.exclude:
+                try:
+                    val = self._load_name(func,nm)
+                except NameError:
+                    values.append((nm,None))
+                else:
+                    values.append((nm,cache.fingerprint(val)))
+        for (parts,_) in self.names.dotted_names(self.exclude):
+            if parts[0] in names:
+                nm = ".".join(parts)
+                try:
+                    val = self._load_dotted(func,parts)
+                except NameError:
+                    values.append((nm,None))
+                else:
+                    values.append((nm,cache.fingerprint(val)))
+        return ("constant",tuple(sorted(values)),tuple(sorted(self.exclude)),
+                self.guarded)
+
     def apply(self,func,code):
         new_constants = {}
-        old_constants = set()
+        guard_ops = {}
         missing_names = []
-        for (i,(op,arg)) in enumerate(code.code):
+        #  Replace chains of loads for dotted names with a LOAD_CONST
+        def replace(parts,op):
+            name = ".".join(parts)
+            if op == LOAD_FAST:
+                raise BrokenPromiseError("local names can't be constant: '%s'" % (name,))
+            if name in missing_names:
+                return None
+            try:
+                val = new_constants[name]
+            except KeyError:
+                try:
+                    val = self._load_dotted(func,parts,op)
+                except NameError:
+                    missing_names.append(name)
+                    return None
+                compare = "is not"
+                if self.guarded:
+                    #  Bound methods are created afresh on each lookup, so
+                    #  they can only be checked for equality.  Chains that
+                    #  don't even give equal objects can't be checked at all.
+                    again = self._load_dotted(func,parts,op)
+                    if again is not val:
+                        if again != val:
+                            return None
+                        compare = "!="
+                new_constants[name] = val
+                guard_ops[name] = [(op,parts[0])]
+                guard_ops[name].extend((LOAD_ATTR,attr) for attr in parts[1:])
+                guard_ops[name].extend([(LOAD_CONST,val),(COMPARE_OP,compare)])
+            return (LOAD_CONST,val)
+        dotted = self.names.dotted_names(self.exclude)
+        if dotted:
+            _replace_dotted(code,dotted,"constant",replace)
+        for i in code.find(_name_ops):
+            (op,arg) = code.code[i]
             #  Replace LOADs of matching names with LOAD_CONST
             if op in (LOAD_GLOBAL,LOAD_DEREF,LOAD_NAME):
-                if arg in self.names:
+                if self.names.match(arg,op):
                     if arg in self.exclude or arg in missing_names:
                         continue
                     try:
@@ -372,56 +1160,248 @@ class constant(Promise):
                             missing_names.append(arg)
                         else:
                             new_constants[arg] = val
-                            code.code[i] = (LOAD_CONST,val)
+                            guard_ops[arg] = [(op,arg),(LOAD_CONST,val),
+                                              (COMPARE_OP,"is not")]
+                            code.replace(i,(LOAD_CONST,val))
                     else:
-                        code.code[i] = (LOAD_CONST,val)
+                        code.replace(i,(LOAD_CONST,val))
             #  Quick check that locals haven't been promised constant
             elif op == LOAD_FAST:
-                if arg in self.names:
+                if self.names.match(arg,op):
                     raise BrokenPromiseError("local names can't be constant: '%s'" % (arg,))
             #  Quick check that constant names arent munged
             elif op in (STORE_NAME,STORE_GLOBAL,STORE_FAST,STORE_DEREF):
-                if arg in self.names:
+                if self.names.match(arg,op):
                     msg = "name '%s' was promised constant, but assigned to"
                     raise BrokenPromiseError(msg % (arg,))
             elif op in (DELETE_NAME,DELETE_GLOBAL,DELETE_FAST):
-                if arg in self.names:
+                if self.names.match(arg,op):
                     msg = "name '%s' was promised constant, but deleted"
                     raise BrokenPromiseError(msg % (arg,))
-            #  Track any existing constants for use in the next step
-            elif op == LOAD_CONST:
-                if arg not in old_constants:
-                    old_constants.add(arg)
-                #  Recursively apply promise to any inner functions.
-                #  TODO: how can we do deferred promises on inner functions?
-                if i+1 < len(code.code):
-                    (nextop,nextarg) = code.code[i+1]
-                    if nextop in (MAKE_FUNCTION,MAKE_CLOSURE):
-                        exclude = arg.to_code().co_varnames
-                        p = self.__class__(names=self.names,exclude=exclude)
-                        try:
-                            p.apply(func,arg)
-                        except NameError:
-                            pass
+        #  Recursively apply promise to any inner functions.
+        #  If that's not yet possible, defer it until they're run.
+        if not self.guarded:
+            for i in code.find(hascode):
+                (op,arg) = code.code[i-1]
+                if op == LOAD_CONST:
+                    exclude = arg.to_code().co_varnames
+                    p = self.__class__(names=self.names,exclude=exclude)
+                    _DeferredInnerPromise.remove(arg)
+                    try:
+                        p.apply(func,arg)
+                    except NameError:
+                        _DeferredInnerPromise(func,p).insert(arg)
         #  If any constants define a '_promise_fold_constant' method,
         #  let them have a crack at the bytecode as well.
-        for const in new_constants.itervalues():
-            try:
-                fold = const._promise_fold_constant
-            except AttributeError:
-                pass
-            else:
-                fold(func,code)
-        for const in old_constants:
+        _fold_constants(func,code)
+        if self.guarded and guard_ops:
+            self._insert_guards(func,code,guard_ops)
+        #  Re-raise a NameError if any occurred
+        if missing_names:
+            raise NameError(",".join(missing_names))
+
+    def _insert_guards(self,func,code,guard_ops):
+        """Insert code checking that the constant names haven't changed.
+
+        The argument 'guard_ops' maps each name to the ops comparing its
+        current value with the constant, giving True if it has changed.
+
+        If any has, or can't be found at all, the arguments are passed on
+        to a _ConstantGuard, which re-applies the function's promises and
+        calls it again.
+        """
+        (changed,handler,deopt) = (Label(),Label(),Label())
+        guards = [(SETUP_EXCEPT,handler)]
+        for nm in sorted(guard_ops):
+            guards.extend(guard_ops[nm])
+            guards.append((POP_JUMP_IF_TRUE,changed))
+        guards.append((POP_BLOCK,None))
+        #  The slow path goes at the end, out of the way of the fast path
+        slow_path = [(changed,None),
+                     (POP_BLOCK,None),
+                     (JUMP_FORWARD,deopt),
+                     (handler,None),
+                     (POP_TOP,None),
+                     (POP_TOP,None),
+                     (POP_TOP,None),
+                     (deopt,None),
+                     (LOAD_CONST,_ConstantGuard(func))]
+        for argname in code.args:
+            slow_path.append((LOAD_FAST,argname))
+        npos = len(code.args) - code.varargs - code.varkwargs
+        call_op = (CALL_FUNCTION,CALL_FUNCTION_VAR,
+                   CALL_FUNCTION_KW,CALL_FUNCTION_VAR_KW)
+        call_op = call_op[code.varargs + 2*code.varkwargs]
+        slow_path.extend([(call_op,npos),(RETURN_VALUE,None)])
+        code.code[0:0] = guards
+        code.code.extend(slow_path)
+
+
+class _ConstantGuard(object):
+    """Callable deoptimising a function when a guarded constant changes.
+
+    The first call re-applies all of the function's promises to its original
+    code, which installs new guards for the new values of the names.  Calls
+    are then passed on to the function itself.
+    """
+
+    def __init__(self,func):
+        self.func = func
+        self.tripped = False
+
+    def __call__(self,*args,**kwds):
+        _deferred_lock.acquire()
+        try:
+            tripped = self.tripped
+            self.tripped = True
+        finally:
+            _deferred_lock.release()
+        if not tripped:
+            _reapply_promises(self.func)
+        return self.func(*args,**kwds)
+
+
+def _reapply_promises(func):
+    """Re-apply all the promises of func to its original code.
+
+    If that's not possible, func is left running its original code.
+    """
+    (func_code,bootstrap) = func._promise_original
+    promises = func._promise_history
+    func._promise_history = []
+    func.__dict__.pop("_promise_inline_report",None)
+    try:
+        _apply_promises(func,func_code,promises,bootstrap)
+    except NameError:
+        if bootstrap:
+            c = Code.from_code(func_code)
+            _remove_bootstrap(c)
+            func_code = c.to_code()
+        func.func_code = func_code
+        func._promise_history = promises
+
+
+def _fold_constants(func,code):
+    """Let constants with a '_promise_fold_constant' method transform code.
+
+    Constants are folded in order of their first appearance in the code, and
+    folding is repeated until nothing changes, so that calls exposed by e.g.
+    inlining one pure function into another are folded in turn.  The fold
+    state is kept on the Code object, so that it's shared by all promises
+    applied to it.
+    """
+    try:
+        state = code._promise_fold_state
+    except AttributeError:
+        state = code._promise_fold_state = _FoldState(func)
+    changed = True
+    while changed:
+        changed = False
+        seen = set()
+        consts = [code.code[i][1] for i in code.find(LOAD_CONST)]
+        for arg in consts:
+            if id(arg) in seen:
+                continue
+            seen.add(id(arg))
             try:
-                fold = const._promise_fold_constant
+                fold = arg._promise_fold_constant
             except AttributeError:
                 pass
             else:
-                fold(func,code)
-        #  Re-raise a NameError if any occurred
-        if missing_names:
-            raise NameError(",".join(missing_names))
+                if fold(func,code,state):
+                    changed = True
+
+
+class _FoldState(object):
+    """State shared by repeated folds of constants into the same code.
+
+    Callsites are identified by their LOAD_CONST instruction tuples, which
+    are kept alive here so that their ids stay unique.  This records which
+    callsites have already been considered, and for callsites exposed by
+    inlining, the set of functions they were inlined from.  It also tracks
+    the number of instructions each function has added by inlining.
+    """
+
+    def __init__(self,func):
+        self.root_ancestry = frozenset([func])
+        self.considered = {}
+        self.ancestry = {}
+        self.growth = {}
+
+    def consider(self,code,idx):
+        """Mark a callsite as considered; return False if it already was."""
+        instr = code.code[idx]
+        if id(instr) in self.considered:
+            return False
+        self.considered[id(instr)] = instr
+        return True
+
+    def get_ancestry(self,instr):
+        """Get the set of functions the given instruction was inlined from."""
+        try:
+            return self.ancestry[id(instr)][1]
+        except KeyError:
+            return self.root_ancestry
+
+    def set_ancestry(self,code_list,ancestry):
+        """Record the ancestry of the LOAD_CONSTs in some inlined code."""
+        for instr in code_list:
+            if instr[0] == LOAD_CONST:
+                self.ancestry[id(instr)] = (instr,ancestry)
+
+
+def _find_pure_globals(code):
+    """Find the global names loaded by the code of a pure function.
+
+    Since pure functions must not modify their globals, BrokenPromiseError
+    is raised if the code stores to or deletes a global name.
+    """
+    global_names = set()
+    for i in code.find((LOAD_GLOBAL,STORE_GLOBAL,DELETE_GLOBAL)):
+        (op,arg) = code.code[i]
+        if op == LOAD_GLOBAL:
+            global_names.add(arg)
+        elif op in (STORE_GLOBAL,DELETE_GLOBAL):
+            msg = "pure functions must not modify their globals: '%s'"
+            raise BrokenPromiseError(msg % (arg,))
+    return global_names
+
+
+class _EvaluationBudgetExceeded(BaseException):
+    """Exception used to abort evaluation of a pure function call.
+
+    This derives from BaseException so that it's not caught by the usual
+    "except Exception" clauses in the function being evaluated.
+    """
+    pass
+
+
+#  Sentinel for pure function calls that couldn't be evaluated.
+_noresult = object()
+
+def _find_linenos(code):
+    """Find the line number of each instruction in the given Code object."""
+    lineno = code.firstlineno
+    linenos = []
+    for (op,arg) in code.code:
+        if op is SetLineno:
+            lineno = arg
+        linenos.append(lineno)
+    return linenos
+
+
+def _count_instructions(code_list):
+    """Count the real instructions in a code list, ignoring labels etc."""
+    count = 0
+    for (op,arg) in code_list:
+        if not isinstance(op,Label) and op is not SetLineno:
+            count += 1
+    return count
+
+
+#  Opcodes that call a function.
+_call_ops = set([CALL_FUNCTION,CALL_FUNCTION_VAR,CALL_FUNCTION_KW,
+                 CALL_FUNCTION_VAR_KW])
 
 
 class pure(Promise):
@@ -443,138 +1423,1573 @@ class pure(Promise):
         def aggregate(pairs):
             return sum(calculate(a,b) for (a,b) in pairs)
 
+    Calls may use keyword arguments, a constant *args tuple and a **kwds dict
+    display; these are matched up with the function's parameters (including
+    any *args and **kwds parameters) when it is inlined.
+
+    Calls whose arguments are all simple constants (numbers, strings and
+    tuples) are evaluated once at transformation time and replaced by their
+    result.  To keep this cheap, evaluation is abandoned after 'max_eval_steps'
+    trace events or 'max_eval_time' seconds, and results larger than
+    'max_result_size' items are discarded; in these cases, and if the call
+    raises an error, the function is inlined as usual.  This budget is only
+    best-effort: it's checked between lines of Python code, so work done
+    inside a single builtin call can't be interrupted, and results are only
+    measured once they've been computed.  As a precaution, calls are not
+    evaluated if any argument is a number bigger than 'max_eval_steps' or a
+    sequence longer than 'max_result_size', since builtins like xrange() or
+    sum() could spend an unbounded time on them.
+
+    To avoid bloating the code of its callers, the function is not inlined
+    if it's bigger than 'max_inline_size' instructions, or once inlining it
+    has added 'max_growth' instructions to a single caller.  If it has other
+    pure functions inlined into it, it's only inlined while the resulting
+    nesting is at most 'max_inline_depth' levels deep.  Any of these limits
+    can be disabled by setting it to None.  Use promise.inline_report() to
+    see which callsites of a function were inlined or skipped, and why.
     """
 
+    def __init__(self,max_eval_steps=10000,max_eval_time=0.1,
+                 max_result_size=256,max_inline_size=100,max_growth=5000,
+                 max_inline_depth=3):
+        self.max_eval_steps = max_eval_steps
+        self.max_eval_time = max_eval_time
+        self.max_result_size = max_result_size
+        self.max_inline_size = max_inline_size
+        self.max_growth = max_growth
+        self.max_inline_depth = max_inline_depth
+        super(pure,self).__init__()
+
     def decorate(self,func):
-        c = Code.from_code(func.func_code)
-        if c.varargs:
-            raise TypeError("pure functions currently don't support varargs")
-        if c.varkwargs:
-            raise TypeError("pure functions currently don't support varkwds")
+        c = Code.from_code(func.func_code,compact=True)
         func._promise_fold_constant = self._make_fold_method(func)
         #  Since I'm pure, my globals must all be constant
-        global_names = set()
-        for (op,arg) in Code.from_code(func.func_code).code:
-            if op == LOAD_GLOBAL:
-                global_names.add(arg)
-            elif op in (STORE_GLOBAL,DELETE_GLOBAL):
-                msg = "pure functions must not modify their globals: '%s'"
-                raise BrokenPromiseError(msg % (arg,))
-        constant(global_names).decorate(func)
+        constant(_find_pure_globals(c)).decorate(func)
 
     def _make_fold_method(self,source_func):
         """Make _promise_fold_constant method for the given pure function."""
-        def fold(dest_func,dest_code):
-            """Inline the code of source_func into the given bytecode."""
-            #  Apply any deferred promises to source_func.
-            #  Since it's pure, we can simply call it to force this.
-            if hasattr(source_func,"_promise_deferred"):
+        def fold(dest_func,dest_code,state=None):
+            """Inline the code of source_func into the given bytecode.
+
+            The optional 'state' is a _FoldState shared between repeated
+            folds into the same code.  Returns True if the code was changed.
+            """
+            #  Apply any deferred promises to source_func.  Those that still
+            #  can't be applied (e.g. for mutually recursive functions that
+            #  aren't all defined yet) remain deferred.
+            apply_all(source_func)
+            #  Find every inlinable callsite in a single pass, then rebuild
+            #  the instruction list once with all of them inlined.
+            if state is None:
+                state = _FoldState(dest_func)
+            callsites = self._find_inlinable_calls(source_func,dest_code)
+            callsites = [(loadsite,callsite) for (loadsite,callsite)
+                         in callsites if state.consider(dest_code,loadsite)]
+            if not callsites:
+                return False
+            linenos = _find_linenos(dest_code)
+            reports = dest_func.__dict__.setdefault("_promise_inline_report",[])
+            if "_promise_deferred" in source_func.__dict__:
+                for (loadsite,_) in callsites:
+                    reports.append((linenos[loadsite],source_func.__name__,
+                                    "skipped","promises not yet applied"))
+                return False
+            removed = set()
+            inlined = {}
+            depth = getattr(source_func,"_promise_inline_depth",0)
+            growth = state.growth.get(source_func,0)
+            nested = False
+            for (loadsite,callsite) in callsites:
+                def report(action,reason=None):
+                    name = source_func.__name__
+                    reports.append((linenos[loadsite],name,action,reason))
+                call = self._parse_call(dest_code,loadsite,callsite)
+                if call is None:
+                    report("skipped","arguments not known statically")
+                    continue
+                #  Calls with constant arguments can be evaluated right now
+                args = self._find_constant_args(dest_code,call)
+                if args is not None:
+                    value = self._evaluate_call(source_func,*args)
+                    if value is not _noresult:
+                        removed.update(xrange(loadsite,callsite))
+                        inlined[callsite] = [(LOAD_CONST,value)]
+                        report("evaluated")
+                        continue
+                #  Don't expand calls exposed by inlining the same function
+                ancestry = state.get_ancestry(dest_code.code[loadsite])
+                if source_func in ancestry:
+                    report("skipped","recursive")
+                    continue
+                #  Check the inlined code against the cost model
+                template = self._get_inline_template(source_func)
+                if template is None:
+                    report("skipped","function can't be inlined")
+                    continue
+                size = _count_instructions(template)
+                if self.max_inline_size is not None:
+                    if size > self.max_inline_size:
+                        report("skipped","too large (%d instructions)"%(size,))
+                        continue
+                if self.max_inline_depth is not None:
+                    if depth >= self.max_inline_depth:
+                        report("skipped","nested too deeply")
+                        continue
+                code = self._make_inline_code(source_func,call)
+                if code is None:
+                    report("skipped","arguments don't match parameters")
+                    continue
+                size = _count_instructions(code)
+                if self.max_growth is not None:
+                    if growth + size > self.max_growth:
+                        report("skipped","growth budget exhausted")
+                        continue
+                growth += size
+                nested = True
+                removed.add(loadsite)
+                removed.update(call[4])
+                inlined[callsite] = code
+                state.set_ancestry(code,ancestry.union([source_func]))
+                report("inlined")
+            state.growth[source_func] = growth
+            if not inlined:
+                return False
+            #  Record how deeply pure functions are now nested in dest_func
+            if nested:
+                dest_depth = getattr(dest_func,"_promise_inline_depth",0)
+                dest_func._promise_inline_depth = max(dest_depth,depth+1)
+            new_code = []
+            for (i,instr) in enumerate(dest_code.code):
+                if i in removed:
+                    continue
                 try:
-                    source_func(*([None]*source_func.func_code.co_argcount))
-                except Exception:
-                    pass
-            #  Inline the function at every callsite
-            toinline = self._find_inlinable_call(source_func,dest_code)
-            while toinline is not None:
-                (loadsite,callsite) = toinline
-                #  Give new names to the locals in the source bytecode
-                source_code = Code.from_code(source_func.func_code)
-                name_map = self._rename_local_vars(source_code)
-                #  Remove any setlineno ops from the source bytecode
-                new_code = [c for c in source_code.code if c[0] != SetLineno]
-                source_code.code[:] = new_code
-                #  Pop the function arguments directly from the stack.
-                #  Keyword args are currently not supported.
-                numargs = dest_code.code[callsite][1] & 0xFF
-                for i in xrange(numargs):
-                    argname = source_func.func_code.co_varnames[i]
-                    source_code.code.insert(0,(STORE_FAST,name_map[argname]))
-                #  Fill in any missing args from the function defaults
-                numreqd = source_func.func_code.co_argcount
-                for i in xrange(numargs,numreqd):
-                    argname = source_func.func_code.co_varnames[i]
-                    defidx = i - numreqd + len(source_func.func_defaults)
-                    defval = source_func.func_defaults[defidx]
-                    source_code.code.insert(0,(STORE_FAST,name_map[argname]))
-                    source_code.code.insert(0,(LOAD_CONST,defval))
-                #  Munge the source bytecode to leave return value on stack
-                end = Label()
-                source_code.code.append((end,None))
-                for (i,(op,arg)) in enumerate(source_code.code):
-                    if op == RETURN_VALUE:
-                        source_code.code[i] = (JUMP_ABSOLUTE,end)
-                #  Replace the callsite with the inlined code
-                dest_code.code[callsite:callsite+1] = source_code.code
-                del dest_code.code[loadsite]
-                #  Rinse and repeat
-                toinline = self._find_inlinable_call(source_func,dest_code)
+                    new_code.extend(inlined[i])
+                except KeyError:
+                    new_code.append(instr)
+            dest_code.code[:] = new_code
+            return True
         return fold
 
-    def _find_inlinable_call(self,func,code):
-        """Find an inlinable call to func in the given code.
+    def _parse_call(self,code,loadsite,callsite):
+        """Parse the arguments passed by the call at the given site.
 
-        If such a call is found, a tuple (loadsite,callsite) is returned
-        giving the position of the LOAD_CONST on the function and the matching
-        CALL_FUNCTION.  If no inlinable call is found, returns None.
-        """
-        for (i,(op,arg)) in enumerate(code.code):
-            if op == LOAD_CONST and arg == func:
-                loadsite = i
-                callsite = self._find_callsite(loadsite,code.code)
-                if callsite is not None:
-                    (op,arg) = code.code[callsite]
-                    #  Can't currently inline kwdargs
-                    if arg == (arg & 0xFF):
-                        return (loadsite,callsite)
-        return None
+        Keyword names and any *args tuple must be constants, and any **kwds
+        must be a dict display with constant string keys.  The result is
+        a tuple (npos,kwnames,star,values,scaffold) where:
 
-    def _find_callsite(self,idx,code):
-        """Find index of the opcode calling the value pushed at opcode idx.
+            * npos is the number of positional arguments on the stack
+            * kwnames gives the name of each keyword argument on the stack
+            * star is the constant *args tuple, or () if there isn't one
+            * values gives the (start,end) positions of the code computing
+              each argument value, in the order they're pushed
+            * scaffold is the set of positions of the instructions that push
+              the keyword names, *args tuple and **kwds dict; once these are
+              removed, only the argument values are left on the stack
 
-        This method finds the position of the opcode that calls a function
-        pushed onto the stack by opcode 'idx'.  If we cannot reliably find
-        such an opcode (due to weird branching etc) then None is returned.
+        If the arguments can't be determined statically, None is returned.
         """
-        try:
-            callsite = idx + 1
+        (callop,callarg) = code.code[callsite]
+        npos = callarg & 0xFF
+        nkw = (callarg >> 8) & 0xFF
+        #  Find where the code computing each item on the stack starts
+        starts = []
+        for i in xrange(loadsite+1,callsite):
+            (op,arg) = code.code[i]
+            if op is SetLineno:
+                continue
             try:
-                (curop,curarg) = code[callsite]
-            except IndexError:
+                (pop,push) = getse(op,arg)
+            except ValueError:
                 return None
-            (pop,push) = getse(curop,curarg)
-            curstack = push - pop
-            while curstack > 0 or curop != CALL_FUNCTION:
-                callsite += 1
-                try:
-                    (curop,curarg) = code[callsite]
-                except IndexError:
-                    return None
-                (pop,push) = getse(curop,curarg)
-                curstack = curstack + push - pop
-            if curstack == 0:
-                return callsite
+            if pop > len(starts):
+                return None
+            if pop:
+                start = starts[len(starts)-pop]
+                del starts[len(starts)-pop:]
             else:
+                start = i
+            starts.extend([start]*push)
+        nstack = npos + 2*nkw
+        if callop in (CALL_FUNCTION_VAR,CALL_FUNCTION_KW):
+            nstack += 1
+        elif callop == CALL_FUNCTION_VAR_KW:
+            nstack += 2
+        if len(starts) != nstack:
+            return None
+        starts.append(callsite)
+        values = []
+        for i in xrange(npos):
+            values.append((starts[i],starts[i+1]))
+        kwnames = []
+        scaffold = set()
+        for i in xrange(npos,npos+2*nkw,2):
+            name = self._find_single_const(code,starts[i],starts[i+1])
+            if not isinstance(name,str):
                 return None
-        except ValueError:
+            kwnames.append(name)
+            scaffold.add(starts[i])
+            values.append((starts[i+1],starts[i+2]))
+        idx = npos + 2*nkw
+        star = ()
+        if callop in (CALL_FUNCTION_VAR,CALL_FUNCTION_VAR_KW):
+            star = self._find_single_const(code,starts[idx],starts[idx+1])
+            if not isinstance(star,tuple):
+                return None
+            scaffold.add(starts[idx])
+            idx += 1
+        if callop in (CALL_FUNCTION_KW,CALL_FUNCTION_VAR_KW):
+            if not self._parse_dict_display(code,starts[idx],callsite,
+                                            kwnames,values,scaffold):
+                return None
+        return (npos,kwnames,star,values,scaffold)
+
+    def _find_single_const(self,code,start,end):
+        """Find the value pushed by the code between start and end.
+
+        If that code is a single LOAD_CONST, its value is returned;
+        otherwise the sentinel _noresult is returned.
+        """
+        (op,arg) = code.code[start]
+        if op != LOAD_CONST:
+            return _noresult
+        for (op,_) in code.code[start+1:end]:
+            if op is not SetLineno:
+                return _noresult
+        return arg
+
+    def _parse_dict_display(self,code,start,end,kwnames,values,scaffold):
+        """Parse the dict display between start and end into keyword args.
+
+        Keyword names and value positions are appended to 'kwnames' and
+        'values', and the instructions building the dict itself are added
+        to 'scaffold'.  Returns False if the code isn't a simple dict display
+        with constant string keys.
+        """
+        if code.code[start][0] != BUILD_MAP:
+            return False
+        scaffold.add(start)
+        depth = 0
+        valstart = start + 1
+        for i in xrange(start+1,end):
+            (op,arg) = code.code[i]
+            if op is SetLineno:
+                continue
+            if op == STORE_MAP:
+                if depth != 2 or code.code[i-1][0] != LOAD_CONST:
+                    return False
+                if not isinstance(code.code[i-1][1],str):
+                    return False
+                kwnames.append(code.code[i-1][1])
+                values.append((valstart,i-1))
+                scaffold.update((i-1,i))
+                valstart = i + 1
+                depth = 0
+                continue
+            try:
+                (pop,push) = getse(op,arg)
+            except ValueError:
+                return False
+            depth = depth - pop
+            if depth < 0:
+                return False
+            depth = depth + push
+        return depth == 0
+
+    def _find_constant_args(self,code,call):
+        """Find the arguments of a call if they are all simple constants.
+
+        If every argument value of the parsed call is pushed by a LOAD_CONST
+        of a simple immutable value, a tuple (args,kwds) is returned;
+        otherwise None is returned.
+        """
+        (npos,kwnames,star,values,_) = call
+        consts = []
+        for (start,end) in values:
+            value = self._find_single_const(code,start,end)
+            if value is _noresult or not peephole.is_foldable(value):
+                return None
+            consts.append(value)
+        if not peephole.is_foldable(star):
             return None
+        args = consts[:npos] + list(star)
+        kwds = {}
+        for (name,value) in zip(kwnames,consts[npos:]):
+            if name in kwds:
+                return None
+            kwds[name] = value
+        return (args,kwds)
 
-    def _rename_local_vars(self,code):
-        """Rename the local variables in the given code to new unique names.
+    def _evaluate_call(self,func,args,kwds={}):
+        """Evaluate a call to the given pure function within our budget.
 
-        Returns a dictionary mapping old names to new names.
+        The function is run under a trace function that aborts it if it takes
+        too many steps or too long.  If the call fails, its arguments are too
+        big to evaluate safely or the result can't be stored as a constant,
+        the sentinel _noresult is returned.
+        """
+        for value in itertools.chain(args,kwds.itervalues()):
+            if not self._is_small_arg(value):
+                return _noresult
+        steps = [0]
+        deadline = time.time() + self.max_eval_time
+        def tracer(frame,event,arg):
+            steps[0] += 1
+            if steps[0] > self.max_eval_steps or time.time() > deadline:
+                raise _EvaluationBudgetExceeded()
+            return tracer
+        oldtrace = sys.gettrace()
+        sys.settrace(tracer)
+        try:
+            try:
+                value = func(*args,**kwds)
+            finally:
+                sys.settrace(oldtrace)
+        except (Exception,_EvaluationBudgetExceeded):
+            return _noresult
+        if not peephole.is_foldable(value):
+            return _noresult
+        if isinstance(value,(str,unicode,tuple,frozenset)):
+            if len(value) > self.max_result_size:
+                return _noresult
+        return value
+
+    def _is_small_arg(self,value):
+        """Check that an argument is small enough to evaluate calls with.
+
+        The trace function can't interrupt builtins, so numbers bigger than
+        the step budget and sequences bigger than the result size budget are
+        rejected, as they may keep a builtin busy for an unbounded time.
         """
+        if isinstance(value,(int,long,float)) and not isinstance(value,bool):
+            if self.max_eval_steps is not None:
+                return abs(value) <= self.max_eval_steps
+        elif isinstance(value,complex):
+            return self._is_small_arg(abs(value))
+        elif isinstance(value,(str,unicode,tuple,frozenset)):
+            if self.max_result_size is not None:
+                if len(value) > self.max_result_size:
+                    return False
+            if isinstance(value,(tuple,frozenset)):
+                for item in value:
+                    if not self._is_small_arg(item):
+                        return False
+        return True
+
+    def _get_inline_template(self,source_func):
+        """Get the inline template for the given pure function.
+
+        The template is the function's instruction list with line numbers
+        removed and each RETURN_VALUE replaced by a jump to a final label.
+        Returns from inside loops or try blocks, or with other values left on
+        the stack, first stash the return value in a local variable so that
+        the blocks and values can be popped.  Functions that can't be inlined
+        in this way (generators, closures, and those returning from inside a
+        finally or with block) have a template of None.
+
+        The template is cached on the function as '_promise_inline_template'
+        along with the code object it was built from, and is rebuilt if the
+        function's code object is replaced.
+        """
+        try:
+            (func_code,template) = source_func._promise_inline_template
+        except AttributeError:
+            pass
+        else:
+            if func_code is source_func.func_code:
+                return template
+        func_code = source_func.func_code
+        template = self._make_inline_template(Code.from_code(func_code))
+        source_func._promise_inline_template = (func_code,template)
+        return template
+
+    def _make_inline_template(self,c):
+        """Make the inline template for the given Code object.
+
+        See _get_inline_template() for details.
+        """
+        has_finally = False
+        for (op,arg) in c.code:
+            if op == YIELD_VALUE or op in hasfree:
+                return None
+            if op in (SETUP_FINALLY,SETUP_WITH):
+                has_finally = True
+        states = c._compute_stack_states()
+        retval = new_name("retval")
+        end = Label()
+        template = []
+        for (i,(op,arg)) in enumerate(c.code):
+            if op is SetLineno:
+                continue
+            if op == RETURN_VALUE:
+                curstack = states[i]
+                if curstack is not None and curstack != (1,):
+                    #  Finally blocks would have to be run before returning
+                    if len(curstack) > 1 and has_finally:
+                        return None
+                    #  Popping a block discards everything pushed inside it,
+                    #  so stash the return value while unwinding.
+                    template.append((STORE_FAST,retval))
+                    for _ in xrange(len(curstack)-1):
+                        template.append((POP_BLOCK,None))
+                    if len(curstack) > 1:
+                        npop = curstack[0]
+                    else:
+                        npop = curstack[0] - 1
+                    for _ in xrange(npop):
+                        template.append((POP_TOP,None))
+                    template.append((LOAD_FAST,retval))
+                template.append((JUMP_ABSOLUTE,end))
+                continue
+            #  Store inner code as immutable code objects, so that clones
+            #  can't share mutable Code objects.
+            if op == LOAD_CONST and isinstance(arg,Code):
+                arg = arg.to_code()
+            template.append((op,arg))
+        template.append((end,None))
+        return tuple(template)
+
+    def _make_inline_code(self,source_func,call):
+        """Make the instructions to inline source_func at a single callsite.
+
+        The generated code pops the argument values of the parsed call from
+        the stack and leaves the function's return value in their place.
+        It's a clone of the function's inline template, with fresh labels and
+        new unique names for all the local variables.  If the function can't
+        be inlined, or the arguments can't be bound to its parameters, None
+        is returned.
+        """
+        template = self._get_inline_template(source_func)
+        if template is None:
+            return None
+        func_code = source_func.func_code
         name_map = {}
-        for nm in code.to_code().co_varnames:
+        for nm in func_code.co_varnames:
             name_map[nm] = new_name(nm)
-        for (i,(op,arg)) in enumerate(code.code):
-            if op in (LOAD_FAST,STORE_FAST,DELETE_FAST):
+        code = self._bind_args(source_func,call,name_map)
+        if code is None:
+            return None
+        label_map = {}
+        def relabel(label):
+            try:
+                return label_map[label]
+            except KeyError:
+                newlabel = label_map[label] = Label()
+                return newlabel
+        #  Clone the template body
+        for (i,(op,arg)) in enumerate(template):
+            if isinstance(op,Label):
+                op = relabel(op)
+            elif op in hasjump:
+                arg = relabel(arg)
+            elif op in haslocal:
                 try:
-                    newarg = name_map[arg]
+                    arg = name_map[arg]
                 except KeyError:
-                    newarg = new_name(arg)
-                    name_map[arg] = newarg
-                code.code[i] = (op,newarg)
-        return name_map
+                    name_map[arg] = new_name(arg)
+                    arg = name_map[arg]
+            elif op == LOAD_CONST and isinstance(arg,pytypes.CodeType):
+                if template[i+1][0] in hascode:
+                    arg = Code.from_code(arg)
+            code.append((op,arg))
+        return code
+
+    def _bind_args(self,source_func,call,name_map):
+        """Make the instructions binding the arguments of a parsed call.
+
+        This statically matches the arguments of the call to the parameters
+        of source_func, in the same way as the interpreter would, and produces
+        code storing each argument value into the renamed local variable for
+        its parameter.  Values come from the stack, the constant *args tuple
+        or the function defaults.  If the arguments can't be bound (e.g. a
+        parameter is missing or given twice) then None is returned, so that
+        the call is left to raise the appropriate error at run-time.
+        """
+        (npos,kwnames,star,_,_) = call
+        func_code = source_func.func_code
+        numreqd = func_code.co_argcount
+        params = func_code.co_varnames[:numreqd]
+        defaults = source_func.func_defaults or ()
+        nextra = numreqd
+        varargs = varkwds = None
+        if func_code.co_flags & inspect.CO_VARARGS:
+            varargs = func_code.co_varnames[nextra]
+            nextra += 1
+        if func_code.co_flags & inspect.CO_VARKEYWORDS:
+            varkwds = func_code.co_varnames[nextra]
+        #  Match up positional arguments
+        if npos + len(star) > numreqd and varargs is None:
+            return None
+        bound = set(params[:npos+len(star)])
+        for name in kwnames:
+            if name in params:
+                if name in bound:
+                    return None
+                bound.add(name)
+            elif varkwds is None or kwnames.count(name) > 1:
+                return None
+        for (i,name) in enumerate(params):
+            if name not in bound and i < numreqd - len(defaults):
+                return None
+        code = []
+        if varkwds is not None:
+            code.append((BUILD_MAP,0))
+            code.append((STORE_FAST,name_map[varkwds]))
+        #  Pop the keyword arguments from the stack
+        for name in reversed(kwnames):
+            if name in params:
+                code.append((STORE_FAST,name_map[name]))
+            else:
+                code.append((LOAD_FAST,name_map[varkwds]))
+                code.append((LOAD_CONST,name))
+                code.append((STORE_SUBSCR,None))
+        #  Collect any excess positional arguments into a tuple
+        if varargs is not None:
+            if npos > numreqd:
+                for value in star:
+                    code.append((LOAD_CONST,value))
+                code.append((BUILD_TUPLE,npos - numreqd + len(star)))
+            else:
+                code.append((LOAD_CONST,star[numreqd-npos:]))
+            code.append((STORE_FAST,name_map[varargs]))
+        #  Pop the positional arguments from the stack
+        for i in reversed(xrange(min(npos,numreqd))):
+            code.append((STORE_FAST,name_map[params[i]]))
+        #  Fill in positional arguments from *args, then defaults
+        for (i,value) in enumerate(star[:max(numreqd-npos,0)]):
+            code.append((LOAD_CONST,value))
+            code.append((STORE_FAST,name_map[params[npos+i]]))
+        for (i,name) in enumerate(params):
+            if name not in bound:
+                defval = defaults[i - numreqd + len(defaults)]
+                code.append((LOAD_CONST,defval))
+                code.append((STORE_FAST,name_map[name]))
+        return code
+
+    def _find_inlinable_calls(self,func,code):
+        """Find all inlinable calls to func in the given code.
+
+        Returns a list of tuples (loadsite,callsite) giving the position of
+        each LOAD_CONST of the function and its matching call.
+        """
+        calls = []
+        for loadsite in code.find(LOAD_CONST,func):
+            callsite = self._find_callsite(loadsite,code.code)
+            if callsite is not None:
+                calls.append((loadsite,callsite))
+        return calls
+
+    def _find_callsite(self,idx,code):
+        """Find index of the opcode calling the value pushed at opcode idx."""
+        return _find_callsite(idx,code)
+
+
+def _find_callsite(idx,code):
+    """Find index of the opcode calling the value pushed at opcode idx.
+
+    This function finds the position of the opcode that calls a function
+    pushed onto the stack by opcode 'idx'.  If we cannot reliably find
+    such an opcode (due to weird branching etc) then None is returned.
+    """
+    try:
+        callsite = idx
+        curstack = 0
+        curop = None
+        while curstack > 0 or curop not in _call_ops:
+            callsite += 1
+            try:
+                (curop,curarg) = code[callsite]
+            except IndexError:
+                return None
+            if curop is SetLineno:
+                continue
+            (pop,push) = getse(curop,curarg)
+            curstack = curstack + push - pop
+        if curstack == 0:
+            return callsite
+        else:
+            return None
+    except ValueError:
+        return None
+
+
+def inline_report(func):
+    """Report on the inlining of pure functions into the given function.
+
+    The result is a list of tuples (lineno,name,action,reason), one for each
+    callsite of a pure function that was considered for inlining.  The action
+    is one of "inlined", "evaluated" or "skipped"; for skipped callsites the
+    reason explains why.  Nothing is reported for code loaded from the
+    on-disk cache.
+    """
+    return list(func.__dict__.get("_promise_inline_report",()))
+
+
+class final(pure):
+    """Promise that a method is final, i.e. not overridden in subclasses.
+
+    Mark methods with this promise, and then apply it to the class itself:
+
+        class Service(object):
+            @promise.final()
+            def _key(self,x):
+                return (self.prefix,x)
+            def lookup(self,x):
+                return self.data[self._key(x)]
+        promise.final()(Service)
+
+    Calls like self._key(x) in the methods of the class then call the final
+    method's function directly rather than looking up a bound method, and the
+    function is inlined in the same way as a pure function (subject to the
+    same limits, which can be given when marking the method).  Unlike pure
+    functions, calls are never evaluated at transformation time.
+
+    The promise is checked rather than trusted:  BrokenPromiseError is raised
+    if the class or any of its existing subclasses overrides a final method,
+    or if a method assigns to it.  Subclasses defined later are checked the
+    first time an instance of them is used in one of the transformed methods.
+    Assigning a final method on an individual instance also breaks the
+    promise, but isn't detected.
+    """
+
+    def __init__(self,max_inline_size=100,max_growth=5000,max_inline_depth=3):
+        super(final,self).__init__(max_inline_size=max_inline_size,
+                                   max_growth=max_growth,
+                                   max_inline_depth=max_inline_depth)
+
+    def __call__(self,*args):
+        if not args:
+            return None
+        for arg in args:
+            if isinstance(arg,(type,pytypes.ClassType)):
+                self._decorate_class(arg)
+            else:
+                super(final,self).__call__(arg)
+        return args[0]
+
+    def decorate(self,func):
+        func._promise_final = True
+        func._promise_fold_constant = self._make_fold_method(func)
+
+    def _make_fold_method(self,source_func):
+        """Make _promise_fold_constant method for the given final method."""
+        fold = super(final,self)._make_fold_method(source_func)
+        def final_fold(dest_func,dest_code,state=None):
+            #  The inlined code looks up globals in dest_func's namespace
+            if dest_func.func_globals is not source_func.func_globals:
+                return False
+            return fold(dest_func,dest_code,state)
+        return final_fold
+
+    def _decorate_class(self,cls):
+        """Arrange for calls to final methods in cls to be inlined."""
+        finals = _FinalMethods(cls)
+        if not finals.methods:
+            return
+        for subcls in finals.find_subclasses():
+            finals.check(subcls)
+        #  Transform the final methods first, so that their calls to other
+        #  final methods are also inlined into their callers.
+        funcs = [f for f in cls.__dict__.itervalues()
+                   if isinstance(f,pytypes.FunctionType)]
+        funcs.sort(key=lambda f: (not _is_final(f),f.__name__))
+        for func in funcs:
+            func._promise_final_class = finals
+            self.apply_or_defer(func)
+
+    def apply(self,func,code):
+        finals = func._promise_final_class
+        if len(code.args) - code.varargs - code.varkwargs < 1:
+            return
+        selfname = code.args[0]
+        code_list = code.code
+        #  Quick check that self and the final methods aren't munged
+        for (i,(op,arg)) in enumerate(code_list):
+            if op in (STORE_FAST,DELETE_FAST) and arg == selfname:
+                return
+            if op in (STORE_ATTR,DELETE_ATTR) and arg in finals.methods:
+                if i > 0 and code_list[i-1] == (LOAD_FAST,selfname):
+                    msg = "method '%s' was promised final, but assigned to"
+                    raise BrokenPromiseError(msg % (arg,))
+        #  Turn calls of bound final methods into calls of their functions,
+        #  passing self as an extra positional argument.
+        changed = False
+        for i in xrange(len(code_list)-1):
+            if code_list[i] != (LOAD_FAST,selfname):
+                continue
+            (op,arg) = code_list[i+1]
+            if op != LOAD_ATTR or arg not in finals.methods:
+                continue
+            callsite = self._find_callsite(i+1,code_list)
+            if callsite is None:
+                continue
+            (callop,callarg) = code_list[callsite]
+            if callarg & 0xFF == 0xFF:
+                continue
+            code_list[i] = (LOAD_CONST,finals.methods[arg])
+            code_list[i+1] = (LOAD_FAST,selfname)
+            code_list[callsite] = (callop,callarg+1)
+            changed = True
+        if not changed:
+            return
+        #  Check the class of self before using the final methods.  Classes
+        #  known not to override them are remembered in a set.
+        ok = Label()
+        code_list[0:0] = [(LOAD_FAST,selfname),
+                          (LOAD_ATTR,"__class__"),
+                          (LOAD_CONST,finals.verified),
+                          (COMPARE_OP,"in"),
+                          (POP_JUMP_IF_TRUE,ok),
+                          (LOAD_CONST,finals),
+                          (LOAD_FAST,selfname),
+                          (CALL_FUNCTION,1),
+                          (POP_TOP,None),
+                          (ok,None)]
+        _fold_constants(func,code)
+        #  Final methods inlined into this one bring their own checks along,
+        #  but they're on the same object so only the first one is needed.
+        code_list = code.code
+        i = 1
+        while i < len(code_list) - 9:
+            (op,arg) = code_list[i+2]
+            if op == LOAD_CONST and arg is finals.verified:
+                if isinstance(code_list[i+9][0],Label):
+                    del code_list[i:i+10]
+                    continue
+            i += 1
+
+    def _find_constant_args(self,code,call):
+        #  Final methods needn't be pure, so calls can't be evaluated early.
+        return None
+
+
+def _is_final(obj):
+    """Check whether the given object is a method promised final."""
+    return isinstance(obj,pytypes.FunctionType) and \
+           getattr(obj,"_promise_final",False)
+
+
+class _FinalMethods(object):
+    """The final methods of a class, and the classes using them correctly.
+
+    The attribute 'methods' maps names to functions promised final in the
+    class or its bases, and 'verified' is the set of classes known not to
+    override any of them.  Calling this object with an instance checks its
+    class, raising BrokenPromiseError if it overrides a final method.
+    """
+
+    def __init__(self,cls):
+        self.cls = cls
+        self.methods = {}
+        #  Find the final methods, checking that cls doesn't override any
+        #  promised final in one of its bases.
+        resolved = {}
+        for klass in inspect.getmro(cls):
+            for (nm,val) in klass.__dict__.iteritems():
+                if nm not in resolved:
+                    resolved[nm] = (val,klass)
+                elif _is_final(val) and resolved[nm][0] is not val:
+                    self._broken(nm,klass,resolved[nm][1])
+        for (nm,(val,klass)) in resolved.iteritems():
+            if _is_final(val):
+                self.methods[nm] = val
+        self.verified = set([cls])
+
+    def __call__(self,obj):
+        self.check(obj.__class__)
+
+    def _broken(self,nm,klass,subcls):
+        msg = "method '%s' of %s was promised final, but overridden in %s"
+        raise BrokenPromiseError(msg % (nm,klass.__name__,subcls.__name__))
+
+    def find_subclasses(self):
+        """Find all the currently-defined subclasses of the class."""
+        subclasses = []
+        todo = [self.cls]
+        while todo:
+            klass = todo.pop()
+            try:
+                todo.extend(klass.__subclasses__())
+            except AttributeError:
+                #  Old-style classes don't keep track of their subclasses
+                continue
+            subclasses.append(klass)
+        return subclasses[1:]
+
+    def check(self,klass):
+        """Check that the given class doesn't override any final methods."""
+        if klass in self.verified:
+            return
+        if not issubclass(klass,self.cls):
+            msg = "final methods of %s used on an instance of %s"
+            raise BrokenPromiseError(msg % (self.cls.__name__,klass.__name__))
+        mro = inspect.getmro(klass)
+        for (nm,val) in self.methods.iteritems():
+            for base in mro:
+                if nm in base.__dict__:
+                    if base.__dict__[nm] is not val:
+                        owner = [b for b in mro if b.__dict__.get(nm) is val]
+                        self._broken(nm,owner[0],base)
+                    break
+        self.verified.add(klass)
+
+
+#  Builtin types whose instances can't also be instances of one of the others,
+#  since no class can inherit from more than one of them.
+_solid_types = set([int,long,float,complex,str,unicode,tuple,list,dict,
+                    set,frozenset,bytearray])
+
+#  Type of methods of builtin types, e.g. list.append
+_method_descriptor = type(list.append)
+
+class types(Promise):
+    """Promise that the arguments of a function have the given types.
+
+        @promise.types(items=list,scale=float)
+        def scale_all(items,scale):
+            ...
+
+    Each argument is promised to be an instance of the given class (or of a
+    tuple of classes), and not to override the methods that the function calls
+    on it, either in a subclass or on the instance itself.  Arguments that are
+    assigned to in the function are left alone.  The promise allows these
+    optimisations:
+
+        * methods defined in Python are called as plain functions instead of
+          creating a bound method, and final() and pure() methods called in
+          this way are inlined.
+        * methods of builtin types, e.g. list.append, that are called inside
+          a loop or more than once are looked up once on entry.
+        * calls to isinstance() on the arguments are replaced by their result
+          where it follows from the promised types.  This needs isinstance
+          and the classes to be constants already, so the names must be
+          covered by e.g. a constant() promise below this one.
+
+    If promise.types.debug is true when the promise is applied, the types of
+    the arguments are checked on entry and BrokenPromiseError is raised if
+    they don't match.
+    """
+
+    debug = False
+
+    def __init__(self,**signature):
+        self.signature = signature
+        super(types,self).__init__()
+
+    def decorate(self,func):
+        (args,varargs,varkw) = inspect.getargs(func.func_code)
+        for nm in self.signature:
+            if nm not in args:
+                msg = "'%s' is not an argument of %s"
+                raise TypeError(msg % (nm,func.__name__))
+        self.apply_or_defer(func)
+
+    def cache_key(self,func):
+        #  Methods looked up on the declared classes get inlined into the
+        #  code, so their own code must be part of the key as well.
+        attrs = sorted(cache.code_names(func.func_code))
+        signature = []
+        for (nm,classes) in sorted(self.signature.iteritems()):
+            if not isinstance(classes,tuple):
+                classes = (classes,)
+            names = tuple(tuple("%s.%s" % (k.__module__,k.__name__)
+                                for k in inspect.getmro(c)) for c in classes)
+            methods = []
+            for attr in attrs:
+                method = _lookup_method(classes,attr)
+                if isinstance(method,pytypes.FunctionType):
+                    code = (method.func_code,method.func_defaults)
+                    methods.append((attr,cache.fingerprint(code)))
+            signature.append((nm,names,tuple(methods)))
+        return ("types",tuple(signature),bool(self.debug))
+
+    def apply(self,func,code):
+        code_list = code.code
+        assigned = set(arg for (op,arg) in code_list
+                           if op in (STORE_FAST,DELETE_FAST))
+        signature = dict((nm,c) for (nm,c) in self.signature.iteritems()
+                                if nm not in assigned)
+        self._call_methods(signature,code_list)
+        prologue = self._hoist_methods(signature,code)
+        self._eliminate_isinstance(signature,code)
+        if self.debug:
+            prologue[0:0] = self._check_signature()
+        code_list = code.code
+        i = 0
+        while i < len(code_list) and code_list[i][0] is SetLineno:
+            i += 1
+        code_list[i:i] = prologue
+        _fold_constants(func,code)
+
+    def _call_methods(self,signature,code_list):
+        """Turn calls of Python methods into calls of their functions."""
+        for i in xrange(len(code_list)-1):
+            (op,nm) = code_list[i]
+            if op != LOAD_FAST or nm not in signature:
+                continue
+            (op,attr) = code_list[i+1]
+            if op != LOAD_ATTR:
+                continue
+            method = _lookup_method(signature[nm],attr)
+            if not isinstance(method,pytypes.FunctionType):
+                continue
+            callsite = _find_callsite(i+1,code_list)
+            if callsite is None:
+                continue
+            (callop,callarg) = code_list[callsite]
+            if callarg & 0xFF == 0xFF:
+                continue
+            code_list[i] = (LOAD_CONST,method)
+            code_list[i+1] = (LOAD_FAST,nm)
+            code_list[callsite] = (callop,callarg+1)
+
+    def _hoist_methods(self,signature,code):
+        """Look up builtin methods used repeatedly once, on entry.
+
+        Returns the code to add on entry; the lookups themselves are replaced
+        in-place by loads of a local variable.
+        """
+        code_list = code.code
+        positions = {}
+        for (i,(op,arg)) in enumerate(code_list):
+            if isinstance(op,Label):
+                positions[op] = i
+        loops = [(positions[arg],i) for (i,(op,arg)) in enumerate(code_list)
+                                    if op in hasjump and positions[arg] < i]
+        uses = {}
+        for i in xrange(len(code_list)-1):
+            (op,nm) = code_list[i]
+            if op != LOAD_FAST or nm not in signature:
+                continue
+            (op,attr) = code_list[i+1]
+            if op != LOAD_ATTR:
+                continue
+            method = _lookup_method(signature[nm],attr)
+            if isinstance(method,_method_descriptor):
+                uses.setdefault((nm,attr),[]).append(i)
+        prologue = []
+        new_code = list(code_list)
+        for ((nm,attr),sites) in sorted(uses.iteritems()):
+            if len(sites) == 1:
+                i = sites[0]
+                if not [s for (s,e) in loops if s <= i <= e]:
+                    continue
+            local = new_name("%s_%s" % (nm,attr))
+            prologue.extend([(LOAD_FAST,nm),
+                             (LOAD_ATTR,attr),
+                             (STORE_FAST,local)])
+            for i in sites:
+                new_code[i] = (LOAD_FAST,local)
+                new_code[i+1] = None
+        code_list[:] = [c for c in new_code if c is not None]
+        return prologue
+
+    def _eliminate_isinstance(self,signature,code):
+        """Replace calls of isinstance() on arguments with a known result.
+
+        Only calls where isinstance and the classes are already constants
+        are replaced; names that might be shadowed or monkeypatched are left
+        alone unless another promise has made them constant.
+        """
+        code_list = code.code
+        def load_const(i):
+            (op,arg) = code_list[i]
+            if op == LOAD_CONST:
+                return arg
+            return None
+        new_code = []
+        i = 0
+        while i < len(code_list):
+            if i + 3 < len(code_list) and load_const(i) is isinstance:
+                (op,nm) = code_list[i+1]
+                if op == LOAD_FAST and nm in signature:
+                    if code_list[i+3] == (CALL_FUNCTION,2):
+                        X = load_const(i+2)
+                        result = _known_isinstance(signature[nm],X)
+                        if result is not None:
+                            new_code.append((LOAD_CONST,result))
+                            i += 4
+                            continue
+            new_code.append(code_list[i])
+            i += 1
+        code_list[:] = new_code
+
+    def _check_signature(self):
+        """Get code checking the types of the arguments on entry."""
+        code = []
+        for (nm,classes) in sorted(self.signature.iteritems()):
+            ok = Label()
+            code.extend([(LOAD_CONST,isinstance),
+                         (LOAD_FAST,nm),
+                         (LOAD_CONST,classes),
+                         (CALL_FUNCTION,2),
+                         (POP_JUMP_IF_TRUE,ok),
+                         (LOAD_CONST,_broken_signature),
+                         (LOAD_CONST,nm),
+                         (LOAD_CONST,classes),
+                         (LOAD_FAST,nm),
+                         (CALL_FUNCTION,3),
+                         (POP_TOP,None),
+                         (ok,None)])
+        return code
+
+
+def _lookup_method(classes,attr):
+    """Find the raw value of a method of the given class.
+
+    None is returned if there's a tuple of classes, or the attribute isn't
+    found in the class dicts.
+    """
+    if isinstance(classes,tuple):
+        if len(classes) != 1:
+            return None
+        classes = classes[0]
+    for klass in inspect.getmro(classes):
+        try:
+            return klass.__dict__[attr]
+        except KeyError:
+            pass
+    return None
+
+
+def _known_isinstance(classes,X):
+    """Get the result of isinstance() for instances of the given classes.
+
+    None is returned if the result isn't known in advance.
+    """
+    if not isinstance(classes,tuple):
+        classes = (classes,)
+    if not isinstance(X,tuple):
+        X = (X,)
+    for x in X:
+        if not isinstance(x,(type,pytypes.ClassType)):
+            return None
+    results = set()
+    for c in classes:
+        if issubclass(c,X):
+            results.add(True)
+        elif c in _solid_types and all(x in _solid_types for x in X):
+            results.add(False)
+        else:
+            return None
+    if len(results) != 1:
+        return None
+    return results.pop()
+
+
+def _broken_signature(nm,classes,value):
+    """Raise BrokenPromiseError for an argument of the wrong type."""
+    if not isinstance(classes,tuple):
+        classes = (classes,)
+    names = " or ".join(c.__name__ for c in classes)
+    msg = "argument '%s' was promised to be %s, but got %s"
+    raise BrokenPromiseError(msg % (nm,names,type(value).__name__))
+
+
+class _MemoTable(object):
+    """Table of remembered results for a function promised by memoize().
+
+    Each entry maps a tuple of argument values to a list [value,score,key],
+    where 'score' is used to pick entries for eviction:  the time of last use
+    for the "lru" policy, or the number of uses for the "lfu" policy.  Hits
+    are handled entirely by the code injected into the function, which reads
+    'data' and updates the score directly; only misses call back into
+    Python-level methods of this class.
+
+    Hits are counted by advancing 'counter'.  For the "lru" policy it also
+    serves as the clock giving the time of last use, so it's advanced by
+    misses as well.
+
+    Candidates for eviction are kept in 'heap' as tuples (score,seq,entry).
+    Since hits update scores without telling us, the score in the heap may
+    be out of date; but scores only ever increase, so when the entry with the
+    lowest score in the heap turns out to have been used since, it's simply
+    pushed back with its current score.  Eviction thus takes O(log n) time
+    amortized over the hits.
+    """
+
+    def __init__(self,maxsize,policy):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.data = {}
+        self.heap = []
+        self.seq = itertools.count()
+        self.misses = 0
+        self.counter = itertools.count()
+        self.counter_base = 0
+        self.lock = threading.Lock()
+
+    def store(self,key,value):
+        """Remember the result for the given key, returning the value.
+
+        If the table is full, the entry with the lowest score is evicted.
+        Unhashable keys are silently ignored.
+        """
+        self.lock.acquire()
+        try:
+            self.misses += 1
+            if self.policy == "lru":
+                score = self.counter.next()
+            else:
+                score = 0
+            try:
+                if key in self.data:
+                    return value
+                if self.maxsize is not None:
+                    while len(self.data) >= self.maxsize:
+                        self._evict()
+                entry = [value,score,key]
+                self.data[key] = entry
+                heapq.heappush(self.heap,(score,self.seq.next(),entry))
+            except TypeError:
+                pass
+            return value
+        finally:
+            self.lock.release()
+
+    def _evict(self):
+        """Evict the entry with the lowest score."""
+        while True:
+            (score,_,entry) = heapq.heappop(self.heap)
+            if entry[1] == score:
+                del self.data[entry[2]]
+                return
+            #  Used since it was pushed, so try again with its current score
+            heapq.heappush(self.heap,(entry[1],self.seq.next(),entry))
+
+    def stats(self):
+        """Get a dict of statistics about use of this table."""
+        hits = self._read_counter() - self.counter_base
+        if self.policy == "lru":
+            hits -= self.misses
+        return {"hits": hits, "misses": self.misses, "size": len(self.data),
+                "maxsize": self.maxsize, "policy": self.policy}
+
+    def clear(self):
+        """Forget all remembered results and reset the statistics."""
+        self.lock.acquire()
+        try:
+            self.data.clear()
+            del self.heap[:]
+            self.misses = 0
+            self.counter_base = self._read_counter()
+        finally:
+            self.lock.release()
+
+    def _read_counter(self):
+        """Read the counter without advancing it.
+
+        The injected code holds a reference to the counter, so it can't be
+        replaced; copying it lets us read its value instead.
+        """
+        return copy.copy(self.counter).next()
+
+
+class memoize(Promise):
+    """Promise that a function is pure and its results may be remembered.
+
+    Like pure(), this promises that the function is a simple mapping from
+    inputs to outputs.  Rather than making the function inlinable, it arranges
+    for its results to be remembered in a table keyed by the argument values,
+    which is worthwhile for expensive functions that are called repeatedly
+    with the same arguments:
+
+        @promise.memoize(maxsize=1000)
+        def fib(n):
+            if n < 2:
+                return n
+            return fib(n-1) + fib(n-2)
+
+    The table lookup is injected directly into the function's bytecode, so no
+    wrapper function is created.  At most 'maxsize' results are remembered
+    (or any number if it's None), and when the table is full an entry is
+    evicted according to 'policy':  "lru" for the least recently used, or
+    "lfu" for the least frequently used.  Calls with unhashable arguments
+    are not remembered.
+
+    Hit and miss statistics can be obtained by calling promise.memo_stats(),
+    and the table can be emptied by calling promise.memo_clear().
+    """
+
+    def __init__(self,maxsize=128,policy="lru"):
+        if maxsize is not None and maxsize < 1:
+            raise ValueError("maxsize must be positive or None")
+        if policy not in ("lru","lfu"):
+            raise ValueError("unknown memoize policy: %r" % (policy,))
+        self.maxsize = maxsize
+        self.policy = policy
+        super(memoize,self).__init__()
+
+    def decorate(self,func):
+        c = Code.from_code(func.func_code,compact=True)
+        if c.varkwargs:
+            raise TypeError("memoized functions currently don't support varkwds")
+        if YIELD_VALUE in c.code.opcodes:
+            raise TypeError("generators can't be memoized")
+        #  Since I'm pure, my globals must all be constant
+        constant(_find_pure_globals(c)).decorate(func)
+        func._promise_memo = _MemoTable(self.maxsize,self.policy)
+        self.apply_or_defer(func)
+
+    def apply(self,func,code):
+        table = func._promise_memo
+        key = new_name("memo_key")
+        entry = new_name("memo_entry")
+        #  Remember the result before each return
+        new_code = []
+        for (op,arg) in code.code:
+            if op == RETURN_VALUE:
+                new_code.append((LOAD_CONST,table.store))
+                new_code.append((ROT_TWO,None))
+                new_code.append((LOAD_FAST,key))
+                new_code.append((ROT_TWO,None))
+                new_code.append((CALL_FUNCTION,2))
+            new_code.append((op,arg))
+        #  Look up the arguments in the table.  Unhashable arguments
+        #  raise TypeError, which is treated as a miss.
+        (handler,reraise,found,miss) = (Label(),Label(),Label(),Label())
+        prologue = [(SETUP_EXCEPT,handler),(LOAD_CONST,table.data.get)]
+        for argname in code.args:
+            prologue.append((LOAD_FAST,argname))
+        prologue.extend([(BUILD_TUPLE,len(code.args)),
+                         (DUP_TOP,None),
+                         (STORE_FAST,key),
+                         (CALL_FUNCTION,1),
+                         (STORE_FAST,entry),
+                         (POP_BLOCK,None),
+                         (JUMP_FORWARD,found),
+                         (handler,None),
+                         (DUP_TOP,None),
+                         (LOAD_CONST,TypeError),
+                         (COMPARE_OP,"exception match"),
+                         (POP_JUMP_IF_FALSE,reraise),
+                         (POP_TOP,None),
+                         (POP_TOP,None),
+                         (POP_TOP,None),
+                         (LOAD_CONST,None),
+                         (STORE_FAST,entry),
+                         (JUMP_FORWARD,found),
+                         (reraise,None),
+                         (END_FINALLY,None),
+                         (found,None),
+                         (LOAD_FAST,entry),
+                         (LOAD_CONST,None),
+                         (COMPARE_OP,"is"),
+                         (POP_JUMP_IF_TRUE,miss),
+                         (LOAD_FAST,entry)])
+        #  On a hit, count it, update the entry's score and return its value
+        if self.policy == "lru":
+            prologue.extend([(DUP_TOP,None),
+                             (LOAD_CONST,table.counter.next),
+                             (CALL_FUNCTION,0),
+                             (ROT_TWO,None),
+                             (LOAD_CONST,1),
+                             (STORE_SUBSCR,None)])
+        else:
+            prologue.extend([(LOAD_CONST,table.counter.next),
+                             (CALL_FUNCTION,0),
+                             (POP_TOP,None),
+                             (DUP_TOP,None),
+                             (LOAD_CONST,1),
+                             (DUP_TOPX,2),
+                             (BINARY_SUBSCR,None),
+                             (LOAD_CONST,1),
+                             (INPLACE_ADD,None),
+                             (ROT_THREE,None),
+                             (STORE_SUBSCR,None)])
+        prologue.extend([(LOAD_CONST,0),
+                         (BINARY_SUBSCR,None),
+                         (RETURN_VALUE,None),
+                         (miss,None)])
+        code.code[:] = prologue + new_code
+
+
+def memo_stats(func):
+    """Get hit/miss statistics for a function promised by memoize().
+
+    The result is a dict with keys "hits", "misses", "size", "maxsize" and
+    "policy".
+    """
+    try:
+        table = func._promise_memo
+    except AttributeError:
+        raise TypeError("function is not memoized: %r" % (func,))
+    return table.stats()
+
+
+def memo_clear(func):
+    """Forget all remembered results of a function promised by memoize()."""
+    try:
+        table = func._promise_memo
+    except AttributeError:
+        raise TypeError("function is not memoized: %r" % (func,))
+    table.clear()
+
+
+class optimize(Promise):
+    """Promise that a function's bytecode may be optimised.
+
+    This promise runs a peephole optimiser over the function's bytecode,
+    cleaning up after the other promises: operations on constants are folded,
+    redundant jumps and dead code are removed, and values that are stored in
+    a local variable only to be loaded again straight away are left on the
+    stack.  See the promise.peephole module for details.
+
+    Since decorators are applied from the bottom up, it should be placed above
+    any other promises so that it sees their transformed code:
+
+        SCALE = 10
+
+        @promise.optimize()
+        @promise.constant(["SCALE","calculate"])
+        def aggregate(items):
+            return sum(SCALE * SCALE * calculate(i) for i in items)
+
+    The only things this promises are that the function doesn't inspect its
+    own local variables through frame objects, and that any operations on
+    simple constants (numbers, strings and tuples) can be evaluated early.
+    """
+
+    def decorate(self,func):
+        self.apply_or_defer(func)
+
+    def cache_key(self,func):
+        return ("optimize",)
+
+    def apply(self,func,code):
+        peephole.optimize_code(code)
+
+
+#  Builtin functions that are pure, and so can be hoisted out of loops.
+_pure_builtins = set([abs,len,min,max,ord,chr,divmod,round,repr,hash,
+                      isinstance,issubclass])
+
+#  Opcodes computing a value from the values they pop, without side-effects
+#  as far as hoist() is concerned.
+_hoistable_ops = set(peephole._binary_ops) | set(peephole._unary_ops) | \
+                 set([LOAD_ATTR,BUILD_TUPLE,COMPARE_OP])
+
+#  Opcodes assigning to or deleting items of a container.
+_item_store_ops = set([STORE_SUBSCR,DELETE_SUBSCR,
+                       STORE_SLICE_0,STORE_SLICE_1,STORE_SLICE_2,STORE_SLICE_3,
+                       DELETE_SLICE_0,DELETE_SLICE_1,DELETE_SLICE_2,
+                       DELETE_SLICE_3])
+
+#  Opcodes setting up blocks that handle exceptions raised within them.
+_handler_setup_ops = set([SETUP_EXCEPT,SETUP_FINALLY,SETUP_WITH])
+
+
+class hoist(Promise):
+    """Promise that pure expressions in loops can be evaluated before them.
+
+    This promise moves subexpressions that have the same value on every
+    iteration of a loop out of the loop, storing their value in a local
+    variable before it starts.  Instead of doing this:
+
+        def count(items,d):
+            n = len(items)
+            get = d.get
+            for x in items:
+                if get(x,0) < n:
+                    ...
+
+    You can now do this:
+
+        @promise.hoist()
+        def count(items,d):
+            for x in items:
+                if d.get(x,0) < len(items):
+                    ...
+
+    An expression is hoisted if it's built only from constants and local
+    variables that aren't assigned to in the loop, using attribute lookups,
+    operators, and calls to pure functions and pure builtins such as len().
+    Since other promises turn the names they cover into constants and local
+    variables, this is best placed above them, e.g. on top of sensible().
+
+    The promise is that these expressions really do have the same value each
+    time round the loop, i.e. that the loop doesn't modify the objects they
+    look at, and that they can be evaluated early without raising an error
+    even if the loop body wouldn't have run them.  As a simple check,
+    expressions looking up an attribute or item are not hoisted from loops
+    that assign to an attribute of that name or to any item.  Loops whose
+    body contains a try or with statement are left alone, since hoisting an
+    expression out of it would move any error it raises out of its handler.
+    """
+
+    def decorate(self,func):
+        self.apply_or_defer(func)
+
+    def cache_key(self,func):
+        return ("hoist",)
+
+    def apply(self,func,code):
+        code_list = code.code
+        for (op,arg) in code_list:
+            if op in peephole._namespace_ops:
+                return
+        #  Outer loops are done first, so that expressions invariant in an
+        #  outer loop are hoisted all the way out of it.  The loops are found
+        #  afresh each time, since hoisting moves them around.
+        n = 0
+        while True:
+            loops = self._find_loops(code_list)
+            if n >= len(loops):
+                break
+            (setup,head,end) = loops[n]
+            self._hoist_loop(code_list,setup,head,end)
+            n += 1
+
+    def _find_loops(self,code_list):
+        """Find the loops in the given code, outermost first.
+
+        Returns a list of tuples (setup,head,end) giving the positions of the
+        SETUP_LOOP opcode, the first instruction executed on each iteration
+        and the end of the loop block.  Loops without a backward jump to their
+        head are skipped.
+        """
+        positions = {}
+        for (i,(op,arg)) in enumerate(code_list):
+            if isinstance(op,Label):
+                positions[op] = i
+        loops = []
+        for (i,(op,arg)) in enumerate(code_list):
+            if op != SETUP_LOOP:
+                continue
+            end = positions[arg]
+            heads = [positions[a] for (j,(o,a)) in enumerate(code_list[i:end])
+                                  if o in hasjump and i < positions[a] < i+j]
+            if heads:
+                loops.append((i,min(heads),end))
+        return loops
+
+    def _hoist_loop(self,code_list,setup,head,end):
+        """Hoist invariant expressions out of the loop at the given position."""
+        body = code_list[head:end]
+        for (op,arg) in body:
+            if op in _handler_setup_ops:
+                return
+        assigned = set()
+        stored_attrs = set()
+        stores_items = False
+        for (op,arg) in body:
+            if op in (STORE_FAST,DELETE_FAST):
+                assigned.add(arg)
+            elif op in (STORE_ATTR,DELETE_ATTR):
+                stored_attrs.add(arg)
+            elif op in _item_store_ops:
+                stores_items = True
+        def hoistable(start,stop):
+            for (op,arg) in body[start:stop]:
+                if op == LOAD_ATTR and arg in stored_attrs:
+                    return False
+                if op == BINARY_SUBSCR and stores_items:
+                    return False
+            return stop - start > 1
+        spans = self._find_invariants(body,assigned,hoistable)
+        if not spans:
+            return
+        hoisted = {}
+        prologue = []
+        new_body = []
+        i = 0
+        for (start,stop) in spans:
+            new_body.extend(body[i:start])
+            expr = body[start:stop]
+            key = tuple((op,id(arg)) if op == LOAD_CONST else (op,arg)
+                        for (op,arg) in expr)
+            if key not in hoisted:
+                hoisted[key] = new_name("hoisted")
+                prologue.extend(expr)
+                prologue.append((STORE_FAST,hoisted[key]))
+            new_body.append((LOAD_FAST,hoisted[key]))
+            i = stop
+        new_body.extend(body[i:])
+        code_list[head:end] = new_body
+        code_list[setup:setup] = prologue
+
+    def _find_invariants(self,body,assigned,hoistable):
+        """Find the maximal invariant expressions in the given loop body.
+
+        The stack is simulated through each run of straight-line code, with
+        each entry either None or the span (start,stop) of the instructions
+        computing an invariant value.  When an invariant value is consumed by
+        anything else, its span is collected if hoistable(start,stop) says so.
+        Returns a list of non-overlapping spans, in order.
+        """
+        spans = []
+        stack = []
+        def collect(entries):
+            for entry in entries:
+                if entry is not None and hoistable(*entry):
+                    spans.append(entry)
+        for (i,(op,arg)) in enumerate(body):
+            if op == LOAD_CONST:
+                stack.append((i,i+1))
+                continue
+            if op == LOAD_FAST and arg not in assigned:
+                stack.append((i,i+1))
+                continue
+            npop = None
+            if op in _hoistable_ops:
+                if op == BUILD_TUPLE:
+                    npop = arg
+                else:
+                    npop = getse(op,arg)[0]
+            elif op == CALL_FUNCTION and arg < 0x100:
+                npop = arg + 1
+            if npop is not None and len(stack) >= npop:
+                args = stack[len(stack)-npop:]
+                if self._is_invariant(body,op,args,i):
+                    del stack[len(stack)-npop:]
+                    stack.append((args[0][0] if args else i,i+1))
+                    continue
+            #  Anything else consumes its arguments as an unknown operation
+            if isinstance(op,Label) or op is SetLineno:
+                collect(stack)
+                stack = []
+                continue
+            try:
+                (pop,push) = getse(op,arg)
+            except ValueError:
+                collect(stack)
+                stack = []
+                continue
+            if op in hasjump:
+                collect(stack)
+                stack = []
+                continue
+            pop = min(pop,len(stack))
+            collect(stack[len(stack)-pop:])
+            del stack[len(stack)-pop:]
+            stack.extend([None] * push)
+        collect(stack)
+        return sorted(spans)
+
+    def _is_invariant(self,body,op,args,i):
+        """Check whether op computes an invariant value from the given args."""
+        stop = i
+        for entry in reversed(args):
+            if entry is None or entry[1] != stop:
+                return False
+            stop = entry[0]
+        if op == CALL_FUNCTION:
+            (funcop,funcarg) = body[args[0][0]]
+            if args[0][1] - args[0][0] != 1 or funcop != LOAD_CONST:
+                return False
+            return _is_pure(funcarg)
+        return True
+
+
+def _is_pure(obj):
+    """Check whether the given object is a function known to be pure."""
+    if isinstance(obj,pytypes.FunctionType):
+        if hasattr(obj,"_promise_memo"):
+            return True
+        return hasattr(obj,"_promise_fold_constant") and not _is_final(obj)
+    try:
+        return obj in _pure_builtins
+    except TypeError:
+        return False
 
 
 class sensible(Promise):
@@ -591,7 +3006,8 @@ class sensible(Promise):
     def decorate(self,func):
         self.defer(func)
 
-    def apply(self,func,code):
+    def _split_globals(self,func):
+        """Split globals of func into sets of callable and other names."""
         callable_globals = set()
         other_globals = set()
         for (nm,obj) in func.func_globals.iteritems():
@@ -599,6 +3015,17 @@ class sensible(Promise):
                 callable_globals.add(nm)
             else:
                 other_globals.add(nm)
+        return (callable_globals,other_globals)
+
+    def cache_key(self,func):
+        (callable_globals,other_globals) = self._split_globals(func)
+        return ("sensible",
+                constant(__builtins__).cache_key(func),
+                constant(callable_globals).cache_key(func),
+                invariant(other_globals).cache_key(func))
+
+    def apply(self,func,code):
+        (callable_globals,other_globals) = self._split_globals(func)
         constant(__builtins__).apply(func,code)
         constant(callable_globals).apply(func,code)
         invariant(other_globals).apply(func,code)
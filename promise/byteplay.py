@@ -25,13 +25,14 @@ __all__ = ['opmap', 'opname', 'opcodes',
            'hasjump', 'haslocal', 'hascompare', 'hasfree', 'hascode',
            'hasflow', 'getse',
            'Opcode', 'SetLineno', 'Label', 'isopcode', 'Code',
-           'CodeList', 'printcodelist']
+           'CodeList', 'CodeArray', 'LABEL_CODE', 'SETLINENO_CODE',
+           'printcodelist']
 
 import opcode
 from dis import findlabels
 import types
 from array import array
-import operator
+import bisect
 import itertools
 import sys
 import warnings
@@ -51,16 +52,40 @@ class Opcode(int):
     __str__ = __repr__
 
 class CodeList(list):
-    """A list for storing opcode tuples - has a nicer __str__."""
+    """A list for storing opcode tuples - has a nicer __str__.
+
+    The version attribute is incremented whenever the list is modified, so
+    that results computed from the list can be remembered until then.
+    """
+    version = 0
+
     def __str__(self):
         f = StringIO()
         printcodelist(self, f)
         return f.getvalue()
 
+def _versioned(name):
+    method = getattr(list, name)
+    def mutator(self, *args, **kwargs):
+        self.version += 1
+        return method(self, *args, **kwargs)
+    mutator.__name__ = name
+    mutator.__doc__ = method.__doc__
+    return mutator
+
+for _name in ('__setitem__', '__delitem__', '__setslice__', '__delslice__',
+              '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop',
+              'remove', 'reverse', 'sort'):
+    setattr(CodeList, _name, _versioned(_name))
+del _name
+
 opmap = dict((name.replace('+', '_'), Opcode(code))
              for name, code in opcode.opmap.iteritems()
              if name != 'EXTENDED_ARG')
 opname = dict((code, name) for name, code in opmap.iteritems())
+# Shared Opcode instances, so that disassembled code doesn't need one for
+# each instruction.
+opcode_objects = dict((int(code), code) for code in opmap.itervalues())
 opcodes = set(opname)
 
 def globalize_opcodes():
@@ -70,6 +95,7 @@ def globalize_opcodes():
 globalize_opcodes()
 
 cmp_op = opcode.cmp_op
+cmp_op_table = dict((x, i) for i, x in enumerate(cmp_op))
 
 hasarg = set(x for x in opcodes if x >= opcode.HAVE_ARGUMENT)
 hasconst = set(Opcode(x) for x in opcode.hasconst)
@@ -232,6 +258,169 @@ def isopcode(obj):
     """Return whether obj is an opcode - not SetLineno or Label"""
     return obj is not SetLineno and not isinstance(obj, Label)
 
+def _as_list(code):
+    """Get a code list as a list, for fast indexing."""
+    if isinstance(code, list):
+        return code
+    return list(code)
+
+# Codes used in the opcode array of a CodeArray for labels and SetLineno,
+# and a mapping from ops to their codes; labels are missing from it.
+LABEL_CODE = 0xFFFF
+SETLINENO_CODE = 0xFFFE
+_opcode_codes = dict((x, x) for x in xrange(256))
+_opcode_codes[SetLineno] = SETLINENO_CODE
+
+# Default for the arg of Code.find(), matching any argument.
+_any_arg = object()
+
+def _arg_key(op, arg):
+    """Get the key of an instruction's argument in the index of a Code."""
+    if op == LOAD_CONST:
+        return id(arg)
+    return arg
+
+class CodeArray(object):
+    """A compact list for storing opcode tuples.
+
+    Instead of a tuple for each item, the opcodes (or labels or SetLineno)
+    and arguments are stored in two parallel lists, along with an
+    array('H') of opcode numbers, in which labels and SetLineno are stored
+    as LABEL_CODE and SETLINENO_CODE. This takes about 40% of the memory
+    of a CodeList, and the array makes checks for the presence of an opcode
+    fast, e.g. "LOAD_NAME in code.opcodes".
+
+    Otherwise it behaves like a CodeList: items are (op, arg) tuples, and
+    the version attribute is incremented whenever the list is modified.
+    The tuples are built when they are accessed, so code relying on their
+    identity should use a CodeList.
+    """
+    version = 0
+    __hash__ = None
+
+    def __init__(self, items=()):
+        self.opcodes = array('H')
+        self.ops = []
+        self.args = []
+        self.extend(items)
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __iter__(self):
+        return itertools.izip(self.ops, self.args)
+
+    def __reversed__(self):
+        return itertools.izip(reversed(self.ops), reversed(self.args))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return zip(self.ops[i], self.args[i])
+        return (self.ops[i], self.args[i])
+
+    def __setitem__(self, i, item):
+        self.version += 1
+        if isinstance(i, slice):
+            items = list(item)
+            start, stop, step = i.indices(len(self.ops))
+            if step == 1:
+                # The slice may change the length, which isn't supported
+                # by arrays in Python 2.4
+                i = slice(start, max(start, stop))
+            self.ops[i] = [op for op, arg in items]
+            self.args[i] = [arg for op, arg in items]
+            self.opcodes[i] = array('H', [_opcode_codes.get(op, LABEL_CODE)
+                                          for op, arg in items])
+        else:
+            op, arg = item
+            self.ops[i] = op
+            self.args[i] = arg
+            self.opcodes[i] = _opcode_codes.get(op, LABEL_CODE)
+
+    def __delitem__(self, i):
+        self.version += 1
+        del self.ops[i]
+        del self.args[i]
+        del self.opcodes[i]
+
+    def __contains__(self, item):
+        return item in itertools.izip(self.ops, self.args)
+
+    def __eq__(self, other):
+        if isinstance(other, CodeArray):
+            return (self.opcodes == other.opcodes and
+                    self.ops == other.ops and self.args == other.args)
+        try:
+            return len(self) == len(other) and list(self) == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __repr__(self):
+        return 'CodeArray(%r)' % (list(self),)
+
+    def __str__(self):
+        f = StringIO()
+        printcodelist(self, f)
+        return f.getvalue()
+
+    def append(self, item):
+        self.version += 1
+        op, arg = item
+        self.ops.append(op)
+        self.args.append(arg)
+        self.opcodes.append(_opcode_codes.get(op, LABEL_CODE))
+
+    def extend(self, items):
+        self.version += 1
+        items = list(items)
+        ops = [op for op, arg in items]
+        self.ops.extend(ops)
+        self.args.extend([arg for op, arg in items])
+        self.opcodes.extend(array('H', [_opcode_codes.get(op, LABEL_CODE)
+                                        for op in ops]))
+
+    def insert(self, i, item):
+        self.version += 1
+        op, arg = item
+        self.ops.insert(i, op)
+        self.args.insert(i, arg)
+        self.opcodes.insert(i, _opcode_codes.get(op, LABEL_CODE))
+
+    def pop(self, i=-1):
+        self.version += 1
+        self.opcodes.pop(i)
+        return (self.ops.pop(i), self.args.pop(i))
+
+    def index(self, item, *args):
+        return list(self).index(item, *args)
+
+    def count(self, item):
+        return list(self).count(item)
+
+    def remove(self, item):
+        del self[self.index(item)]
+
+    def reverse(self):
+        self.version += 1
+        self.ops.reverse()
+        self.args.reverse()
+        self.opcodes.reverse()
+
+    def sort(self, *args, **kwargs):
+        items = list(self)
+        items.sort(*args, **kwargs)
+        self[:] = items
+
 # Flags from code.h
 CO_OPTIMIZED              = 0x0001      # use LOAD/STORE_FAST instead of _NAME
 CO_NEWLOCALS              = 0x0002      # only cleared for module/exec code
@@ -317,8 +506,12 @@ class Code(object):
         yield (addr, lineno)
 
     @classmethod
-    def from_code(cls, co):
-        """Disassemble a Python code object into a Code object."""
+    def from_code(cls, co, compact=False):
+        """Disassemble a Python code object into a Code object.
+
+        If compact is true, the code list is stored in a CodeArray rather
+        than a CodeList, and so are the code lists of any inner code objects.
+        """
         co_code = co.co_code
         labels = dict((addr, Label()) for addr in findlabels(co_code))
         linestarts = dict(cls._findlinestarts(co))
@@ -329,7 +522,9 @@ class Code(object):
         i = 0
         extended_arg = 0
         while i < n:
-            op = Opcode(ord(co_code[i]))
+            op = opcode_objects.get(ord(co_code[i]))
+            if op is None:
+                op = Opcode(ord(co_code[i]))
             if i in labels:
                 code.append((labels[i], None))
             if i in linestarts:
@@ -340,7 +535,7 @@ class Code(object):
                 if lastop != LOAD_CONST:
                     raise ValueError, \
                           "%s should be preceded by LOAD_CONST code" % op
-                code[-1] = (LOAD_CONST, Code.from_code(lastarg))
+                code[-1] = (LOAD_CONST, Code.from_code(lastarg, compact))
             if op not in hasarg:
                 code.append((op, None))
             else:
@@ -366,6 +561,9 @@ class Code(object):
                 else:
                     code.append((op, arg))
 
+        if compact:
+            code = CodeArray(code)
+
         varargs = bool(co.co_flags & CO_VARARGS)
         varkwargs = bool(co.co_flags & CO_VARKEYWORDS)
         newlocals = bool(co.co_flags & CO_NEWLOCALS)
@@ -387,6 +585,8 @@ class Code(object):
                    )
 
     def __eq__(self, other):
+        if not isinstance(other, Code):
+            return NotImplemented
         if (self.freevars != other.freevars or
             self.args != other.args or
             self.varargs != other.varargs or
@@ -418,6 +618,99 @@ class Code(object):
                         return False
         return True
 
+    def find(self, ops, arg=_any_arg):
+        """Get the positions of the instructions with any of the given ops.
+
+        ops may be a single opcode (or SetLineno or a Label) or a collection
+        of them. If an arg is given as well, only instructions with that
+        argument are found; constants (the arguments of LOAD_CONST) are
+        matched by identity, other arguments by equality. The positions are
+        returned as a new list, in increasing order.
+
+        An index from ops and arguments to positions is built on first use.
+        If the code is a CodeList or a CodeArray, the index is kept until
+        the code is modified other than through replace().
+        """
+        by_op, by_arg = self._get_index()
+        if isinstance(ops, (int, Label)) or ops is SetLineno:
+            ops = (ops,)
+        found = []
+        for op in ops:
+            if arg is _any_arg:
+                found.append(by_op.get(op, ()))
+                continue
+            try:
+                table = by_arg[op]
+            except KeyError:
+                table = by_arg[op] = {}
+                code = self.code
+                for pos in by_op.get(op, ()):
+                    key = _arg_key(op, code[pos][1])
+                    table.setdefault(key, []).append(pos)
+            found.append(table.get(_arg_key(op, arg), ()))
+        found = [positions for positions in found if positions]
+        if len(found) == 1:
+            return list(found[0])
+        return sorted(itertools.chain(*found))
+
+    def replace(self, pos, item):
+        """Replace the instruction at the given position.
+
+        This is the same as "code.code[pos] = item", except that the index
+        used by find() is updated instead of being discarded.
+        """
+        code = self.code
+        if pos < 0:
+            pos += len(code)
+        index = self._current_index()
+        old = code[pos]
+        code[pos] = item
+        if index is None:
+            return
+        by_op, by_arg = index
+        for (op, arg), add in ((old, False), (item, True)):
+            positions = [by_op.setdefault(op, [])]
+            if op in by_arg:
+                positions.append(by_arg[op].setdefault(_arg_key(op, arg), []))
+            for lst in positions:
+                i = bisect.bisect_left(lst, pos)
+                if add:
+                    lst.insert(i, pos)
+                else:
+                    del lst[i]
+        self._index = (code, code.version, by_op, by_arg)
+
+    def _current_index(self):
+        """Get the index used by find(), or None if it's out of date."""
+        code = self.code
+        cached = self.__dict__.get('_index')
+        if cached is not None and cached[0] is code:
+            if cached[1] == getattr(code, 'version', None):
+                return cached[2], cached[3]
+        return None
+
+    def _get_index(self):
+        """Get the index used by find(), building it if necessary."""
+        index = self._current_index()
+        if index is not None:
+            return index
+        code = self.code
+        if isinstance(code, CodeArray):
+            ops = code.ops
+        else:
+            ops = [op for op, arg in code]
+        by_op = {}
+        for pos, op in enumerate(ops):
+            try:
+                by_op[op].append(pos)
+            except KeyError:
+                by_op[op] = [pos]
+        version = getattr(code, 'version', None)
+        if version is not None:
+            self._index = (code, version, by_op, {})
+            return by_op, self._index[3]
+        return by_op, {}
+
     def _compute_flags(self):
         opcodes = set(op for op, arg in self.code if isopcode(op))
 
@@ -437,10 +730,228 @@ class Code(object):
         return flags
 
     def _compute_stacksize(self):
-        """Get a code list, compute its maximal stack usage."""
+        """Get a code list, compute its maximal stack usage.
+
+        The result is remembered until the code list is modified, if it's a
+        CodeList.
+        """
+        code = self.code
+        version = getattr(code, 'version', None)
+        cached = self.__dict__.get('_stacksize')
+        if cached is not None and version is not None:
+            if cached[0] is code and cached[1] == version:
+                return cached[2]
+        stacksize = self._analyse_stacksize()
+        if version is not None:
+            self._stacksize = (code, version, stacksize)
+        return stacksize
+
+    def _basic_blocks(self, code):
+        """Split the code list into basic blocks for the stack analysis.
+
+        Blocks start at each label and after each opcode with a special flow
+        control, and end at the next such opcode (inclusive) or label. The
+        result is a list with a tuple (start, islabel, net, peak, trough,
+        last, next) for each block: net is the change in stack depth made by
+        the block's simple opcodes, peak and trough the highest and lowest
+        change on the way, last the position of the flow control opcode
+        ending the block or None, and next the position following the block.
+        """
+        n = len(code)
+        blocks = []
+        pos = 0
+        while pos < n:
+            start = pos
+            islabel = isinstance(code[pos][0], Label)
+            if islabel:
+                pos += 1
+            depth = peak = trough = 0
+            last = None
+            while pos < n:
+                op, arg = code[pos]
+                if isinstance(op, Label):
+                    break
+                pos += 1
+                if not isopcode(op):
+                    # SetLineno
+                    continue
+                if op in hasflow or op in (RETURN_VALUE, RAISE_VARARGS):
+                    last = pos - 1
+                    break
+                if op == MAKE_CLOSURE and python_version == '2.4':
+                    depth -= arg + self._closure_pops(pos - 1)
+                else:
+                    pop, push = getse(op, arg)
+                    depth += push - pop
+                if depth > peak:
+                    peak = depth
+                elif depth < trough:
+                    trough = depth
+            blocks.append((start, islabel, depth, peak, trough, last, pos))
+        return blocks
+
+    def _closure_pops(self, pos):
+        """Get the number of free vars popped by MAKE_CLOSURE in Python 2.4.
+
+        This depends on the number of freevars of TOS, which should be a code
+        object.
+        """
+        if pos == 0:
+            raise ValueError, \
+                  "MAKE_CLOSURE can't be the first opcode"
+        lastop, lastarg = self.code[pos-1]
+        if lastop != LOAD_CONST:
+            raise ValueError, \
+                  "MAKE_CLOSURE should come after a LOAD_CONST op"
+        try:
+            return len(lastarg.freevars)
+        except AttributeError:
+            try:
+                return len(lastarg.co_freevars)
+            except AttributeError:
+                raise ValueError, \
+                      "MAKE_CLOSURE preceding const should "\
+                      "be a code or a Code object"
+
+    def _analyse_stacksize(self):
+        """Compute the maximal stack usage of the code list.
+
+        This finds the same stack states as _compute_stack_states(), but only
+        at the start of each basic block: within a block only the depth
+        changes, by the amounts precomputed by _basic_blocks(). Blocks are
+        explored from a worklist, and blocks starting with a label are only
+        explored once.
+        """
+        code = _as_list(self.code)
+        blocks = self._basic_blocks(code)
+        block_at = dict((b[0], i) for i, b in enumerate(blocks))
+        label_block = dict((code[b[0]][0], i) for i, b in enumerate(blocks)
+                           if b[1])
+        # See _compute_stack_states() for the special treatment of the
+        # targets of SETUP_FINALLY opcodes.
+        sf_targets = set(label_block[arg] for op, arg in code
+                         if op == SETUP_FINALLY)
+        def newstack(curstack, n):
+            # Return a new stack, modified by adding n elements to the last
+            # block
+            if curstack[-1] + n < 0:
+                raise ValueError, "Popped a non-existing element"
+            return curstack[:-1] + (curstack[-1]+n,)
+
+        states = {}
+        maxsize = 0
+        todo = [(block_at.get(0), (0,))]
+        while todo:
+            b, curstack = todo.pop()
+            if b is None:
+                raise ValueError, "Code continues past its end"
+            start, islabel, net, peak, trough, last, next = blocks[b]
+            if islabel:
+                if b in sf_targets:
+                    curstack = curstack[:-1] + (curstack[-1] + 2,)
+                known = states.get(b)
+                if known is not None:
+                    if known != curstack:
+                        raise ValueError, "Inconsistent code"
+                    continue
+                states[b] = curstack
+            top = curstack[-1]
+            if top + trough < 0:
+                raise ValueError, "Popped a non-existing element"
+            size = sum(curstack) + peak
+            if size > maxsize:
+                maxsize = size
+            if net:
+                curstack = curstack[:-1] + (top + net,)
+
+            follow = block_at.get(next)
+            if last is None:
+                todo.append((follow, curstack))
+                continue
+
+            op, arg = code[last]
+            if op in hasjump:
+                target = label_block[arg]
+
+            if op in (STOP_CODE, RETURN_VALUE, RAISE_VARARGS, BREAK_LOOP):
+                # No place in particular to continue to; BREAK_LOOP jumps to
+                # a place specified on block creation
+                pass
+
+            elif op in (JUMP_FORWARD, JUMP_ABSOLUTE):
+                todo.append((target, curstack))
+
+            elif python_version < '2.7' and op in (JUMP_IF_FALSE, JUMP_IF_TRUE):
+                todo.append((target, curstack))
+                todo.append((follow, curstack))
+
+            elif python_version >= '2.7' and op in (POP_JUMP_IF_FALSE, POP_JUMP_IF_TRUE):
+                todo.append((target, newstack(curstack, -1)))
+                todo.append((follow, newstack(curstack, -1)))
+
+            elif python_version >= '2.7' and op in (JUMP_IF_TRUE_OR_POP, JUMP_IF_FALSE_OR_POP):
+                todo.append((target, curstack))
+                todo.append((follow, newstack(curstack, -1)))
+
+            elif op == FOR_ITER:
+                todo.append((target, newstack(curstack, -1)))
+                todo.append((follow, newstack(curstack, 1)))
+
+            elif op == CONTINUE_LOOP:
+                if python_version == '2.6':
+                  stack = curstack[:-1]
+                  if states.get(target) != stack:
+                    todo.append((target, stack[:-1] + (stack[-1]-1,)))
+                  else:
+                    todo.append((target, stack))
+                else:
+                  todo.append((target, curstack[:-1]))
+
+            elif op == SETUP_LOOP:
+                todo.append((target, curstack))
+                todo.append((follow, curstack + (0,)))
+
+            elif op == SETUP_EXCEPT:
+                todo.append((target, newstack(curstack, 3)))
+                todo.append((follow, curstack + (0,)))
+
+            elif op == SETUP_FINALLY:
+                todo.append((target, newstack(curstack, 1)))
+                todo.append((follow, curstack + (0,)))
+
+            elif python_version == '2.7' and op == SETUP_WITH:
+                todo.append((target, curstack))
+                todo.append((follow, newstack(curstack, -1) + (1,)))
+
+            elif op == POP_BLOCK:
+                todo.append((follow, curstack[:-1]))
+
+            elif op == END_FINALLY:
+                todo.append((follow, newstack(curstack, -3)))
+
+            elif op == WITH_CLEANUP:
+                if python_version == '2.7':
+                  todo.append((follow, newstack(curstack, 2)))
+                else:
+                  todo.append((follow, newstack(curstack, -1)))
+
+            else:
+                assert False, "Unhandled opcode: %r" % op
+
+        return maxsize
+
+    def _compute_stack_states(self):
+        """Get a code list, compute the stack state at each opcode.
+
+        The result is a list with an entry for each position in the code
+        list, giving the stack state before the operation as an n-tuple, or
+        None if the position is unreachable. n-1 is the number of blocks
+        pushed; the first item is the number of objects pushed outside any
+        block, and each other item the number pushed inside each block.
+        """
         # This is done by scanning the code, and computing for each opcode
         # the stack state at the opcode.
-        code = self.code
+        code = _as_list(self.code)
 
         # A mapping from labels to their positions in the code list
         label_pos = dict((op, pos)
@@ -491,6 +1002,8 @@ class Code(object):
                     if stacks[pos] != curstack:
                         raise ValueError, "Inconsistent code"
                     return
+            else:
+                stacks[pos] = curstack
 
             def newstack(n):
                 # Return a new stack, modified by adding n elements to the last
@@ -512,23 +1025,7 @@ class Code(object):
                 # effect of MAKE_CLOSURE can be calculated from the arg.
                 # In Python 2.4, it depends on the number of freevars of TOS,
                 # which should be a code object.
-                if pos == 0:
-                    raise ValueError, \
-                          "MAKE_CLOSURE can't be the first opcode"
-                lastop, lastarg = code[pos-1]
-                if lastop != LOAD_CONST:
-                    raise ValueError, \
-                          "MAKE_CLOSURE should come after a LOAD_CONST op"
-                try:
-                    nextrapops = len(lastarg.freevars)
-                except AttributeError:
-                    try:
-                        nextrapops = len(lastarg.co_freevars)
-                    except AttributeError:
-                        raise ValueError, \
-                              "MAKE_CLOSURE preceding const should "\
-                              "be a code or a Code object"
-
+                nextrapops = self._closure_pops(pos)
                 yield pos+1, newstack(-arg-nextrapops)
 
             elif op not in hasflow:
@@ -632,16 +1129,14 @@ class Code(object):
         # Now comes the calculation: open_positions holds positions which are
         # yet to be explored. In each step we take one open position, and
         # explore it by adding the positions to which you can get from it, to
-        # open_positions. On the way, we update maxsize.
+        # open_positions.
         # open_positions is a list of tuples: (pos, stack state)
-        maxsize = 0
         open_positions = [(0, (0,))]
         while open_positions:
             pos, curstack = open_positions.pop()
-            maxsize = max(maxsize, sum(curstack))
             open_positions.extend(get_next_stacks(pos, curstack))
 
-        return maxsize
+        return stacks
 
     def to_code(self):
         """Assemble a Python code object from a Code object."""
@@ -665,19 +1160,43 @@ class Code(object):
                        and arg not in co_freevars)
         co_cellvars = [x for x in self.args if x in cellvars]
 
-        def index(seq, item, eq=operator.eq, can_append=True):
+        # Each sequence gets a hashed table mapping keys to indices, so that
+        # assembly is linear in the size of the code. Constants are keyed by
+        # id(), matching them by identity: this keeps 1, 1.0 and True apart
+        # and handles unhashable constants. The objects themselves are kept
+        # alive by co_consts, so their ids are stable during assembly.
+        def make_table(seq, key=None):
+            table = {}
+            for i, x in enumerate(seq):
+                if key is not None:
+                    x = key(x)
+                table.setdefault(x, i)
+            return table
+
+        consts_table = make_table(co_consts, id)
+        names_table = make_table(co_names)
+        varnames_table = make_table(co_varnames)
+        freevars_table = make_table(co_freevars)
+        cellvars_table = make_table(co_cellvars)
+
+        def index(seq, table, item, key=None, can_append=True):
             """Find the index of item in a sequence and return it.
             If it is not found in the sequence, and can_append is True,
             it is appended to the sequence.
 
-            eq is the equality operator to use.
+            table is the hashed index of seq, and key is the function used
+            to compute an item's key in the table.
             """
-            for i, x in enumerate(seq):
-                if eq(x, item):
-                    return i
+            if key is None:
+                k = item
             else:
+                k = key(item)
+            try:
+                return table[k]
+            except KeyError:
                 if can_append:
                     seq.append(item)
+                    table[k] = len(seq) - 1
                     return len(seq) - 1
                 else:
                     raise IndexError, "Item not found"
@@ -730,23 +1249,23 @@ class Code(object):
                     if isinstance(arg, Code) and i < len(self.code)-1 and \
                        self.code[i+1][0] in hascode:
                         arg = arg.to_code()
-                    arg = index(co_consts, arg, operator.is_)
+                    arg = index(co_consts, consts_table, arg, id)
                 elif op in hasname:
-                    arg = index(co_names, arg)
+                    arg = index(co_names, names_table, arg)
                 elif op in hasjump:
                     # arg will be filled later
                     jumps.append((len(co_code), arg))
                     arg = 0
                 elif op in haslocal:
-                    arg = index(co_varnames, arg)
+                    arg = index(co_varnames, varnames_table, arg)
                 elif op in hascompare:
-                    arg = index(cmp_op, arg, can_append=False)
+                    arg = index(cmp_op, cmp_op_table, arg, can_append=False)
                 elif op in hasfree:
                     try:
-                        arg = index(co_freevars, arg, can_append=False) \
-                              + len(cellvars)
+                        arg = index(co_freevars, freevars_table, arg,
+                                    can_append=False) + len(cellvars)
                     except IndexError:
-                        arg = index(co_cellvars, arg)
+                        arg = index(co_cellvars, cellvars_table, arg)
                 else:
                     # arg is ok
                     pass
@@ -0,0 +1,297 @@
+"""
+
+  promise.cache:  persistent on-disk cache of promise-transformed code.
+
+Applying promises means disassembling, transforming and reassembling the
+bytecode of each decorated function, which is repeated in every process that
+imports the function.  This module provides an opt-in cache that stores the
+transformed code objects on disk, so that later processes can skip all that
+work.  Enable it by calling promise.enable_cache(dirname) before importing
+the decorated modules, or by setting the environment variable PROMISE_CACHE_DIR.
+
+Cache entries are keyed by a fingerprint of the original code object, the
+parameters of the promises being applied (including the current values of any
+names they make constant) and the interpreter's bytecode magic number.
+
+Constants that are real objects (functions, builtins, etc) can't be marshalled,
+so they are stored as a reference to the name under which the object can be
+found in the function's scope, and are re-bound when the entry is loaded.
+Functions whose constants can't be referenced in this way are not cached.
+"""
+
+import os
+import imp
+import types
+import marshal
+import hashlib
+import tempfile
+import __builtin__
+
+from promise import __version__
+
+
+#  Directory in which cache entries are stored; None if disabled.
+_cache_dir = None
+
+#  Attributes set on functions while applying promises, which are stored
+#  with the transformed code and restored when it's loaded.
+_func_attrs = ("_promise_inline_depth","_promise_inline_report")
+
+#  Types of constant that marshal can store directly.
+_marshallable = (types.NoneType,bool,int,long,float,complex,str,unicode)
+
+
+def enable(dirname):
+    """Enable the cache, storing entries in the given directory."""
+    global _cache_dir
+    try:
+        os.makedirs(dirname)
+    except OSError:
+        if not os.path.isdir(dirname):
+            raise
+    _cache_dir = dirname
+
+
+def disable():
+    """Disable the cache."""
+    global _cache_dir
+    _cache_dir = None
+
+
+def enabled():
+    """Check whether the cache is enabled."""
+    return _cache_dir is not None
+
+
+def code_names(co,names=None):
+    """Get the set of names referenced by a code object and its inner code."""
+    if names is None:
+        names = set()
+    names.update(co.co_names)
+    names.update(co.co_varnames)
+    names.update(co.co_freevars)
+    names.update(co.co_cellvars)
+    for const in co.co_consts:
+        if isinstance(const,types.CodeType):
+            code_names(const,names)
+    return names
+
+
+def fingerprint(obj):
+    """Get a string fingerprinting the given object.
+
+    Code objects and constant values are fingerprinted by their contents.
+    Pure functions are fingerprinted by their code and defaults, since they
+    might be inlined; all other objects only by their type.
+    """
+    h = hashlib.sha1()
+    _fingerprint(h,obj,set())
+    return h.hexdigest()
+
+
+def _fingerprint(h,obj,seen):
+    """Update hash object h with a fingerprint of the given object."""
+    if isinstance(obj,_marshallable):
+        h.update(marshal.dumps(obj))
+    elif isinstance(obj,(tuple,frozenset)):
+        h.update("%s:%d:" % (type(obj).__name__,len(obj)))
+        for item in obj:
+            _fingerprint(h,item,seen)
+    elif isinstance(obj,types.CodeType):
+        h.update(marshal.dumps((obj.co_argcount,obj.co_nlocals,
+                                obj.co_stacksize,obj.co_flags,obj.co_code,
+                                obj.co_names,obj.co_varnames,obj.co_filename,
+                                obj.co_name,obj.co_firstlineno,obj.co_lnotab,
+                                obj.co_freevars,obj.co_cellvars)))
+        _fingerprint(h,obj.co_consts,seen)
+    elif hasattr(obj,"_promise_fold_constant") and id(obj) not in seen:
+        seen.add(id(obj))
+        h.update("pure:")
+        _fingerprint(h,obj.func_code,seen)
+        _fingerprint(h,obj.func_defaults,seen)
+    else:
+        h.update("object:%s.%s" % (type(obj).__module__,type(obj).__name__))
+
+
+def make_key(func,co,promises):
+    """Make the cache key for applying the given promises to func.
+
+    The argument 'co' is the code object that the promises will transform.
+    None is returned if the cache is disabled, or if any of the promises
+    doesn't support caching.
+    """
+    if _cache_dir is None:
+        return None
+    h = hashlib.sha1()
+    h.update(imp.get_magic())
+    h.update(__version__)
+    _fingerprint(h,co,set())
+    for p in promises:
+        key = p.cache_key(func)
+        if key is None:
+            return None
+        h.update(repr(key))
+    return h.hexdigest()
+
+
+def load(func,key):
+    """Load the cached code object for func with the given key.
+
+    If there is no usable entry for the key, None is returned.  Otherwise the
+    attributes of func that were stored with the entry are restored.
+    """
+    if key is None or _cache_dir is None:
+        return None
+    try:
+        f = open(os.path.join(_cache_dir,key),"rb")
+        try:
+            if f.read(len(imp.get_magic())) != imp.get_magic():
+                return None
+            (co,bindings,attrs) = marshal.load(f)
+        finally:
+            f.close()
+    except (EnvironmentError,EOFError,ValueError,TypeError):
+        return None
+    try:
+        values = [_resolve_binding(func,binding) for binding in bindings]
+    except NameError:
+        return None
+    co = _rebind_consts(co,(),bindings,values)
+    func.__dict__.update(attrs)
+    return co
+
+
+def store(func,key,co):
+    """Store the code object for func in the cache under the given key.
+
+    If some constants in the code object can't be re-bound when loading,
+    nothing is stored.  The attributes of func named in _func_attrs are
+    stored along with the code.
+    """
+    if key is None or _cache_dir is None:
+        return
+    bindings = []
+    try:
+        index = _scope_index(func)
+        co = _unbind_consts(co,(),index,bindings)
+        attrs = dict((nm,func.__dict__[nm]) for nm in _func_attrs
+                                            if nm in func.__dict__)
+        data = marshal.dumps((co,bindings,attrs))
+    except (NameError,ValueError):
+        return
+    #  Write to a temporary file and rename into place, so that concurrent
+    #  processes never see a partially-written entry.
+    try:
+        (fd,tmpname) = tempfile.mkstemp(dir=_cache_dir)
+        try:
+            f = os.fdopen(fd,"wb")
+            try:
+                f.write(imp.get_magic())
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmpname,os.path.join(_cache_dir,key))
+        except EnvironmentError:
+            os.unlink(tmpname)
+    except EnvironmentError:
+        pass
+
+
+def _get_builtins(func):
+    """Get the builtins dict used by the given function."""
+    builtins = func.func_globals.get("__builtins__",__builtin__)
+    if isinstance(builtins,types.ModuleType):
+        builtins = builtins.__dict__
+    return builtins
+
+
+def _scope_index(func):
+    """Build a dict mapping ids of objects in scope of func to bindings.
+
+    A binding is a tuple (kind,name) where kind is one of "deref", "global"
+    or "builtin", in order of priority.
+    """
+    index = {}
+    for (nm,val) in _get_builtins(func).iteritems():
+        index[id(val)] = ("builtin",nm)
+    for (nm,val) in func.func_globals.iteritems():
+        index[id(val)] = ("global",nm)
+    if func.func_closure:
+        for (nm,cell) in zip(func.func_code.co_freevars,func.func_closure):
+            try:
+                index[id(cell.cell_contents)] = ("deref",nm)
+            except ValueError:
+                pass
+    return index
+
+
+def _resolve_binding(func,binding):
+    """Find the object referred to by the given binding in scope of func."""
+    (_,_,(kind,name)) = binding
+    try:
+        if kind == "deref":
+            idx = func.func_code.co_freevars.index(name)
+            return func.func_closure[idx].cell_contents
+        elif kind == "global":
+            return func.func_globals[name]
+        elif kind == "builtin":
+            return _get_builtins(func)[name]
+    except (ValueError,KeyError,IndexError,TypeError):
+        pass
+    raise NameError(name)
+
+
+def _is_marshallable(obj):
+    """Check whether a constant can be stored directly by marshal."""
+    if isinstance(obj,_marshallable):
+        return True
+    if isinstance(obj,(tuple,frozenset)):
+        for item in obj:
+            if not _is_marshallable(item):
+                return False
+        return True
+    return False
+
+
+def _replace_consts(co,consts):
+    """Make a copy of code object co with the given constants."""
+    return types.CodeType(co.co_argcount,co.co_nlocals,co.co_stacksize,
+                          co.co_flags,co.co_code,tuple(consts),co.co_names,
+                          co.co_varnames,co.co_filename,co.co_name,
+                          co.co_firstlineno,co.co_lnotab,co.co_freevars,
+                          co.co_cellvars)
+
+
+def _unbind_consts(co,path,index,bindings):
+    """Replace non-marshallable constants in co with None.
+
+    Each replaced constant is recorded in the 'bindings' list as a tuple
+    (path,idx,binding) where 'path' gives the indices of the inner code
+    objects containing the constant and 'idx' its index in co_consts.
+    If a constant can't be found in the index, NameError is raised.
+    """
+    consts = list(co.co_consts)
+    for (i,const) in enumerate(consts):
+        if isinstance(const,types.CodeType):
+            consts[i] = _unbind_consts(const,path+(i,),index,bindings)
+        elif not _is_marshallable(const):
+            try:
+                binding = index[id(const)]
+            except KeyError:
+                raise NameError(repr(const))
+            bindings.append((path,i,binding))
+            consts[i] = None
+    return _replace_consts(co,consts)
+
+
+def _rebind_consts(co,path,bindings,values):
+    """Reverse the operation of _unbind_consts using the given values."""
+    consts = list(co.co_consts)
+    for (i,const) in enumerate(consts):
+        if isinstance(const,types.CodeType):
+            consts[i] = _rebind_consts(const,path+(i,),bindings,values)
+    for ((bpath,idx,_),value) in zip(bindings,values):
+        if bpath == path:
+            consts[idx] = value
+    return _replace_consts(co,consts)
+
@@ -0,0 +1,192 @@
+"""
+
+  promise.namespec:  matching of variable names against name specs.
+
+Promises such as constant() and invariant() are given a "name spec" saying
+which variables they apply to.  This module compiles a name spec into a
+NameMatcher, which answers whether a given name (accessed by a given opcode)
+is covered by the spec.  A name spec may be any of:
+
+    * a collection of names, such as a list, tuple or set
+    * a dict or module, covering the names it contains; this is checked
+      against the current contents of the dict, so e.g. __builtins__ works
+      whether it's the builtins module or its dict
+    * a string holding a single name
+    * an existing NameMatcher, which is used as-is
+
+Each name in a collection can be one of:
+
+    * a plain name, e.g. "range"
+    * a dotted name, e.g. "os.path.join"; see constant() and invariant()
+    * a regular expression between slashes, e.g. "/[A-Z_]+/", which must
+      match the whole name
+    * any of the above prefixed by a scope qualifier, e.g. "global:/[A-Z]+/",
+      which restricts it to names in that scope.  The scopes are "global"
+      (including builtins), "closure" and "local".  Names starting with a
+      slash are always regular expressions, so colons in them, as in
+      "/(?:MAX|MIN)_[A-Z]+/", are never taken as a scope qualifier.
+
+Compiling collects the plain names into sets and all the regular expressions
+for each scope into a single regular expression.  The results of matching
+against regular expressions are remembered (up to a limit), and matchers for
+hashable specs are shared, so that applying the same broad spec to many
+functions is cheap.
+"""
+
+import re
+import types
+
+from promise.byteplay import *
+
+
+#  The scope of the names accessed by each opcode.
+_op_scopes = {}
+for _op in (LOAD_GLOBAL,STORE_GLOBAL,DELETE_GLOBAL,
+            LOAD_NAME,STORE_NAME,DELETE_NAME):
+    _op_scopes[_op] = "global"
+for _op in (LOAD_DEREF,STORE_DEREF,LOAD_CLOSURE):
+    _op_scopes[_op] = "closure"
+for _op in (LOAD_FAST,STORE_FAST,DELETE_FAST):
+    _op_scopes[_op] = "local"
+del _op
+
+SCOPES = ("global","closure","local")
+
+#  Matchers compiled from hashable specs, so they can be shared.
+_matchers = {}
+
+#  Maximum number of shared matchers.
+MAX_SHARED_MATCHERS = 256
+
+#  Maximum number of regular expression results remembered by each matcher.
+MAX_REMEMBERED_RESULTS = 4096
+
+
+def matcher(spec):
+    """Get a NameMatcher for the given name spec."""
+    if isinstance(spec,NameMatcher):
+        return spec
+    if isinstance(spec,(basestring,tuple,frozenset)):
+        try:
+            return _matchers[spec]
+        except KeyError:
+            m = NameMatcher(spec)
+            if len(_matchers) >= MAX_SHARED_MATCHERS:
+                _matchers.clear()
+            _matchers[spec] = m
+            return m
+        except TypeError:
+            pass
+    return NameMatcher(spec)
+
+
+def op_scope(op):
+    """Get the scope of the names accessed by the given opcode.
+
+    None is returned for opcodes that don't access variables.
+    """
+    return _op_scopes.get(op)
+
+
+class NameMatcher(object):
+    """Precompiled matcher for a name spec.
+
+    Use match(name,op) to check whether a name accessed by the given opcode
+    is covered by the spec, or "name in matcher" to check whether it could
+    be in any scope.  The dotted names in the spec are available in the
+    attribute 'dotted' as a list of tuples (parts,scope), longest first.
+    """
+
+    def __init__(self,spec):
+        self.spec = spec
+        #  Names matched in any scope, and per scope.
+        self.exact = set()
+        self.scoped = dict((scope,set()) for scope in SCOPES)
+        #  Dicts whose keys are matched in any scope.
+        self.mappings = []
+        self.dotted = []
+        patterns = dict((scope,[]) for scope in SCOPES+(None,))
+        if isinstance(spec,types.ModuleType):
+            spec = spec.__dict__
+        if isinstance(spec,dict):
+            self.mappings.append(spec)
+            spec = ()
+        elif isinstance(spec,basestring):
+            spec = [spec]
+        for nm in spec:
+            self._add(nm,patterns)
+        self.dotted.sort(key=lambda d: len(d[0]),reverse=True)
+        #  Combine all the patterns for each scope into a single regex.
+        #  Patterns for any scope are included in each.
+        self.regexes = {}
+        for scope in SCOPES:
+            regex = patterns[scope] + patterns[None]
+            if regex:
+                regex = "|".join("(?:%s)" % (p,) for p in regex)
+                self.regexes[scope] = re.compile("(?:%s)\\Z" % (regex,))
+        self.results = {}
+
+    def _add(self,nm,patterns):
+        """Add a single name from the spec."""
+        scope = None
+        if ":" in nm and not nm.startswith("/"):
+            (scope,nm) = nm.split(":",1)
+            if scope not in SCOPES:
+                raise ValueError("unknown scope in name spec: %r" % (scope,))
+        if len(nm) > 1 and nm.startswith("/") and nm.endswith("/"):
+            pattern = nm[1:-1]
+            re.compile(pattern)
+            patterns[scope].append(pattern)
+        elif "." in nm:
+            self.dotted.append((nm.split("."),scope))
+        elif scope is None:
+            self.exact.add(nm)
+        else:
+            self.scoped[scope].add(nm)
+
+    def __repr__(self):
+        return "<NameMatcher %r>" % (self.spec,)
+
+    def __contains__(self,name):
+        return self.match(name)
+
+    def match(self,name,op=None):
+        """Check whether the given name is covered by this spec.
+
+        If an opcode is given, only specs for the scope of that opcode are
+        considered; otherwise specs for any scope are.
+        """
+        if name in self.exact:
+            return True
+        for mapping in self.mappings:
+            if name in mapping:
+                return True
+        if op is None:
+            scopes = SCOPES
+        else:
+            scopes = (_op_scopes.get(op),)
+        for scope in scopes:
+            try:
+                if name in self.scoped[scope]:
+                    return True
+            except KeyError:
+                continue
+            if scope in self.regexes:
+                try:
+                    result = self.results[(name,scope)]
+                except KeyError:
+                    result = bool(self.regexes[scope].match(name))
+                    if len(self.results) >= MAX_REMEMBERED_RESULTS:
+                        self.results.clear()
+                    self.results[(name,scope)] = result
+                if result:
+                    return True
+        return False
+
+    def dotted_names(self,exclude=()):
+        """Get the dotted names in the spec, skipping those in 'exclude'.
+
+        Each is returned as a tuple (parts,scope), longest first.
+        """
+        return [(parts,scope) for (parts,scope) in self.dotted
+                              if parts[0] not in exclude]
@@ -0,0 +1,360 @@
+"""
+
+  promise.peephole:  peephole optimisation of byteplay Code objects.
+
+Once promises have turned global loads into constants and inlined the code of
+pure functions, the resulting bytecode contains lots of patterns that the
+CPython compiler would normally have optimised away.  This module provides a
+simple peephole optimiser to clean them up:
+
+    * constant folding:  LOAD_CONST/LOAD_CONST/BINARY_* sequences (and their
+                         unary, BUILD_TUPLE and conditional-jump friends) on
+                         simple immutable constants are evaluated at
+                         transformation time.
+
+    * jump threading:    jumps to unconditional jumps are redirected to the
+                         final target, and jumps to the very next instruction
+                         are removed.
+
+    * store/load elimination:  a STORE_FAST immediately followed by a LOAD_FAST
+                               of a variable that is used nowhere else leaves
+                               the value on the stack instead.
+
+    * dead code removal:  unreferenced labels and code that can't be reached
+                          after an unconditional jump, return or raise are
+                          removed.
+
+These optimisations assume the function doesn't inspect its own local
+variables through e.g. sys._getframe(); functions calling locals() or vars(),
+or using exec or "import *", do not get store/load elimination.
+"""
+
+import operator
+
+from promise.byteplay import *
+
+
+#  Types of constant that can safely be operated on at transformation time;
+#  they are immutable and have no user-defined behaviour.
+_foldable_types = (type(None),bool,int,long,float,complex,str,unicode)
+
+#  Maximum length of a sequence produced by constant folding.
+MAX_FOLDED_LENGTH = 20
+
+#  Maximum exponent or shift amount evaluated by constant folding.
+MAX_FOLDED_EXPONENT = 128
+
+_binary_ops = {
+    BINARY_POWER: operator.pow,
+    BINARY_MULTIPLY: operator.mul,
+    BINARY_DIVIDE: operator.div,
+    BINARY_TRUE_DIVIDE: operator.truediv,
+    BINARY_FLOOR_DIVIDE: operator.floordiv,
+    BINARY_MODULO: operator.mod,
+    BINARY_ADD: operator.add,
+    BINARY_SUBTRACT: operator.sub,
+    BINARY_SUBSCR: operator.getitem,
+    BINARY_LSHIFT: operator.lshift,
+    BINARY_RSHIFT: operator.rshift,
+    BINARY_AND: operator.and_,
+    BINARY_XOR: operator.xor,
+    BINARY_OR: operator.or_,
+}
+
+_unary_ops = {
+    UNARY_POSITIVE: operator.pos,
+    UNARY_NEGATIVE: operator.neg,
+    UNARY_NOT: operator.not_,
+    UNARY_CONVERT: repr,
+    UNARY_INVERT: operator.invert,
+}
+
+#  Opcodes after which execution never continues to the next instruction.
+_unconditional = set([JUMP_ABSOLUTE,JUMP_FORWARD,RETURN_VALUE,RAISE_VARARGS,
+                      BREAK_LOOP,CONTINUE_LOOP])
+
+#  Jump opcodes whose target can be freely redirected.
+_threadable = set([JUMP_ABSOLUTE,JUMP_FORWARD,POP_JUMP_IF_FALSE,
+                   POP_JUMP_IF_TRUE,JUMP_IF_FALSE_OR_POP,JUMP_IF_TRUE_OR_POP])
+
+#  Opcodes that give access to the local namespace by name.
+_namespace_ops = set([LOAD_NAME,STORE_NAME,DELETE_NAME,LOAD_LOCALS,
+                      EXEC_STMT,IMPORT_STAR])
+
+#  Sentinel for operations that can't be folded.
+_nofold = object()
+
+
+def optimize_code(code):
+    """Apply all peephole optimisations to the given Code object in-place.
+
+    The optimisations are repeated until there is nothing left to change.
+    Inner code objects, e.g. of generator expressions, are also optimised.
+    """
+    for (i,(op,arg)) in enumerate(code.code):
+        if op == LOAD_CONST and isinstance(arg,Code):
+            if i+1 < len(code.code) and code.code[i+1][0] in hascode:
+                optimize_code(arg)
+    changed = True
+    while changed:
+        changed = fold_constants(code)
+        changed = thread_jumps(code) or changed
+        changed = eliminate_store_load(code) or changed
+        changed = remove_dead_code(code) or changed
+
+
+def is_foldable(value):
+    """Check whether the given constant can be operated on when folding."""
+    if isinstance(value,_foldable_types):
+        return True
+    if isinstance(value,(tuple,frozenset)):
+        for item in value:
+            if not is_foldable(item):
+                return False
+        return True
+    return False
+
+
+def fold_constants(code):
+    """Evaluate operations on constants at transformation time.
+
+    Returns True if the code was changed, False otherwise.
+    """
+    changed = False
+    new_code = []
+    for (op,arg) in code.code:
+        new_code.append((op,arg))
+        while _fold_tail(new_code):
+            changed = True
+    if changed:
+        code.code[:] = new_code
+    return changed
+
+
+def _fold_tail(code):
+    """Try to fold the instructions at the end of the given list.
+
+    Returns True if the list was changed, False otherwise.
+    """
+    (op,arg) = code[-1]
+    if op in _binary_ops:
+        if len(code) < 3:
+            return False
+        (op1,arg1) = code[-3]
+        (op2,arg2) = code[-2]
+        if op1 != LOAD_CONST or op2 != LOAD_CONST:
+            return False
+        if not is_foldable(arg1) or not is_foldable(arg2):
+            return False
+        value = _eval_binary(op,arg1,arg2)
+        if value is _nofold:
+            return False
+        code[-3:] = [(LOAD_CONST,value)]
+        return True
+    if op in _unary_ops:
+        if len(code) < 2:
+            return False
+        (op1,arg1) = code[-2]
+        if op1 != LOAD_CONST or not is_foldable(arg1):
+            return False
+        try:
+            value = _unary_ops[op](arg1)
+        except Exception:
+            return False
+        if not _is_small(value):
+            return False
+        code[-2:] = [(LOAD_CONST,value)]
+        return True
+    if op == BUILD_TUPLE:
+        if len(code) < arg + 1:
+            return False
+        items = code[len(code)-arg-1:-1]
+        for (op1,arg1) in items:
+            if op1 != LOAD_CONST:
+                return False
+        code[len(code)-arg-1:] = [(LOAD_CONST,tuple(a for (_,a) in items))]
+        return True
+    if op in (POP_JUMP_IF_FALSE,POP_JUMP_IF_TRUE):
+        if len(code) < 2:
+            return False
+        (op1,arg1) = code[-2]
+        if op1 != LOAD_CONST or not is_foldable(arg1):
+            return False
+        if bool(arg1) == (op == POP_JUMP_IF_TRUE):
+            code[-2:] = [(JUMP_ABSOLUTE,arg)]
+        else:
+            del code[-2:]
+        return True
+    return False
+
+
+def _eval_binary(op,a,b):
+    """Evaluate a binary operation on constants, if it's safe to do so.
+
+    Returns the result of the operation, or _nofold if it can't be folded.
+    """
+    integers = (int,long)
+    if op in (BINARY_POWER,BINARY_LSHIFT):
+        if isinstance(b,integers) and abs(b) > MAX_FOLDED_EXPONENT:
+            return _nofold
+    if op == BINARY_MULTIPLY:
+        #  Avoid building huge sequences only to throw them away
+        for (seq,n) in ((a,b),(b,a)):
+            if isinstance(seq,(str,unicode,tuple)) and isinstance(n,integers):
+                if len(seq) * n > MAX_FOLDED_LENGTH:
+                    return _nofold
+    try:
+        value = _binary_ops[op](a,b)
+    except Exception:
+        return _nofold
+    if not _is_small(value):
+        return _nofold
+    return value
+
+
+def _is_small(value):
+    """Check that a folded value isn't too big to store as a constant."""
+    if isinstance(value,(str,unicode,tuple,frozenset)):
+        return len(value) <= MAX_FOLDED_LENGTH
+    return True
+
+
+def _label_positions(code_list):
+    """Map each label to the position of the first real instruction after it.
+
+    Labels at the very end of the code are mapped to len(code_list).
+    """
+    positions = {}
+    pending = []
+    for (i,(op,arg)) in enumerate(code_list):
+        if isinstance(op,Label):
+            pending.append(op)
+        elif op is not SetLineno:
+            for label in pending:
+                positions[label] = i
+            pending = []
+    for label in pending:
+        positions[label] = len(code_list)
+    return positions
+
+
+def thread_jumps(code):
+    """Redirect jumps to jumps, and remove jumps to the next instruction.
+
+    Returns True if the code was changed, False otherwise.
+    """
+    code_list = code.code
+    positions = _label_positions(code_list)
+    #  For each position, the position of the next real instruction
+    next_real = [len(code_list)] * (len(code_list) + 1)
+    for i in xrange(len(code_list)-1,-1,-1):
+        (op,arg) = code_list[i]
+        if isinstance(op,Label) or op is SetLineno:
+            next_real[i] = next_real[i+1]
+        else:
+            next_real[i] = i
+    changed = False
+    new_code = []
+    for (i,(op,arg)) in enumerate(code_list):
+        if op in _threadable:
+            #  Follow chains of unconditional jumps to their final target
+            target = arg
+            seen = set()
+            while target not in seen:
+                seen.add(target)
+                pos = positions[target]
+                if pos == len(code_list):
+                    break
+                (nextop,nextarg) = code_list[pos]
+                if nextop not in (JUMP_ABSOLUTE,JUMP_FORWARD):
+                    break
+                target = nextarg
+            if target is not arg:
+                #  Relative jumps can't go backwards
+                if op == JUMP_FORWARD:
+                    op = JUMP_ABSOLUTE
+                arg = target
+                changed = True
+            #  Remove jumps to the next instruction
+            if positions[arg] == next_real[i+1]:
+                if op in (JUMP_ABSOLUTE,JUMP_FORWARD):
+                    changed = True
+                    continue
+                if op in (POP_JUMP_IF_FALSE,POP_JUMP_IF_TRUE):
+                    new_code.append((POP_TOP,None))
+                    changed = True
+                    continue
+        new_code.append((op,arg))
+    if changed:
+        code.code[:] = new_code
+    return changed
+
+
+def eliminate_store_load(code):
+    """Remove STORE_FAST/LOAD_FAST pairs of otherwise unused variables.
+
+    Returns True if the code was changed, False otherwise.
+    """
+    loads = {}
+    for (op,arg) in code.code:
+        if op in _namespace_ops:
+            return False
+        if op in (LOAD_GLOBAL,LOAD_NAME) and arg in ("locals","vars"):
+            return False
+        if op == LOAD_CONST and (arg is locals or arg is vars):
+            return False
+        if op in (LOAD_FAST,DELETE_FAST):
+            loads[arg] = loads.get(arg,0) + 1
+    changed = False
+    new_code = []
+    code_list = code.code
+    i = 0
+    while i < len(code_list):
+        (op,arg) = code_list[i]
+        if op == STORE_FAST and loads.get(arg) == 1:
+            #  Line number changes can come in between
+            j = i + 1
+            while j < len(code_list) and code_list[j][0] is SetLineno:
+                j += 1
+            if j < len(code_list) and code_list[j] == (LOAD_FAST,arg):
+                #  The value just stays on the stack
+                new_code.extend(code_list[i+1:j])
+                loads[arg] = 0
+                changed = True
+                i = j + 1
+                continue
+        new_code.append((op,arg))
+        i += 1
+    #  Any other stores to those variables are now dead
+    if changed:
+        for (i,(op,arg)) in enumerate(new_code):
+            if op == STORE_FAST and loads.get(arg) == 0:
+                new_code[i] = (POP_TOP,None)
+        code.code[:] = new_code
+    return changed
+
+
+def remove_dead_code(code):
+    """Remove unreferenced labels and unreachable code.
+
+    Returns True if the code was changed, False otherwise.
+    """
+    referenced = set(arg for (op,arg) in code.code if op in hasjump)
+    changed = False
+    new_code = []
+    dead = False
+    for (op,arg) in code.code:
+        if isinstance(op,Label):
+            if op not in referenced:
+                changed = True
+                continue
+            dead = False
+        elif dead:
+            changed = True
+            continue
+        elif op in _unconditional:
+            dead = True
+        new_code.append((op,arg))
+    if changed:
+        code.code[:] = new_code
+    return changed
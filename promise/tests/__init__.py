@@ -1,7 +1,12 @@
 
 import os
 import sys
+import shutil
+import tempfile
+import threading
+import time
 import timeit
+import types
 import unittest
 
 import promise
@@ -57,6 +62,22 @@ class TestPromiseTiming(unittest.TestCase):
             nm = modnm[:-3]
             locals()["test_"+nm] = _make_test(nm)
 
+    def test_guard_overhead(self):
+        """Report the cost of checking guarded constants on each call."""
+        setup = "from promise.tests.guarded import guarded1, unguarded; "
+        setup += "guarded1(0)"
+        if "PROMISE_SKIP_TIMING_TESTS" in os.environ:
+            num = 2
+        else:
+            num = 1000000
+        ts = []
+        for funcnm in ("guarded1","unguarded"):
+            t = timeit.Timer("%s(0)" % (funcnm,),setup).repeat(number=num)
+            ts.append(min(t))
+        if "PROMISE_SKIP_TIMING_TESTS" not in os.environ:
+            per_call = (ts[0] - ts[1]) / num * 1e9
+            sys.stderr.write("guard overhead: %.0fns per call\n" % (per_call,))
+
 
 def test_inlining():
     """Test that function inlining works under a variety of circumstances."""
@@ -99,8 +120,1416 @@ def test_inlining():
     genexp = aggregate4.func_code.co_consts[1]
     assert (LOAD_DEREF,"calc") not in Code.from_code(genexp).code
     assert (BINARY_ADD,None) in Code.from_code(genexp).code
-    
-    
+    #  Nested calls are all inlined
+    @promise.constant(["calc"])
+    def aggregate5(items):
+        return calc(calc(items[0][0]),calc(items[1][0],calc(items[2][0])))
+    assert aggregate5(items) == calc(calc(1),calc(3,calc(5)))
+    assert (LOAD_CONST,calc) not in Code.from_code(aggregate5.func_code).code
+
+
+def test_inlining_arguments():
+    """Test inlining of calls using keyword arguments, *args and **kwds."""
+    @promise.pure()
+    def calc(a,b=7,c=1):
+        return 2*a + 3*b + c
+    @promise.pure()
+    def total(a,*args):
+        return a + sum(args)
+    @promise.pure()
+    def options(a,**kwds):
+        return (a,sorted(kwds.items()))
+    ARGS = (2,3)
+    def inlined(funcs):
+        for func in funcs:
+            code = Code.from_code(func.func_code).code
+            for val in (calc,total,options):
+                assert (LOAD_CONST,val) not in code
+    #  Keyword arguments are mapped onto parameters
+    @promise.constant(["calc"])
+    def keywords(x,y):
+        return (calc(x,b=y),calc(c=x,a=y),calc(y,
+                                               c=x))
+    assert keywords(1,2) == (calc(1,b=2),calc(c=1,a=2),calc(2,c=1))
+    #  Constant *args tuples and **kwds dict displays are unpacked
+    @promise.constant(["calc","ARGS"])
+    def unpacked(x,y):
+        return (calc(*ARGS),calc(x,*ARGS),calc(x,*(2,),**{"c":y}),
+                calc(a=x,**{"b":y+1,"c":y}))
+    assert unpacked(1,2) == (calc(2,3),calc(1,2,3),calc(1,2,c=2),
+                             calc(1,3,2))
+    #  Excess arguments are collected
+    @promise.constant(["total","options","ARGS"])
+    def excess(x,y):
+        return (total(x),total(x,y),total(x,y,*ARGS),total(*ARGS),
+                options(x),options(a=x),options(x,b=y,c=x))
+    assert excess(1,2) == (1,3,8,5,(1,[]),(1,[]),(1,[("b",2),("c",1)]))
+    inlined([keywords,unpacked,excess])
+    #  Calls that can't be bound are left to fail at run-time
+    @promise.constant(["calc","total"])
+    def broken(x,y):
+        if x:
+            return calc(x,a=y)
+        if y:
+            return total(b=y)
+        return calc(b=x)
+    for args in ((1,0),(0,1),(0,0)):
+        try:
+            broken(*args)
+        except TypeError:
+            pass
+        else:
+            assert False, "TypeError not raised"
+    code = Code.from_code(broken.func_code).code
+    assert (LOAD_CONST,calc) in code and (LOAD_CONST,total) in code
+    #  Keyword calls with constant arguments are evaluated
+    @promise.constant(["calc","options"])
+    def evaluated():
+        return (calc(1,c=2),options(1,b=2))
+    assert evaluated() == (25,(1,[("b",2)]))
+    consts = [arg for (op,arg) in Code.from_code(evaluated.func_code).code
+              if op == LOAD_CONST]
+    assert 25 in consts and calc not in consts
+    #  Results containing mutable values are inlined instead
+    assert options not in consts
+    assert evaluated()[1][1] is not evaluated()[1][1]
+
+
+def test_inlining_blocks():
+    """Test inlining of pure functions containing loops and try blocks."""
+    @promise.pure()
+    def find(items,target):
+        for (i,item) in enumerate(items):
+            if item == target:
+                return i
+        return -1
+    @promise.pure()
+    def find_pair(items,total):
+        i = 0
+        while i < len(items):
+            for item in items[i+1:]:
+                if items[i] + item == total:
+                    return (items[i],item)
+            i += 1
+    @promise.pure()
+    def parse(value,default=0):
+        try:
+            return int(value)
+        except ValueError:
+            for c in value:
+                if c.isdigit():
+                    return int(c)
+            return default
+    @promise.pure()
+    def guarded(value):
+        try:
+            return value + 1
+        finally:
+            pass
+    @promise.pure()
+    def generate(n):
+        for i in xrange(n):
+            yield i
+    @promise.pure()
+    def closure(n):
+        return sum(i*n for i in xrange(3))
+    @promise.constant(["find","find_pair","parse"])
+    def caller(items,values):
+        total = 0
+        for value in values:
+            total += 1 + parse(value,-1)
+        return [1 + find(items,3) * 2,(find_pair(items,9),"x"),
+                [parse(v) for v in values],total]
+    items = [1,2,3,4,5]
+    values = ["12","a7b","c"]
+    assert caller(items,values) == [5,((4,5),"x"),[12,7,0],21]
+    assert caller([],[]) == [-1,(None,"x"),[],0]
+    code = Code.from_code(caller.func_code)
+    for func in (find,find_pair,parse):
+        assert (LOAD_CONST,func) not in code.code
+    assert (SETUP_EXCEPT,None) not in code.code
+    assert caller.func_code.co_stacksize == code._compute_stacksize()
+    #  Returns from finally blocks, generators and closures aren't inlined
+    @promise.constant(["guarded","generate","closure"])
+    def unsupported(n):
+        return (guarded(n),list(generate(n)),closure(n))
+    assert unsupported(2) == (3,[0,1],6)
+    code = Code.from_code(unsupported.func_code).code
+    for func in (guarded,generate,closure):
+        assert (LOAD_CONST,func) in code
+
+
+def test_inline_cost_model():
+    """Test the limits on inlining of pure functions, and their report."""
+    @promise.pure(max_inline_size=5)
+    def big(a):
+        return (a + 1) * (a + 2) * (a + 3)
+    @promise.pure(max_growth=12)
+    def small(a):
+        return a + 1
+    @promise.constant(["big","small"])
+    def caller(x,xs):
+        return (big(x),small(x),small(x),small(x),small(*xs),small(1))
+    assert caller(1,[2]) == (24,2,2,2,3,2)
+    report = promise.inline_report(caller)
+    lineno = caller.func_code.co_firstlineno + 2
+    assert sorted(report) == sorted([
+        (lineno,"big","skipped","too large (12 instructions)"),
+        (lineno,"small","inlined",None),
+        (lineno,"small","inlined",None),
+        (lineno,"small","skipped","growth budget exhausted"),
+        (lineno,"small","skipped","arguments not known statically"),
+        (lineno,"small","evaluated",None),
+    ])
+    #  Pure functions inlined into other pure functions count as nested
+    @promise.pure(max_inline_depth=1)
+    def inner(a):
+        return a * 2
+    @promise.pure()
+    @promise.constant(["inner"])
+    def middle(a):
+        return inner(a) + 1
+    @promise.constant(["middle","inner"])
+    def outer(x):
+        return middle(x) + inner(x)
+    assert outer(1) == 5
+    assert middle._promise_inline_depth == 1
+    actions = [(name,action) for (_,name,action,_) in
+               promise.inline_report(outer)]
+    assert sorted(actions) == [("inner","inlined"),("middle","inlined")]
+    @promise.pure(max_inline_depth=1)
+    @promise.constant(["inner"])
+    def middle2(a):
+        return inner(a) + 1
+    @promise.constant(["middle2"])
+    def outer2(x):
+        return middle2(x)
+    assert outer2(1) == 3
+    assert promise.inline_report(outer2)[0][2:] == ("skipped",
+                                                    "nested too deeply")
+
+
+def test_inlining_transitive():
+    """Test that chains of pure functions are inlined to a fixed point."""
+    def h(a):
+        return a + 1
+    @promise.pure()
+    @promise.constant(["h"])
+    def g(a):
+        return h(a) * 2
+    @promise.pure()
+    @promise.constant(["g"])
+    def f(a):
+        return g(a) - 3
+    #  Only now is h known to be pure, so its calls are exposed by inlining
+    promise.pure()(h)
+    @promise.constant(["f"])
+    def caller(x):
+        return f(x)
+    assert caller(1) == 1
+    code = Code.from_code(caller.func_code).code
+    for func in (f,g,h):
+        assert (LOAD_CONST,func) not in code
+    actions = [(name,action) for (_,name,action,_) in
+               promise.inline_report(caller)]
+    assert actions == [("f","inlined"),("h","inlined")]
+    #  Recursive functions are inlined at most once along each chain
+    @promise.pure()
+    @promise.constant(["is_odd"])
+    def is_even(n):
+        if n == 0:
+            return True
+        return is_odd(n - 1)
+    @promise.pure()
+    @promise.constant(["is_even"])
+    def is_odd(n):
+        if n == 0:
+            return False
+        return is_even(n - 1)
+    @promise.constant(["is_even"])
+    def parity(x):
+        return is_even(x)
+    assert parity(3) is False and parity(4) is True
+    code = Code.from_code(parity.func_code).code
+    assert (LOAD_CONST,is_even) in code
+    reasons = [reason for (_,name,_,reason) in
+               promise.inline_report(parity) if name == "is_even"]
+    assert "recursive" in reasons
+
+
+def test_inline_template():
+    """Test that pure functions cache their inline template."""
+    @promise.pure()
+    def calc(a,b=7):
+        return 2*a + 3*b
+    @promise.constant(["calc"])
+    def aggregate0(x):
+        return calc(x) + calc(x,1)
+    assert aggregate0(1) == calc(1) + calc(1,1)
+    (func_code,template) = calc._promise_inline_template
+    assert func_code is calc.func_code
+    assert (RETURN_VALUE,None) not in template
+    @promise.constant(["calc"])
+    def aggregate1(x):
+        return calc(x)
+    assert calc._promise_inline_template[1] is template
+    #  Replacing the code object invalidates the template
+    def calc2(a,b=7):
+        return 3*a + 2*b
+    calc.func_code = calc2.func_code
+    @promise.constant(["calc"])
+    def aggregate2(x):
+        return calc(x)
+    assert calc._promise_inline_template[1] is not template
+    assert aggregate2(1) == 17
+    assert aggregate1(1) == 23
+
+
+def test_pure_constant_args():
+    """Test that pure calls with constant arguments are evaluated early."""
+    @promise.pure()
+    def squares(n):
+        return sum(i*i for i in range(n))
+    @promise.pure()
+    def count(n):
+        total = 0
+        i = 0
+        while i < n:
+            total += 1
+            i += 1
+        return total
+    @promise.pure()
+    def div(a,b):
+        return a // b
+    @promise.pure()
+    def listify(n):
+        return range(n)
+    @promise.pure()
+    def total(n):
+        return sum(xrange(n))
+    #  The time budget can't interrupt builtins, so big arguments aren't
+    #  evaluated at all; this would otherwise take seconds.
+    start = time.time()
+    @promise.constant(["squares","count","div","listify","total"])
+    def calls(x):
+        return (squares(4),squares(x),div(1,0) if x is None else div(7,2),
+                count(1000000) if x is None else count(3),listify(2),
+                total(300000000) if x is None else total(3))
+    assert time.time() - start < 1
+    assert calls(2) == (14,1,3,3,[0,1],3)
+    code = Code.from_code(calls.func_code).code
+    consts = [arg for (op,arg) in code
+              if op == LOAD_CONST and not isinstance(arg,Code)]
+    #  Evaluated calls are replaced by their result
+    assert 14 in consts
+    assert 3 in consts
+    #  Failing, non-constant, too-slow or mutable calls are inlined instead
+    assert (BINARY_FLOOR_DIVIDE,None) in code
+    assert 1000000 in consts
+    assert 300000000 in consts
+    assert range in consts
+    assert calls(2)[4] is not calls(2)[4]
+    for func in (squares,count,div,listify,total):
+        assert func not in consts
+
+
+def _make_many_callsites(n):
+    """Generate a function calling a pure function at n callsites."""
+    @promise.pure()
+    def calc(a,b=7):
+        return 2*a + 3*b
+    src = "def many(x):\n    return 0"
+    src += "".join(" + calc(x,%d)" % (i,) for i in xrange(n))
+    ns = {"calc":calc}
+    exec src in ns
+    return (calc,ns["many"])
+
+
+def test_inlining_many_callsites():
+    """Test that inlining time is linear in the number of callsites."""
+    (calc,many) = _make_many_callsites(100)
+    expected = many(3)
+    promise.constant(["calc"])(many)
+    assert many(3) == expected
+    assert (LOAD_CONST,calc) not in Code.from_code(many.func_code).code
+    if "PROMISE_SKIP_TIMING_TESTS" not in os.environ:
+        def decorate_time(n):
+            ts = []
+            for _ in xrange(3):
+                (calc,many) = _make_many_callsites(n)
+                t = time.time()
+                promise.constant(["calc"])(many)
+                ts.append(time.time() - t)
+            return min(ts)
+        t_small = decorate_time(100)
+        t_large = decorate_time(400)
+        #  Linear would give a ratio of about 4; quadratic about 16.
+        assert t_large / t_small < 8
+
+
+def _make_big_code(n):
+    """Generate a Code object with roughly n distinct-heavy instructions."""
+    code = [(SetLineno,1),(LOAD_CONST,0)]
+    for i in xrange(n // 6):
+        code.append((LOAD_CONST,i))
+        code.append((STORE_FAST,"v%d" % (i,)))
+        code.append((LOAD_FAST,"v%d" % (i,)))
+        code.append((BINARY_ADD,None))
+        code.append((LOAD_CONST,str(i)))
+        code.append((POP_TOP,None))
+    code.append((RETURN_VALUE,None))
+    #  Some never-executed name lookups to populate co_names
+    for i in xrange(n // 6):
+        code.append((LOAD_GLOBAL,"g%d" % (i,)))
+    return Code(CodeList(code),(),(),False,False,True,"big","<big>",1,None)
+
+
+def test_assemble_constants():
+    """Test that constants are matched by identity when assembling."""
+    lst = [1]
+    code = Code(CodeList([(SetLineno,1),
+                          (LOAD_CONST,1),(LOAD_CONST,1.0),(LOAD_CONST,True),
+                          (LOAD_CONST,lst),(LOAD_CONST,lst),(LOAD_CONST,1),
+                          (BUILD_TUPLE,6),(RETURN_VALUE,None)]),
+                (),(),False,False,True,"consts","<consts>",1,None)
+    co = code.to_code()
+    assert co.co_consts == (None,1,1.0,True,[1])
+    assert [type(c) for c in co.co_consts[1:4]] == [int,float,bool]
+    res = eval(co)
+    assert res == (1,1.0,True,[1],[1],1)
+    assert res[3] is lst and res[4] is lst
+
+
+def test_assemble_large_function():
+    """Test that assembly of very large functions is linear in code size."""
+    code = _make_big_code(10000)
+    co = code.to_code()
+    assert Code.from_code(co) == code
+    assert eval(co) == sum(xrange(10000 // 6))
+    if "PROMISE_SKIP_TIMING_TESTS" not in os.environ:
+        def assemble_time(n):
+            code = _make_big_code(n)
+            return min(timeit.Timer(code.to_code).repeat(3,number=1))
+        t_small = assemble_time(5000)
+        t_large = assemble_time(20000)
+        #  Linear would give a ratio of about 4; quadratic about 16.
+        assert t_large / t_small < 8
+
+
+def test_stacksize():
+    """Test the stack depth analysis against the full stack states."""
+    import inspect, difflib, tarfile
+    def check(co):
+        code = Code.from_code(co)
+        states = [sum(st) for st in code._compute_stack_states()
+                          if st is not None]
+        assert code._compute_stacksize() == max(states)
+        for const in co.co_consts:
+            if isinstance(const,types.CodeType):
+                check(const)
+    for mod in (inspect,difflib,tarfile,promise):
+        filename = mod.__file__
+        if filename.endswith(".pyc"):
+            filename = filename[:-1]
+        check(compile(open(filename,"U").read(),filename,"exec"))
+    #  The result is remembered until the code list is modified
+    code = _make_big_code(100)
+    size = code._compute_stacksize()
+    version = code.code.version
+    assert code._compute_stacksize() == size
+    code.code[0:0] = [(LOAD_CONST,None)] * 10
+    assert code.code.version > version
+    assert code._compute_stacksize() == size + 10
+
+
+def test_code_array():
+    """Test that CodeArray behaves like a CodeList."""
+    def check(lst,arr):
+        assert arr == lst and list(arr) == list(lst) and len(arr) == len(lst)
+        codes = [LABEL_CODE if isinstance(op,Label) else
+                 SETLINENO_CODE if op is SetLineno else op
+                 for (op,arg) in lst]
+        assert list(arr.opcodes) == codes
+    co = test_code_array.func_code
+    lst = Code.from_code(co).code
+    arr = Code.from_code(co,compact=True).code
+    assert isinstance(arr,CodeArray)
+    #  Labels are separate objects in each, so map them across
+    labels = dict(zip([op for (op,arg) in lst if isinstance(op,Label)],
+                      [op for (op,arg) in arr if isinstance(op,Label)]))
+    lst = CodeList((labels.get(op,op),labels.get(arg,arg)) for (op,arg) in lst)
+    check(lst,arr)
+    for c in (lst,arr):
+        c.insert(2,(LOAD_CONST,None))
+        c.append((POP_TOP,None))
+        c[3] = (LOAD_CONST,1)
+        c[4:6] = [(LOAD_CONST,2),(LOAD_CONST,3),(LOAD_CONST,4)]
+        del c[-3:-1]
+        c[0:0] = [(SetLineno,1)]
+        c.extend(c[:2])
+        c.pop(5)
+    check(lst,arr)
+    assert (LOAD_CONST,4) in arr and (YIELD_VALUE,None) not in arr
+    assert arr.index((LOAD_CONST,4)) == lst.index((LOAD_CONST,4))
+    assert arr[::-1] == lst[::-1] and list(reversed(arr)) == lst[::-1]
+    assert LOAD_CONST in arr.opcodes and YIELD_VALUE not in arr.opcodes
+    version = arr.version
+    arr[:] = lst
+    assert arr.version > version
+    check(lst,arr)
+    #  Compact code assembles to the same code object
+    code = Code.from_code(co,compact=True)
+    assert code.to_code() == Code.from_code(co).to_code()
+
+
+
+def test_code_find():
+    """Test the index of instructions on Code objects."""
+    def f(a,b):
+        x = a + b
+        for i in range(10):
+            x += len(str(i)) * a
+        return x
+    def check(c):
+        for op in (LOAD_FAST,LOAD_GLOBAL,LOAD_CONST,STORE_FAST,YIELD_VALUE):
+            expected = [i for (i,(op2,_)) in enumerate(c.code) if op2 == op]
+            assert c.find(op) == expected
+            for arg in set(arg for (op2,arg) in c.code if op2 == op):
+                assert c.find(op,arg) == [i for i in expected
+                                          if c.code[i][1] is arg or
+                                             (op != LOAD_CONST and
+                                              c.code[i][1] == arg)]
+        expected = [i for (i,(op,_)) in enumerate(c.code)
+                      if op in (LOAD_FAST,STORE_FAST)]
+        assert c.find((LOAD_FAST,STORE_FAST)) == expected
+    for compact in (False,True):
+        c = Code.from_code(f.func_code,compact=compact)
+        check(c)
+        #  Replacing an instruction keeps the index up to date
+        index = c._index
+        i = c.find(LOAD_FAST,"a")[0]
+        c.replace(i,(LOAD_GLOBAL,"z"))
+        assert c._index[2] is index[2]
+        assert c.find(LOAD_GLOBAL,"z") == [i] and i not in c.find(LOAD_FAST)
+        check(c)
+        #  Other changes to the code rebuild it
+        c.code.insert(0,(NOP,None))
+        assert c.find(NOP) == [0]
+        assert c.find(LOAD_GLOBAL,"z") == [i+1]
+        check(c)
+        c.code = CodeList(c.code)
+        check(c)
+    assert not c.find(LOAD_CONST,10.0)
+
+
+_cache_test_src = """
+import promise
+
+@promise.pure()
+def calc(a,b=7):
+    return 2*a + 3*b
+
+items = [(1,7),(3,7),(5,7)]
+
+@promise.constant(__builtins__)
+@promise.constant(["calc"])
+def aggregate(n):
+    return sum([calc(a,b) for (a,b) in items[:n]]) + len(items)
+
+@promise.sensible()
+def finder(item):
+    return item in items
+"""
+
+def test_cache():
+    """Test that transformed code objects are cached on disk."""
+    cachedir = tempfile.mkdtemp()
+    orig_apply = promise.constant.apply
+    applied = []
+    def counting_apply(self,func,code):
+        applied.append(func.func_name)
+        return orig_apply(self,func,code)
+    promise.constant.apply = counting_apply
+    promise.enable_cache(cachedir)
+    try:
+        ns1 = {"__name__":"cachetest"}
+        exec _cache_test_src in ns1
+        assert ns1["aggregate"](2) == 53
+        assert ns1["finder"]((3,7))
+        assert "aggregate" in applied and "finder" in applied
+        assert os.listdir(cachedir)
+        #  A fresh copy of the module loads from the cache
+        del applied[:]
+        ns2 = {"__name__":"cachetest"}
+        exec _cache_test_src in ns2
+        assert ns2["aggregate"](2) == 53
+        assert ns2["finder"]((3,7))
+        assert not ns2["finder"]((3,8))
+        assert "aggregate" not in applied and "finder" not in applied
+        #  The inlining done is restored along with the code
+        assert promise.inline_report(ns2["aggregate"]) == \
+               promise.inline_report(ns1["aggregate"])
+        assert ns2["aggregate"]._promise_inline_depth == \
+               ns1["aggregate"]._promise_inline_depth == 1
+        #  Constants are re-bound to the objects in the new scope
+        consts = ns2["aggregate"].func_code.co_consts
+        assert ns2["calc"] not in consts
+        assert sum in consts and ns1["calc"] not in consts
+        #  Changing a constant value gives a different cache key
+        ns3 = {"__name__":"cachetest"}
+        exec _cache_test_src.replace("2*a","4*a") in ns3
+        assert ns3["aggregate"](2) == 61
+        assert "aggregate" in applied
+    finally:
+        promise.disable_cache()
+        promise.constant.apply = orig_apply
+        shutil.rmtree(cachedir)
+
+
+_types_cache_test_src = """
+import promise
+
+class Vector(object):
+    def __init__(self,x):
+        self.x = x
+    @promise.pure()
+    def double(self):
+        return self.x * 2
+
+@promise.types(v=Vector)
+def use(v):
+    return v.double()
+"""
+
+def test_types_cache():
+    """Test that cached types() promises notice changes to methods."""
+    cachedir = tempfile.mkdtemp()
+    promise.enable_cache(cachedir)
+    try:
+        ns1 = {"__name__":"typescachetest"}
+        exec _types_cache_test_src in ns1
+        assert ns1["use"](ns1["Vector"](3)) == 6
+        ns2 = {"__name__":"typescachetest"}
+        exec _types_cache_test_src.replace("* 2","* 5") in ns2
+        assert ns2["Vector"](3).double() == 15
+        assert ns2["use"](ns2["Vector"](3)) == 15
+    finally:
+        promise.disable_cache()
+        shutil.rmtree(cachedir)
+
+
+_apply_all_test_src = """
+import promise
+
+@promise.constant(["helper"])
+def early(x):
+    return helper(x)
+
+class Thing(object):
+    @promise.sensible()
+    def method(self,x):
+        return len(x)
+    @staticmethod
+    @promise.sensible()
+    def static(x):
+        return len(x)
+"""
+
+def test_apply_all():
+    """Test eager application of deferred promises."""
+    mod = types.ModuleType("applyalltest")
+    exec _apply_all_test_src in mod.__dict__
+    early = mod.early
+    method = mod.Thing.__dict__["method"]
+    static = mod.Thing.__dict__["static"].__func__
+    for func in (early,method,static):
+        assert hasattr(func,"_promise_deferred")
+    #  Promises that can't yet be resolved are reported
+    unresolved = promise.apply_all(mod)
+    assert [func for (func,err) in unresolved] == [early]
+    assert isinstance(unresolved[0][1],NameError)
+    assert hasattr(early,"_promise_deferred")
+    for func in (method,static):
+        assert not hasattr(func,"_promise_deferred")
+        assert (LOAD_CONST,len) in Code.from_code(func.func_code).code
+        assert (LOAD_CONST,promise.apply_deferred_promises) \
+               not in Code.from_code(func.func_code).code
+    assert mod.Thing().method("abc") == 3
+    assert mod.Thing.static("ab") == 2
+    #  Once the name is defined, they can be resolved
+    exec "def helper(x):\n    return x + 1" in mod.__dict__
+    assert promise.apply_all(mod) == []
+    assert not hasattr(early,"_promise_deferred")
+    assert (LOAD_CONST,mod.helper) in Code.from_code(early.func_code).code
+    assert early(1) == 2
+    #  Other errors are reported too, without stopping the others
+    class failing(promise.Promise):
+        def decorate(self,func):
+            self.defer(func)
+        def apply(self,func,code):
+            raise TypeError("can't apply this")
+    @failing()
+    def broken(x):
+        return len(x)
+    @promise.sensible()
+    def fine(x):
+        return len(x)
+    unresolved = promise.apply_all(broken,fine)
+    assert [func for (func,err) in unresolved] == [broken]
+    assert isinstance(unresolved[0][1],TypeError)
+    for func in (broken,fine):
+        assert not hasattr(func,"_promise_deferred")
+        assert (LOAD_CONST,promise.apply_deferred_promises) \
+               not in Code.from_code(func.func_code).code
+    assert (LOAD_CONST,len) in Code.from_code(fine.func_code).code
+    assert broken("ab") == fine("ab") == 2
+
+
+def test_deferred_threads():
+    """Test that deferred promises are applied exactly once under threads."""
+    orig_apply = promise.sensible.apply
+    applied = []
+    def slow_apply(self,func,code):
+        applied.append(func)
+        time.sleep(0.01)
+        return orig_apply(self,func,code)
+    promise.sensible.apply = slow_apply
+    try:
+        for _ in xrange(5):
+            @promise.sensible()
+            def hammered(x):
+                return len(x) + 1
+            start = threading.Event()
+            results = []
+            errors = []
+            def worker():
+                start.wait()
+                try:
+                    for i in xrange(200):
+                        results.append(hammered(range(i % 10)))
+                except Exception, e:
+                    errors.append(e)
+            threads = [threading.Thread(target=worker) for _ in xrange(20)]
+            for t in threads:
+                t.start()
+            start.set()
+            for t in threads:
+                t.join()
+            assert not errors
+            assert len(results) == 20*200
+            assert sorted(set(results)) == range(1,11)
+            assert applied.count(hammered) == 1
+            assert not hasattr(hammered,"_promise_deferred")
+            code = Code.from_code(hammered.func_code).code
+            assert (LOAD_CONST,promise.apply_deferred_promises) not in code
+            assert (LOAD_CONST,len) in code
+    finally:
+        promise.sensible.apply = orig_apply
+
+
+def test_deferred_failure():
+    """Test that a deferred promise failing removes the bootstrap code."""
+    @promise.constant(["undefined_name"])
+    def broken(x):
+        if x is None:
+            return undefined_name
+        return x + 1
+    try:
+        broken(1)
+    except NameError:
+        pass
+    else:
+        assert False, "deferred promise should have raised NameError"
+    code = Code.from_code(broken.func_code).code
+    assert (LOAD_CONST,promise.apply_deferred_promises) not in code
+    assert broken(1) == 2
+
+
+def test_deferred_inner():
+    """Test deferring promises on inner code until it's first executed."""
+    def make_outer():
+        @promise.constant(["scale"])
+        def outer(n):
+            def inner(x):
+                return scale * x
+            return sum(inner(i) for i in xrange(n))
+        return outer
+    outer = make_outer()
+    def inner_code(func,name):
+        for c in func.func_code.co_consts:
+            if isinstance(c,types.CodeType) and c.co_name == name:
+                return Code.from_code(c).code
+    assert (LOAD_GLOBAL,"scale") in inner_code(outer,"inner")
+    #  The inner code can't be transformed until the name is defined
+    assert outer(0) == 0
+    try:
+        outer(3)
+    except NameError:
+        pass
+    else:
+        assert False, "inner function should have raised NameError"
+    assert (LOAD_GLOBAL,"scale") in inner_code(outer,"inner")
+    globals()["scale"] = 2
+    try:
+        assert outer(3) == 6
+        code = inner_code(outer,"inner")
+        assert (LOAD_CONST,2) in code
+        assert (LOAD_GLOBAL,"scale") not in code
+        assert not [arg for (op,arg) in code if callable(arg)]
+        #  Later changes to the name are not seen
+        globals()["scale"] = 3
+        assert outer(3) == 6
+    finally:
+        del globals()["scale"]
+
+
+def test_guarded_constant():
+    """Test that guarded constants are re-applied when the names change."""
+    globals()["offset"] = 1
+    try:
+        @promise.optimize()
+        @promise.constant(["offset","len"],guarded=True)
+        def guarded(x,*args):
+            if x is None:
+                return len(args)
+            return [x + offset for _ in args]
+        assert guarded(1,2,3) == [2,2]
+        code = Code.from_code(guarded.func_code).code
+        assert (LOAD_CONST,1) in code
+        assert (LOAD_GLOBAL,"offset") in code
+        #  Changing the name re-applies all the promises with the new value
+        globals()["offset"] = 10
+        assert guarded(1,2,3) == [11,11]
+        code = Code.from_code(guarded.func_code).code
+        assert (LOAD_CONST,10) in code
+        assert (LOAD_CONST,1) not in code
+        assert guarded(2,None) == [12]
+        #  Deleting a name that's not used gives the original code back
+        del globals()["offset"]
+        assert guarded(None,1,2) == 2
+        code = Code.from_code(guarded.func_code).code
+        assert (LOAD_CONST,len) not in code
+        try:
+            guarded(1,2)
+        except NameError:
+            pass
+        else:
+            assert False, "guarded function should have raised NameError"
+    finally:
+        globals().pop("offset",None)
+    #  Builtins are re-checked if they're patched or shadowed by a global
+    import __builtin__
+    ns = {}
+    exec "def count(x):\n    return abs(len(x))\n" in ns
+    count = promise.constant(["abs","len"],guarded=True)(ns["count"])
+    real_abs = __builtin__.abs
+    assert count([]) == 0
+    __builtin__.abs = lambda x: 1
+    try:
+        assert count([]) == 1
+    finally:
+        __builtin__.abs = real_abs
+    assert count([]) == 0
+    ns["len"] = lambda x: 5
+    assert count([]) == 5
+    assert (LOAD_CONST,ns["len"]) in Code.from_code(count.func_code).code
+    try:
+        @promise.constant(["len"],guarded=True)
+        def generator(x):
+            yield len(x)
+    except TypeError:
+        pass
+    else:
+        assert False, "generators shouldn't have guarded constants"
+
+
+def test_dotted_names():
+    """Test promising chains of attribute lookups using dotted names."""
+    class Config(object):
+        timeout = 5
+    class Holder(object):
+        config = Config()
+    @promise.constant(["os.path.join","os"])
+    def joined(a):
+        return (os.path.join(a,"b"),os.sep)
+    assert joined("a") == ("a/b","/")
+    code = Code.from_code(joined.func_code).code
+    assert (LOAD_CONST,os.path.join) in code
+    assert (LOAD_ATTR,"path") not in code
+    assert (LOAD_CONST,os) in code
+    assert (LOAD_ATTR,"sep") in code
+    #  Invariant chains and bound methods are hoisted into locals
+    @promise.invariant(["self.config.timeout","out.append"])
+    def collect(self,out,n):
+        for i in xrange(n):
+            out.append(self.config.timeout + i)
+        return out
+    assert collect(Holder(),[],3) == [5,6,7]
+    code = Code.from_code(collect.func_code).code
+    assert [op for (op,arg) in code].count(LOAD_ATTR) == 3
+    assert code[2] == (LOAD_ATTR,"append")
+    #  The names may not be modified
+    try:
+        @promise.constant(["os.path.join"])
+        def broken():
+            os.path.join = None
+    except promise.BrokenPromiseError:
+        pass
+    else:
+        assert False, "assigning a constant attribute should fail"
+    try:
+        @promise.invariant(["self.config"])
+        def broken(self):
+            self = Holder()
+            return self.config
+    except promise.BrokenPromiseError:
+        pass
+    else:
+        assert False, "assigning an invariant name should fail"
+    try:
+        @promise.constant(["self.config"])
+        def broken(self):
+            return self.config
+    except promise.BrokenPromiseError:
+        pass
+    else:
+        assert False, "local names can't be constant"
+    #  Guarded bound methods are checked for equality
+    holder = Holder()
+    holder.add = lambda x: x + 1
+    @promise.constant(["holder.config.__repr__","holder.add"],guarded=True)
+    def check(x):
+        return (holder.config.__repr__(),holder.add(x))
+    assert check(1) == (repr(Holder.config),2)
+    code = Code.from_code(check.func_code).code
+    assert (LOAD_CONST,holder.add) in code
+    holder.add = lambda x: x + 2
+    assert check(1) == (repr(Holder.config),3)
+
+
+def test_name_specs():
+    """Test matching names against regexes and scope qualifiers."""
+    import __builtin__
+    LIMIT = 3
+    @promise.constant(["/[A-Z]+/","global:/[a-z]+/"])
+    def limited(items):
+        return [min(x,LIMIT) for x in items]
+    assert limited([1,5]) == [1,3]
+    code = Code.from_code(limited.func_code).code
+    assert (LOAD_CONST,3) in code
+    assert (LOAD_CONST,min) in code
+    assert (LOAD_FAST,"x") in code
+    #  Modules and single names can be given as specs
+    @promise.constant(__builtin__)
+    @promise.invariant("LIMIT")
+    def lengths(items):
+        return [len(x) + LIMIT for x in items]
+    assert lengths(["ab"]) == [5]
+    code = Code.from_code(lengths.func_code).code
+    assert (LOAD_CONST,len) in code
+    assert (LOAD_DEREF,"LIMIT") in code
+    #  Locals only break a promise if they're in scope of the spec
+    try:
+        @promise.constant(["/[a-z]+/"])
+        def broken(items):
+            return len(items)
+    except promise.BrokenPromiseError:
+        pass
+    else:
+        assert False, "local names can't be constant"
+    try:
+        promise.constant(["module:len"])
+    except ValueError:
+        pass
+    else:
+        assert False, "unknown scope should raise ValueError"
+    matcher = promise.namespec.matcher(("closure:/l.*/","global:x"))
+    assert matcher is promise.namespec.matcher(("closure:/l.*/","global:x"))
+    assert matcher.match("len",LOAD_DEREF)
+    assert not matcher.match("len",LOAD_GLOBAL)
+    assert matcher.match("x",LOAD_GLOBAL)
+    assert not matcher.match("x",LOAD_FAST)
+    assert "x" in matcher and "y" not in matcher
+    #  Colons inside regular expressions aren't scope qualifiers
+    matcher = promise.namespec.matcher(("/(?:MAX|MIN)_[A-Z]+/",
+                                        "local:/(?!_)[a-z]+/"))
+    assert "MAX_SIZE" in matcher and "MIN_X" in matcher
+    assert "AVG_SIZE" not in matcher
+    assert matcher.match("item",LOAD_FAST)
+    assert not matcher.match("item",LOAD_GLOBAL)
+    assert not matcher.match("_item",LOAD_FAST)
+    #  Remembered results are bounded
+    for i in xrange(promise.namespec.MAX_REMEMBERED_RESULTS + 10):
+        matcher.match("MAX_%d" % (i,))
+    assert len(matcher.results) <= promise.namespec.MAX_REMEMBERED_RESULTS
+
+
+def test_final_methods():
+    """Test inlining final methods into other methods of their class."""
+    class Service(object):
+        prefix = "p"
+        @promise.final()
+        def _key(self,x):
+            return (self.prefix,self._norm(x))
+        @promise.final()
+        def _norm(self,x):
+            return abs(x)
+        def lookup(self,x):
+            return self._key(x)
+        def lookup_many(self,*xs):
+            return [self._key(x=x) for x in xs]
+    promise.final()(Service)
+    service = Service()
+    assert service.lookup(-1) == ("p",1)
+    assert service.lookup_many(2,-3) == [("p",2),("p",3)]
+    assert promise.inline_report(Service.lookup.im_func) == \
+           [(service.lookup.func_code.co_firstlineno+1,"_key","inlined",None)]
+    code = Code.from_code(Service.lookup.im_func.func_code).code
+    assert (LOAD_ATTR,"_key") not in code
+    assert (LOAD_ATTR,"_norm") not in code
+    #  Subclasses are checked before using the inlined code
+    class Sub(Service):
+        prefix = "s"
+    assert Sub().lookup(2) == ("s",2)
+    class Broken(Service):
+        def _norm(self,x):
+            return x
+    try:
+        Broken().lookup(2)
+    except promise.BrokenPromiseError:
+        pass
+    else:
+        assert False, "overriding a final method should fail"
+    try:
+        promise.final()(Service)
+    except promise.BrokenPromiseError:
+        pass
+    else:
+        assert False, "overriding a final method should fail"
+    class Munger(object):
+        @promise.final()
+        def _key(self,x):
+            return x
+        def munge(self):
+            self._key = None
+    try:
+        promise.final()(Munger)
+    except promise.BrokenPromiseError:
+        pass
+    else:
+        assert False, "assigning a final method should fail"
+
+
+def test_types():
+    """Test optimisations using the promised types of arguments."""
+    class Vector(object):
+        def __init__(self,x):
+            self.x = x
+        @promise.pure()
+        def double(self):
+            return self.x * 2
+    @promise.types(items=list,v=Vector,n=int)
+    @promise.constant(["isinstance","int","float"])
+    def fill(items,v,n):
+        for i in range(n):
+            items.append(v.double())
+        if isinstance(n,int) and not isinstance(n,float):
+            return items
+        return None
+    assert fill([],Vector(3),2) == [6,6]
+    code = Code.from_code(fill.func_code).code
+    assert (LOAD_ATTR,"double") not in code
+    assert (LOAD_CONST,isinstance) not in code
+    #  The list method is looked up once, on entry
+    ops = [op for (op,arg) in code if op is not SetLineno]
+    assert ops[:3] == [LOAD_FAST,LOAD_ATTR,STORE_FAST]
+    assert ops.count(LOAD_ATTR) == 2
+    #  Arguments that are assigned to are left alone
+    @promise.types(x=int)
+    def reassigned(x):
+        x = str(x)
+        return isinstance(x,int)
+    assert reassigned(1) is False
+    #  Without a promise that isinstance is constant, it's left alone
+    ns = {}
+    exec "def check(n):\n    return isinstance(n,int)\n" in ns
+    check = promise.types(n=int)(ns["check"])
+    assert (LOAD_GLOBAL,"isinstance") in Code.from_code(check.func_code).code
+    ns["isinstance"] = lambda x,c: "patched"
+    assert check(1) == "patched"
+    try:
+        promise.types(z=int)(lambda a: a)
+    except TypeError:
+        pass
+    else:
+        assert False, "promising the type of a non-argument should fail"
+    #  In debug mode, the types are checked on entry
+    promise.types.debug = True
+    try:
+        @promise.types(x=(int,long))
+        def checked(x):
+            return x
+    finally:
+        promise.types.debug = False
+    assert checked(1) == 1
+    try:
+        checked("1")
+    except promise.BrokenPromiseError:
+        pass
+    else:
+        assert False, "passing an argument of the wrong type should fail"
+
+
+def test_hoist():
+    """Test hoisting invariant expressions out of loops."""
+    @promise.hoist()
+    @promise.constant(["len"])
+    def count(words,d,out):
+        for w in words:
+            for c in w:
+                d[c] = d.get(c,0) + len(words)
+            out.seen.append(len(w))
+        return d
+    class Output(object):
+        pass
+    out = Output()
+    out.seen = []
+    assert count(["ab","b"],{},out) == {"a":2,"b":4}
+    assert out.seen == [2,1]
+    code = Code.from_code(count.func_code).code
+    ops = [op for (op,arg) in code]
+    #  Everything but len(w) is hoisted out of both loops
+    setup = ops.index(SETUP_LOOP)
+    attrs = [arg for (op,arg) in code[:setup] if op == LOAD_ATTR]
+    assert attrs == ["get","seen","append"]
+    assert LOAD_ATTR not in ops[setup:]
+    assert ops[:setup].count(CALL_FUNCTION) == 1
+    #  Values assigned in the loop, or looked up in munged attributes,
+    #  are left alone
+    @promise.hoist()
+    def munged(obj,n):
+        total = 0
+        for i in range(n):
+            total += obj.value * 2
+            obj.value = i
+        return total
+    class Value(object):
+        value = 1
+    assert munged(Value(),3) == 2 + 0 + 2
+    ops = [op for (op,arg) in Code.from_code(munged.func_code).code]
+    assert LOAD_ATTR not in ops[:ops.index(SETUP_LOOP)]
+    #  Nothing is hoisted out of exception handlers
+    @promise.hoist()
+    def divide(items,a,b):
+        out = []
+        for i in items:
+            try:
+                out.append(a / b)
+            except ZeroDivisionError:
+                out.append(None)
+        return out
+    assert divide([1],1,0) == [None]
+    assert divide([1,2],4,2) == [2,2]
+    @promise.hoist()
+    def cleanup(items,a,b,log):
+        for i in items:
+            try:
+                log.append(i)
+            finally:
+                log.append(a / b)
+        return log
+    log = []
+    try:
+        cleanup([1],1,0,log)
+    except ZeroDivisionError:
+        assert log == [1]
+    else:
+        assert False, "dividing by zero should fail"
+
+
+def test_invariant_comprehensions():
+    """Test passing invariant values into generator expressions."""
+    def make(scale):
+        @promise.invariant(["scale","offset","items"])
+        def scaled(items,offset):
+            return (list(x * scale + offset for x in items),
+                    dict((x,list(y * offset for y in items)) for x in items))
+        return scaled
+    scaled = make(3)
+    assert scaled([1,2],10) == ([13,16],{1:[10,20],2:[10,20]})
+    def inner_codes(code):
+        for (op,arg) in code.code:
+            if op == LOAD_CONST and isinstance(arg,Code):
+                yield arg
+                for inner in inner_codes(arg):
+                    yield inner
+    for inner in inner_codes(Code.from_code(scaled.func_code)):
+        ops = [op for (op,arg) in inner.code]
+        assert LOAD_DEREF not in ops and LOAD_CLOSURE not in ops
+        assert not inner.freevars
+    #  The arguments no longer need to be cells
+    assert scaled.func_code.co_cellvars == ()
+    assert scaled([],0) == ([],{})
+
+
+def test_fused_promises():
+    """Test applying stacked promises with one disassembly and assembly."""
+    calls = []
+    converted = []
+    from_code = Code.__dict__["from_code"]
+    to_code = Code.__dict__["to_code"]
+    def counting_from_code(cls,co,compact=False):
+        converted.append(("from",co.co_name))
+        return from_code.__func__(cls,co,compact)
+    def counting_to_code(self):
+        converted.append(("to",self.name))
+        return to_code(self)
+    Code.from_code = classmethod(counting_from_code)
+    Code.to_code = counting_to_code
+    try:
+        @promise.constant(["len"])
+        @promise.invariant(["calls.append"])
+        def record(a,(b,c)=(1,2),*args,**kwds):
+            calls.append((a,b,c,args,kwds))
+            return len(calls)
+        #  Both promises are applied, but the code isn't assembled yet
+        assert converted == [("from","record")]
+        assert record(1,(2,3),4,x=5) == 1
+        assert converted == [("from","record"),("to","record")]
+    finally:
+        Code.from_code = from_code
+        Code.to_code = to_code
+    assert calls == [(1,2,3,(4,),{"x":5})]
+    assert record(6) == 2 and calls[1] == (6,1,2,(),{})
+    code = Code.from_code(record.func_code).code
+    assert (LOAD_CONST,len) in code
+    assert (LOAD_CONST,promise.apply_deferred_promises) not in code
+    @promise.memoize()
+    @promise.constant(["len"])
+    def counted(x):
+        calls.append(x)
+        return len(calls)
+    assert counted(1) == counted(1) == 3 and calls[2:] == [1]
+    @promise.constant(["len"])
+    @promise.invariant(["calls"])
+    def lengths(n):
+        for i in xrange(n):
+            yield len(calls) + i
+    assert list(lengths(2)) == [3,4] and list(lengths(1)) == [3]
+    assert (LOAD_CONST,len) in Code.from_code(lengths.func_code).code
+    #  Broken promises are still reported when they're made
+    try:
+        @promise.invariant(["x"])
+        @promise.constant(["len"])
+        def broken(x):
+            x = len(x)
+            return x
+    except promise.BrokenPromiseError:
+        pass
+    else:
+        assert False, "assigning an invariant name should fail"
+    #  Copies of the function made before its first call run their own code
+    ns = {}
+    exec "def later(x):\n    return len(x) + offset(x)\n" in ns
+    ns["offset"] = lambda x: 1
+    later = promise.invariant(["offset"])(ns["later"])
+    later = promise.constant(["len"])(later)
+    copied = types.FunctionType(later.func_code,{"len":lambda x: 10,
+                                                 "offset":lambda x: 20})
+    assert copied("ab") == 30
+    assert "_promise_deferred" not in later.__dict__
+    assert later("ab") == 3 and copied("ab") == 30
+    def make(n):
+        @promise.constant(["len"])
+        @promise.invariant(["calls"])
+        def closure(x):
+            return len(calls) + n
+        return closure
+    closure = make(1)
+    other = types.FunctionType(closure.func_code,globals(),"other",None,
+                               make(100).func_closure)
+    assert other(0) == len(calls) + 100
+    assert closure(0) == len(calls) + 1 and other(0) == len(calls) + 100
+    #  Promises stacked on a deferred one are applied when first called
+    ns = {}
+    exec "def later(x):\n    return len(x) + offset(x)\n" in ns
+    later = promise.constant(["offset"])(ns["later"])
+    later = promise.constant(["len"])(later)
+    assert len(later._promise_deferred) == 2
+    ns["offset"] = lambda x: 1
+    assert later("ab") == 3
+    ns["offset"] = lambda x: 2
+    assert later("ab") == 3
+    @promise.constant(["len"])
+    @promise.optimize()
+    def ahead(x):
+        return len(x)
+    assert promise.apply_all(ahead) == []
+    assert "_promise_deferred" not in ahead.__dict__
+    assert (LOAD_CONST,len) in Code.from_code(ahead.func_code).code
+    assert ahead("ab") == 2
+
+
+def test_optimize():
+    """Test the peephole optimisations applied by promise.optimize()."""
+    SIZE = 3
+    NAME = "abc"
+    DEBUG = False
+    @promise.optimize()
+    @promise.constant(["SIZE","NAME","DEBUG"])
+    def folded(x):
+        if DEBUG:
+            print "debugging"
+        return (SIZE * 2 + 1, NAME * SIZE, -SIZE, x)
+    assert folded(1) == (7,"abcabcabc",-3,1)
+    code = Code.from_code(folded.func_code).code
+    ops = [op for (op,arg) in code]
+    assert BINARY_MULTIPLY not in ops and BINARY_ADD not in ops
+    assert UNARY_NEGATIVE not in ops
+    assert PRINT_ITEM not in ops and POP_JUMP_IF_FALSE not in ops
+    #  Operations that raise or produce huge values aren't folded
+    @promise.optimize()
+    @promise.constant(["SIZE","NAME"])
+    def unfolded(x):
+        if x:
+            return SIZE / 0
+        return NAME * 1000
+    assert unfolded(0) == "abc" * 1000
+    ops = [op for (op,arg) in Code.from_code(unfolded.func_code).code]
+    assert BINARY_DIVIDE in ops and BINARY_MULTIPLY in ops
+    #  Stores followed by a single load are removed
+    @promise.optimize()
+    def stored(x):
+        y = x + 1
+        return y
+    assert stored(1) == 2
+    assert (STORE_FAST,"y") not in Code.from_code(stored.func_code).code
+    #  But not if the function can see its locals
+    @promise.optimize()
+    def inspected(x):
+        y = x + 1
+        return locals()
+    assert inspected(1) == {"x":1,"y":2}
+    #  Jumps to jumps are threaded, dead code is removed
+    @promise.optimize()
+    def jumpy(x):
+        while True:
+            if x:
+                break
+            return 0
+        return 1
+    assert jumpy(0) == 0 and jumpy(1) == 1
+    code = Code.from_code(jumpy.func_code).code
+    for (i,(op,arg)) in enumerate(code):
+        if op in (JUMP_ABSOLUTE,JUMP_FORWARD):
+            assert code[i+1][0] not in (JUMP_ABSOLUTE,JUMP_FORWARD)
+            assert code[i+1][0] is not arg
+
+
+def test_memoize():
+    """Test remembering results of functions promised by memoize()."""
+    calls = []
+    @promise.memoize(maxsize=2)
+    def lru(a,b=1):
+        calls.append((a,b))
+        return [a,b]
+    assert lru(1) == [1,1]
+    assert lru(1) is lru(1,1)
+    assert calls == [(1,1)]
+    assert promise.memo_stats(lru) == {"hits":2,"misses":1,"size":1,
+                                       "maxsize":2,"policy":"lru"}
+    #  The least recently used entry is evicted
+    lru(2); lru(1); lru(3)
+    assert calls == [(1,1),(2,1),(3,1)]
+    lru(1); lru(2)
+    assert calls == [(1,1),(2,1),(3,1),(2,1)]
+    #  Unhashable arguments are not remembered
+    assert lru([]) == [[],1]
+    assert lru([]) == [[],1]
+    assert calls[-2:] == [([],1),([],1)]
+    stats = promise.memo_stats(lru)
+    assert (stats["hits"],stats["misses"],stats["size"]) == (4,6,2)
+    promise.memo_clear(lru)
+    stats = promise.memo_stats(lru)
+    assert (stats["hits"],stats["misses"],stats["size"]) == (0,0,0)
+    lru(1); lru(1)
+    assert promise.memo_stats(lru)["hits"] == 1
+    #  The least frequently used entry is evicted
+    @promise.memoize(maxsize=2,policy="lfu")
+    def lfu(*args):
+        calls.append(args)
+        return len(args)
+    del calls[:]
+    lfu(1); lfu(1); lfu(2); lfu(3); lfu(1); lfu(2)
+    assert calls == [(1,),(2,),(3,),(2,)]
+    assert promise.memo_stats(lfu)["hits"] == 2
+    #  Eviction uses a heap, pushing back entries used since they were added
+    @promise.memoize(maxsize=8)
+    def ident(x):
+        calls.append(x)
+        return x
+    del calls[:]
+    recent = []
+    expected = []
+    for i in xrange(500):
+        x = (i * i + i // 5) % 11
+        if x in recent:
+            recent.remove(x)
+        else:
+            expected.append(x)
+            if len(recent) == 8:
+                del recent[0]
+        recent.append(x)
+        ident(x)
+    assert calls == expected
+    assert 100 < len(calls) < 400
+    table = ident._promise_memo
+    assert len(table.heap) == len(table.data) == 8
+    #  Errors are not remembered
+    @promise.memoize()
+    def fails(x):
+        calls.append(x)
+        return 1 / x
+    del calls[:]
+    for i in xrange(2):
+        try:
+            fails(0)
+        except ZeroDivisionError:
+            pass
+        else:
+            assert False, "ZeroDivisionError not raised"
+    assert calls == [0,0]
+    #  Recursive calls are memoized too, without any wrapper function
+    @promise.memoize(maxsize=None)
+    def fib(n):
+        if n < 2:
+            return n
+        return fib(n-1) + fib(n-2)
+    assert fib(100) == 354224848179261915075
+    assert promise.memo_stats(fib)["misses"] == 101
+    assert isinstance(fib,types.FunctionType)
+    #  Unsupported functions and policies are rejected
+    try:
+        promise.memoize(policy="random")
+    except ValueError:
+        pass
+    else:
+        assert False, "ValueError not raised"
+    try:
+        @promise.memoize()
+        def kwds(**kwds):
+            return kwds
+    except TypeError:
+        pass
+    else:
+        assert False, "TypeError not raised"
+    try:
+        promise.memo_stats(lambda: None)
+    except TypeError:
+        pass
+    else:
+        assert False, "TypeError not raised"
+
 
 def test_README():
     """Ensure that the README is in sync with the docstring.
@@ -0,0 +1,27 @@
+
+import promise
+
+
+def verify(argtypes):
+    """Verify that the given collecting function works OK."""
+    items = []
+    assert argtypes(items,range(10)) == [0,2,4,6,8]
+    assert argtypes(items,[1,2]) == [0,2,4,6,8,2]
+
+
+#  Collect even numbers, looking up items.append each time round the loop.
+def argtypes0(items,numbers):
+    for x in numbers:
+        if not x % 2:
+            items.append(x)
+    return items
+
+
+#  Collect even numbers, with items promised to be a list.
+@promise.types(items=list)
+def argtypes1(items,numbers):
+    for x in numbers:
+        if not x % 2:
+            items.append(x)
+    return items
+
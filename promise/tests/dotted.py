@@ -0,0 +1,23 @@
+
+import os
+
+import promise
+
+
+def verify(dotted):
+    """Verify that the given dotted function works OK."""
+    assert dotted([]) == []
+    assert dotted(["a","B"]) == ["a","B"]
+    assert dotted(["c"] * 20) == ["c"] * 20
+
+
+def dotted0(names):
+    """Normalise some names, looking up the whole chain each time."""
+    return [os.path.normcase(nm) for nm in names]
+
+
+@promise.constant(["os.path.normcase"])
+def dotted1(names):
+    """Normalise some names, with the whole chain collapsed to a constant."""
+    return [os.path.normcase(nm) for nm in names]
+
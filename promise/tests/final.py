@@ -0,0 +1,53 @@
+
+import promise
+
+
+class PlainCounter(object):
+    """Counts keys, using a tiny helper method to build each key."""
+
+    def __init__(self):
+        self.prefix = "k"
+        self.counts = {}
+
+    def _key(self,x):
+        return (self.prefix,x)
+
+    def count(self,items):
+        counts = self.counts
+        for x in items:
+            key = self._key(x)
+            counts[key] = counts.get(key,0) + 1
+        return counts
+
+
+class FinalCounter(PlainCounter):
+    """Counts keys, with the helper method promised final."""
+
+    @promise.final()
+    def _key(self,x):
+        return (self.prefix,x)
+
+    def count(self,items):
+        counts = self.counts
+        for x in items:
+            key = self._key(x)
+            counts[key] = counts.get(key,0) + 1
+        return counts
+
+promise.final()(FinalCounter)
+
+
+def verify(final):
+    """Verify that the given counting function works OK."""
+    counts = final(range(10) * 2)
+    assert counts[("k",3)] % 2 == 0
+    assert len(counts) == 10
+    counts.clear()
+
+
+#  Count keys, looking up the helper as a bound method each time.
+final0 = PlainCounter().count
+
+#  Count keys, with the helper inlined.
+final1 = FinalCounter().count
+
@@ -42,3 +42,17 @@ def finder2(item):
         i += 1
     return False
 
+@promise.hoist()
+@promise.sensible()
+def finder3(item):
+    """Finder function with len(items) hoisted out of the loop.
+
+    As for finder2, but the call to len() is also only made once.
+    """
+    i = 0
+    while i < len(items):
+        if items[i] == item:
+            return True
+        i += 1
+    return False
+
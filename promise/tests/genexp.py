@@ -0,0 +1,31 @@
+
+import promise
+
+SCALE = 3
+OFFSET = 1
+LIMIT = 150
+
+#  Enough items that looking the globals up on each iteration matters more
+#  than the one-off cost of passing them into the generator expression.
+ITEMS = range(200)
+
+
+def verify(genexp):
+    """Verify that the given scaling function works OK."""
+    assert genexp(range(4)) == [1,4,7,10]
+    scaled = genexp(ITEMS)
+    assert len(scaled) == 150 and scaled[-1] == 448
+    assert genexp([]) == []
+
+
+#  Scale items in a generator expression, looking up globals each time.
+def genexp0(items):
+    return list(x * SCALE + OFFSET for x in items if x < LIMIT)
+
+
+#  Scale items with the globals promised invariant, so they're only looked
+#  up once and passed into the generator expression.
+@promise.invariant(["SCALE","OFFSET","LIMIT"])
+def genexp1(items):
+    return list(x * SCALE + OFFSET for x in items if x < LIMIT)
+
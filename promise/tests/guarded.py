@@ -0,0 +1,44 @@
+
+import promise
+
+
+#  Module-level settings, which might be monkeypatched.
+SCALE = 3
+OFFSET = 7
+LIMIT = 100
+
+def verify(guarded):
+    """Verify that the given guarded function works OK."""
+    assert guarded(0) == 0
+    assert guarded(2) == 17
+    assert guarded(40) == 1720
+    assert guarded(400) == 19800
+
+
+def guarded0(n):
+    """Total some numbers scaled by the settings, looking up every name."""
+    total = 0
+    for i in xrange(n):
+        total += (i * SCALE + OFFSET) % LIMIT
+    return total
+
+
+@promise.constant(["xrange","SCALE","OFFSET","LIMIT"],guarded=True)
+def guarded1(n):
+    """Total with constant settings, checked once on each call."""
+    total = 0
+    for i in xrange(n):
+        total += (i * SCALE + OFFSET) % LIMIT
+    return total
+
+
+#  Not part of the timing sequence:  the guard's overhead compared to this
+#  is reported by TestPromiseTiming.test_guard_overhead() instead.
+@promise.constant(["xrange","SCALE","OFFSET","LIMIT"])
+def unguarded(n):
+    """Total with constant settings, trusted without checking."""
+    total = 0
+    for i in xrange(n):
+        total += (i * SCALE + OFFSET) % LIMIT
+    return total
+
@@ -0,0 +1,63 @@
+
+import promise
+
+
+def wrapper_memoize(maxsize):
+    """Memoize using a wrapper function, in the style of functools.lru_cache.
+
+    Entries are kept in a circular doubly linked list in order of use, so
+    that hits and evictions take constant time.
+    """
+    def decorator(func):
+        data = {}
+        root = []
+        root[:] = [root,root,None,None]
+        def wrapper(*args):
+            try:
+                link = data[args]
+            except KeyError:
+                value = func(*args)
+                if len(data) >= maxsize:
+                    oldest = root[1]
+                    root[1] = oldest[1]
+                    oldest[1][0] = root
+                    del data[oldest[2]]
+                last = root[0]
+                link = [last,root,args,value]
+                last[1] = root[0] = data[args] = link
+                return value
+            else:
+                (prev,next) = link[:2]
+                prev[1] = next
+                next[0] = prev
+                last = root[0]
+                last[1] = root[0] = link
+                link[:2] = [last,root]
+                return link[3]
+        return wrapper
+    return decorator
+
+
+def verify(memoize):
+    """Verify that the given memoized function works OK."""
+    for i in xrange(3):
+        assert memoize(0) == 0
+        assert memoize(3) == 5
+        assert memoize(10) == 285
+
+
+def memoize0(n):
+    """Sum of squares, computed afresh on every call."""
+    return sum(i*i for i in xrange(n))
+
+
+@wrapper_memoize(maxsize=10)
+def memoize1(n):
+    """Sum of squares, memoized by a wrapper function."""
+    return sum(i*i for i in xrange(n))
+
+
+@promise.memoize(maxsize=10)
+def memoize2(n):
+    """Sum of squares, memoized by code injected into the function."""
+    return sum(i*i for i in xrange(n))
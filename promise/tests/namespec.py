@@ -0,0 +1,22 @@
+import __builtin__
+
+from promise.namespec import NameMatcher
+
+
+SPEC = dir(__builtin__) + ["MAX_SIZE","helper_one","_helper_two"]
+
+NAMES = ["len","MAX_SIZE","x","helper_one","_helper_two","os","range","i"]
+
+def verify(namespec):
+    """Verify that the given matching function works OK."""
+    matched = [nm for nm in NAMES if namespec(nm)]
+    assert matched == ["len","MAX_SIZE","helper_one","_helper_two","range"]
+
+
+def namespec0(name):
+    """Match a name by membership in the list of names, as promises did."""
+    return name in SPEC
+
+
+#  Match a name using the precompiled matcher.
+namespec1 = NameMatcher(SPEC).__contains__
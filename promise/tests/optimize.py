@@ -0,0 +1,39 @@
+
+import promise
+
+
+SCALE = 10
+OFFSET = 3
+
+@promise.pure()
+def calculate(a):
+    """Pure function abstracting a calculation."""
+    b = a * 2
+    return b + 1
+
+def verify(optimize):
+    """Verify that the given optimized function works OK."""
+    res = optimize(1)
+    assert res == [60]
+    res = optimize(20)
+    assert res[:4] == [60,180,300,420]
+    assert len(res) == 20
+
+
+def optimize0(n):
+    """Dumb little aggregator using some global constants."""
+    return [SCALE * (OFFSET * 2) * calculate(i) for i in xrange(n)]
+
+
+@promise.constant(["calculate","SCALE","OFFSET"])
+def optimize1(n):
+    """Aggregator with calculate() inlined and constants stored directly."""
+    return [SCALE * (OFFSET * 2) * calculate(i) for i in xrange(n)]
+
+
+@promise.optimize()
+@promise.constant(["calculate","SCALE","OFFSET"])
+def optimize2(n):
+    """Aggregator with constants folded and inlined code cleaned up."""
+    return [SCALE * (OFFSET * 2) * calculate(i) for i in xrange(n)]
+